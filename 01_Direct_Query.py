@@ -2,14 +2,16 @@ import os
 import re
 import traceback
 import streamlit as st
-from llm_helper import LLMHelper
+from llm_helper import get_llm_helper
+from tracing import last_trace
+from warmup import start_warm_up
 
 
 def check_deployment():
     # Check if the deployment is working
     #\ 1. Check if the llm is working
     try:
-        llm_helper = LLMHelper()
+        llm_helper = get_llm_helper()
         llm_helper.standard_query("Generate a joke!")
         st.success("LLM is working!")
     except Exception as e:
@@ -17,7 +19,7 @@ def check_deployment():
         st.error(traceback.format_exc())
     #\ 2. Check if the embedding is working
     try:
-        llm_helper = LLMHelper()
+        llm_helper = get_llm_helper()
         llm_helper.embeddings.embed_documents(texts=["This is a test"])
         st.success("Embedding is working!")
     except Exception as e:
@@ -25,7 +27,7 @@ def check_deployment():
         st.error(traceback.format_exc())
     #\ 3. Check if vector store is connected
     try:
-        llm_helper = LLMHelper()
+        llm_helper = get_llm_helper()
         llm_helper.print_semantic_similarity("This is a test About Senacor")
         st.success("Semantic Similarity Search is working!")
     except Exception as e:
@@ -72,6 +74,8 @@ def setup_ui():
 
 try:
     setup_ui()
+    # Preload the clients and chains once per server process, so the first question is not the slowest
+    start_warm_up()
     default_prompt = ""
     default_question = ""
     default_answer = ""
@@ -89,6 +93,10 @@ try:
 
     if 'sources' not in st.session_state:
         st.session_state['sources'] = ""
+    if 'context_stats' not in st.session_state:
+        st.session_state['context_stats'] = None
+    if 'trace' not in st.session_state:
+        st.session_state['trace'] = None
     # if 'followup_questions' not in st.session_state:
     #     st.session_state['followup_questions'] = []
     if 'input_message_key' not in st.session_state:
@@ -97,8 +105,8 @@ try:
         st.session_state.askedquestion = default_question
 
 
-    llm_helper = LLMHelper(custom_prompt=st.session_state.custom_prompt,
-                           temperature=st.session_state.custom_temperature)
+    llm_helper = get_llm_helper(custom_prompt=st.session_state.custom_prompt,
+                               temperature=st.session_state.custom_temperature)
 
     # Custom prompt variables
     custom_prompt_placeholder = """{summaries}  
@@ -131,11 +139,20 @@ try:
     if st.session_state.askedquestion != '':
         st.session_state['question'] = st.session_state.askedquestion
         st.session_state.askedquestion = ""
-        st.session_state['question'], \
-            st.session_state['response'], \
-            st.session_state['context'], \
-            st.session_state['sources'] = llm_helper.get_semantic_answer_lang_chain(st.session_state['question'],
-                                                                                    [])
+        # Stream the answer into a placeholder, it is replaced by the formatted answer below once it is complete
+        answer_placeholder = st.empty()
+        for event, value in llm_helper.get_semantic_answer_lang_chain_stream(st.session_state['question'], []):
+            if event == "partial":
+                answer_placeholder.markdown("Answer: " + value + "▌")
+            else:
+                st.session_state['question'], \
+                    st.session_state['response'], \
+                    st.session_state['context'], \
+                    st.session_state['sources'] = value
+        answer_placeholder.empty()
+        st.session_state['context_stats'] = llm_helper.context_packer.last_stats \
+            if llm_helper.context_packer is not None else None
+        st.session_state['trace'] = last_trace().to_dict() if last_trace() is not None else None
         # st.session_state['response'], followup_questions_list = llm_helper.extract_followupquestions(
         #     st.session_state['response'])
         # st.session_state['followup_questions'] = followup_questions_list
@@ -150,6 +167,9 @@ try:
             llm_helper.get_links_filenames(st.session_state['response'], st.session_state['sources']))
         st.write("<br>", unsafe_allow_html=True)
         st.markdown("Answer: " + st.session_state['response'])
+        if st.session_state['context_stats']:
+            st.caption("Context: {tokens_out} tokens from {chunks_out} segments "
+                       "({tokens_saved} of {tokens_in} tokens saved)".format(**st.session_state['context_stats']))
 
     # Display proposed follow-up questions which can be clicked on to ask that question automatically
     # if len(st.session_state['followup_questions']) > 0:
@@ -178,6 +198,18 @@ try:
                     for i, context_text in enumerate(st.session_state['context'][content_source]):
                         st.markdown(f"Chunk {i+1}: {context_text}")
 
+        # Duration of each stage of the last question, with the token counts and cache hits of the stage
+        if st.session_state['trace']:
+            with st.expander("Timing"):
+                trace = st.session_state['trace']
+                st.markdown(f"**Total: {trace['duration'] * 1000:.0f} ms**")
+                for stage in trace['spans']:
+                    attributes = ", ".join(f"{key}: {value}" for key, value in stage['attributes'].items())
+                    st.markdown(f"- {stage['name']}: {stage['duration'] * 1000:.0f} ms"
+                                + (f" ({attributes})" if attributes else ""))
+                if trace['attributes']:
+                    st.caption(", ".join(f"{key}: {value}" for key, value in trace['attributes'].items()))
+
     # for questionId, followup_question in enumerate(st.session_state['followup_questions']):
     #     if followup_question:
     #         str_followup_question = re.sub(r"(^|[^\\\\])'", r"\1\\'", followup_question)
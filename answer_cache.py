@@ -0,0 +1,141 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Semantic answer cache: answers are stored under the embedding of the condensed question, so paraphrases of an
+# already answered question can be served without a GPT call. Each entry also remembers the chunks that were used
+# to answer it, a hit is only valid as long as the retrieval for the new question still returns the same chunks.
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 24 * 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1000))
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", None)
+
+
+class CacheEntry:
+    # A cached answer together with the data needed to decide whether it is still valid
+
+    def __init__(self, key, namespace, embedding, chunk_ids, value, created_at):
+        self.key = key
+        self.namespace = namespace
+        self.embedding = embedding
+        self.chunk_ids = tuple(chunk_ids)
+        self.value = value
+        self.created_at = created_at
+
+
+class SemanticAnswerCache:
+    # In-memory LRU cache with TTL, optionally written through to a SQLite file so it survives restarts
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                 path=ANSWER_CACHE_PATH):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._open_db(path)
+
+    def _open_db(self, path):
+        # Open the SQLite backend and load the entries that are not expired yet
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS answers (key INTEGER PRIMARY KEY, namespace TEXT, "
+                         "embedding BLOB, chunk_ids TEXT, value TEXT, created_at REAL)")
+        self._db.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - self.ttl,))
+        self._db.commit()
+        rows = self._db.execute("SELECT key, namespace, embedding, chunk_ids, value, created_at FROM answers "
+                                "ORDER BY created_at").fetchall()
+        for key, namespace, embedding, chunk_ids, value, created_at in rows[-self.max_entries:]:
+            self._entries[key] = CacheEntry(key, namespace, np.frombuffer(embedding, dtype=np.float32),
+                                            json.loads(chunk_ids), json.loads(value), created_at)
+            self._next_key = max(self._next_key, key + 1)
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM answers WHERE key = ?", (key,))
+            self._db.commit()
+
+    def lookup(self, embedding, namespace=""):
+        # Return the most similar entry above the threshold, or None. The caller still has to validate the chunk ids.
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            best_entry, best_score = None, self.threshold
+            for key, entry in list(self._entries.items()):
+                if now - entry.created_at > self.ttl:
+                    self._remove(key)
+                    continue
+                if entry.namespace != namespace:
+                    continue
+                score = float(np.dot(vector, entry.embedding))
+                if score >= best_score:
+                    best_entry, best_score = entry, score
+            if best_entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_entry.key)
+            return best_entry
+
+    def validate(self, entry, chunk_ids):
+        # A hit only counts if the index still returns the chunks the answer was built from, otherwise drop it
+        with self._lock:
+            if tuple(chunk_ids) == entry.chunk_ids:
+                self.hits += 1
+                return True
+            self.misses += 1
+            self._remove(entry.key)
+            return False
+
+    def store(self, embedding, chunk_ids, value, namespace=""):
+        # Add an answer to the cache, evicting the least recently used entries when full
+        vector = self._normalize(embedding)
+        with self._lock:
+            entry = CacheEntry(self._next_key, namespace, vector, chunk_ids, value, time.time())
+            self._next_key += 1
+            self._entries[entry.key] = entry
+            if self._db is not None:
+                self._db.execute("INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                                 (entry.key, namespace, vector.tobytes(), json.dumps(list(entry.chunk_ids)),
+                                  json.dumps(value), entry.created_at))
+                self._db.commit()
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM answers")
+                self._db.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    # One cache per process, so all sessions and helpers share the entries and the SQLite connection
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SemanticAnswerCache()
+        return _cache
@@ -0,0 +1,145 @@
+import re
+
+# Post-processing of the LLM answers. All patterns are compiled once, and the answer is scanned a single time: the
+# scan stops at the sources list the LLM appends, numbers the [[filename]] citations on the way, and hands the rest
+# over to the follow-up question parser once the follow-up section starts. Every step is linear in the answer
+# length, so it can run on every streamed chunk and on long answers with many citations.
+
+# The LLM appends the sources in one of these spellings, everything from the first marker on is dropped
+_SOURCES_MARKER_PATTERN = re.compile(r"SOURCES:|Sources:|SOURCE:|Source:")
+# Longest marker minus one, the number of characters a marker can reach back into already scanned text
+SOURCES_MARKER_OVERLAP = len("SOURCES:") - 1
+_CITATION_PATTERN = re.compile(r"\[\[(.*?)\]\]")
+_CITATION_REFERENCE_PATTERN = re.compile(r"\$\^\{(\d+)\}\$")
+_BODY_PATTERN = re.compile(r"(?P<sources>SOURCES:|Sources:|SOURCE:|Source:)|(?P<citation>\[\[(?P<filename>.*?)\]\])|"
+                           r"(?P<followup>Follow-up Questions|<<)")
+# Follow-up questions as <<question>>, as a numbered list or as "Follow-up Question: ..." lines
+_FOLLOWUP_PATTERNS = (
+    (re.compile(r"\<\<(.*?)\>\>"), 2, -2),
+    (re.compile(r"\d. (.*)"), 3, None),
+    (re.compile(r"Follow-up Question: (.*)"), 19, None),
+)
+# Headings of the follow-up section the LLM sometimes writes in the answer before the << >> questions
+_FOLLOWUP_HEADING_PATTERN = re.compile(r"follow[- ]up questions", re.IGNORECASE)
+# "[path/to/filename.ext]" in the source links, replaced by "[filename]"
+_SOURCE_LINK_PATTERN = re.compile(r"\[[^\]]*?/([^/\]]*?)\]")
+# Answers that can not be UTF-8 decoded from Latin-1 (characters beyond Latin-1) are left as they are
+_NON_LATIN1_PATTERN = re.compile(r"[^\x00-\xff]")
+
+
+class ProcessedAnswer:
+    # Result of the post-processing: the answer text, the cited sources in order of their first citation, the
+    # follow-up questions and the normalized source links
+
+    def __init__(self, answer, cited_sources, followup_questions, sources):
+        self.answer = answer
+        self.cited_sources = cited_sources
+        self.followup_questions = followup_questions
+        self.sources = sources
+
+
+def find_sources_marker(text, start=0):
+    # Position of the first sources marker at or after start, or -1
+    match = _SOURCES_MARKER_PATTERN.search(text, start)
+    return match.start() if match else -1
+
+
+def strip_sources_section(answer):
+    position = find_sources_marker(answer)
+    return answer if position == -1 else answer[:position]
+
+
+def clean_encoding(text):
+    # Repair UTF-8 text that was decoded as Latin-1 (e.g. "Ã¤" -> "ä"), text that is not affected is returned as is
+    if text.isascii() or _NON_LATIN1_PATTERN.search(text):
+        return text
+    try:
+        return text.encode("ISO-8859-1").decode("utf-8")
+    except UnicodeError:
+        return text
+
+
+def filter_sources_links(sources):
+    # '[anypath/anypath/somefilename.xxx](the_link)' -> '[somefilename](the_link)', one source per markdown line
+    sources = _SOURCE_LINK_PATTERN.sub(lambda match: "[" + match.group(1).split(".")[0] + "]", sources)
+    return "  \n " + sources.replace("\n", "  \n ")
+
+
+def parse_followup_questions(text):
+    # Each pattern continues where the previous one found its last question, like the LLM writes them
+    questions, position = [], 0
+    for pattern, start_offset, end_offset in _FOLLOWUP_PATTERNS:
+        for match in pattern.finditer(text, position):
+            end = match.end() + end_offset if end_offset else match.end()
+            questions.append(text[match.start() + start_offset:end])
+            position = match.end()
+    return questions
+
+
+def cut_followup_heading(answer):
+    match = _FOLLOWUP_HEADING_PATTERN.search(answer)
+    return answer if match is None else answer[:match.start()]
+
+
+def cited_references(answer, filenames):
+    # Filenames whose citation number ("$^{1}$") already is in the answer, e.g. when the page is reloaded
+    numbers = {int(number) for number in _CITATION_REFERENCE_PATTERN.findall(answer)}
+    return [filename for i, filename in enumerate(filenames) if i + 1 in numbers]
+
+
+def _citation_replacer(filenames, matched_sources):
+    # Replacement for a cited filename: $^{n}$ with n the position of the file in filenames, unknown files keep
+    # their name. Cited files are appended (lowercased) to matched_sources in order of their first citation.
+    positions = {filename: i + 1 for i, filename in reversed(list(enumerate(filenames)))}
+
+    def replace(cited):
+        filename = cited.split(".")[0]  # remove any extension to the name of the source document
+        if filename not in positions:
+            return "$^{" + filename.lower() + "}$"
+        if filename.lower() not in matched_sources:
+            matched_sources.append(filename.lower())
+        return "$^{" + str(positions[filename]) + "}$"
+
+    return replace
+
+
+def number_citations(answer, filenames):
+    # Replace the [[filename]] citations, returns the answer and the cited filenames
+    matched_sources = []
+    replace = _citation_replacer(filenames, matched_sources)
+    return _CITATION_PATTERN.sub(lambda match: replace(match.group(1)), answer), matched_sources
+
+
+def process_answer(answer, filenames=None, sources=None, extract_followups=True):
+    # Single scan over the answer: cut at the sources marker, number the citations if filenames are given, and
+    # split off the follow-up questions. The source links are normalized as well.
+    parts, matched_sources, followup_questions = [], [], []
+    replace_citation = _citation_replacer(filenames, matched_sources) if filenames is not None else None
+    position = 0
+    for match in _BODY_PATTERN.finditer(answer):
+        kind = match.lastgroup if match.lastgroup != "filename" else "citation"
+        if kind == "followup" and not extract_followups:
+            continue
+        parts.append(answer[position:match.start()])
+        position = match.end()
+        if kind == "sources":
+            position = len(answer)
+            break
+        if kind == "followup":
+            followup_section = answer[match.start():]
+            sources_position = find_sources_marker(followup_section)
+            if sources_position != -1:
+                followup_section = followup_section[:sources_position]
+            followup_questions = parse_followup_questions(followup_section.strip())
+            position = len(answer)
+            break
+        parts.append(replace_citation(match.group("filename")) if replace_citation else match.group(0))
+    parts.append(answer[position:])
+    text = "".join(parts)
+    if extract_followups:
+        text = cut_followup_heading(text)
+    if filenames is not None:
+        lowered = [filename.lower() for filename in filenames]
+        matched_sources += [f for f in cited_references(text, lowered) if f not in matched_sources]
+    return ProcessedAnswer(clean_encoding(text), matched_sources, followup_questions,
+                           filter_sources_links(sources) if sources is not None else "")
@@ -0,0 +1,195 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from tracing import last_trace
+
+# Bulk question answering, e.g. to re-run the reference questions after a prompt change or an index update.
+# Questions are read from JSONL, identical questions are answered once, and the answers are appended to the output
+# JSONL as soon as they are ready. Questions that already have an answer in the output file are skipped, so an
+# interrupted run continues where it stopped when it is started again with the same output file.
+#
+#   python batch_runner.py questions.jsonl answers.jsonl --workers 8 --requests-per-minute 120
+#
+# Input lines are either a JSON string or an object with "question" and optionally "id" and "chat_history" (a list of
+# [question, answer] pairs). Output lines contain the ids of all input lines with the question, the answer, sources,
+# context and the duration of each stage, or the error if the question failed (it is retried by the next run).
+
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 4))
+BATCH_REQUESTS_PER_MINUTE = int(os.getenv("BATCH_REQUESTS_PER_MINUTE", 60))
+BATCH_TOKENS_PER_MINUTE = int(os.getenv("BATCH_TOKENS_PER_MINUTE", 120000))
+
+# Span attributes of the traces that count tokens sent to or generated by the LLM
+_LLM_TOKEN_ATTRIBUTES = ("prompt_tokens", "completion_tokens", "history_tokens")
+
+
+def llm_tokens(finished_trace):
+    # Tokens sent to and generated by the LLM in a trace
+    return sum(span["attributes"].get(key, 0) for span in finished_trace.spans for key in _LLM_TOKEN_ATTRIBUTES)
+
+
+def question_key(question, chat_history=()):
+    # Identical questions (ignoring surrounding whitespace) with the same chat history are answered once
+    payload = json.dumps([question.strip(), [list(turn) for turn in chat_history]], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def unique_questions(records):
+    # Unique questions in input order as {"key", "ids", "question", "chat_history"}. Records are dicts with
+    # "question" and optionally "id" (default: the position) and "chat_history".
+    questions = {}
+    for position, record in enumerate(records):
+        chat_history = [tuple(turn) for turn in record.get("chat_history", [])]
+        key = question_key(record["question"], chat_history)
+        entry = questions.setdefault(key, {"key": key, "ids": [], "question": record["question"].strip(),
+                                           "chat_history": chat_history})
+        entry["ids"].append(record.get("id", position))
+    return list(questions.values())
+
+
+def read_questions(path):
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            records.append({"question": record, "id": line_number} if isinstance(record, str)
+                           else dict({"id": line_number}, **record))
+    return unique_questions(records)
+
+
+def answered_keys(path):
+    # Keys of the questions with an answer in an existing output file, a partially written last line is ignored
+    keys = set()
+    if not os.path.exists(path):
+        return keys
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if "error" not in result:
+                keys.add(result["key"])
+    return keys
+
+
+class BatchRunner:
+    # Answers questions with a bounded number of workers. Each question is booked on a requests-per-minute and
+    # tokens-per-minute budget before it starts, the tokens of a question are estimated from the questions already
+    # answered (prompt, condense and completion tokens of their traces).
+
+    def __init__(self, llm_helper, workers=BATCH_WORKERS, requests_per_minute=BATCH_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=BATCH_TOKENS_PER_MINUTE):
+        # embedding_scheduler imports openai, llm_helper imports this module on every page start
+        from embedding_scheduler import RateBudget
+        self.llm_helper = llm_helper
+        self.workers = workers
+        self.budget = RateBudget(tokens_per_minute, requests_per_minute)
+        self._tokens_lock = threading.Lock()
+        self._answered = 0
+        self._tokens = 0
+
+    def _estimated_tokens(self):
+        with self._tokens_lock:
+            return self._tokens // self._answered if self._answered else 0
+
+    def _book_tokens(self, tokens):
+        with self._tokens_lock:
+            self._answered += 1
+            self._tokens += tokens
+
+    def answer(self, entry):
+        # Answer one question, returns the output record
+        self.budget.acquire(self._estimated_tokens())
+        started = time.perf_counter()
+        result = {"key": entry["key"], "ids": entry["ids"], "question": entry["question"]}
+        try:
+            _, answer, context, sources = self.llm_helper.get_semantic_answer_lang_chain(entry["question"],
+                                                                                         entry["chat_history"])
+            result.update(answer=answer, sources=sources, context=context)
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["seconds"] = time.perf_counter() - started
+        finished = last_trace()
+        if finished is not None:
+            result["stages"] = finished.stage_durations()
+            tokens = llm_tokens(finished)
+            result["tokens"] = tokens
+            self._book_tokens(tokens)
+        return result
+
+    def run(self, questions):
+        # Yields the output records in the order they finish. At most 2 x workers questions are submitted at once, so
+        # an interrupted run has not started (and paid for) more questions than it could write.
+        questions = iter(questions)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            while True:
+                for entry in questions:
+                    pending.add(executor.submit(self.answer, entry))
+                    if len(pending) >= 2 * self.workers:
+                        break
+                if not pending:
+                    return
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+
+def run_batch(llm_helper, input_path, output_path, workers=BATCH_WORKERS,
+              requests_per_minute=BATCH_REQUESTS_PER_MINUTE, tokens_per_minute=BATCH_TOKENS_PER_MINUTE):
+    # Answer the questions of input_path that have no answer in output_path yet, returns the counts of the run
+    questions = read_questions(input_path)
+    done = answered_keys(output_path)
+    todo = [entry for entry in questions if entry["key"] not in done]
+    stats = {"questions": len(questions), "skipped": len(questions) - len(todo), "answered": 0, "failed": 0}
+    runner = BatchRunner(llm_helper, workers, requests_per_minute, tokens_per_minute)
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "a+", encoding="utf-8") as f:
+        # Terminate the line an interrupted run was writing, it is ignored as not answered
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        for result in runner.run(todo):
+            f.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            stats["failed" if "error" in result else "answered"] += 1
+            print(f"{stats['answered'] + stats['failed']}/{len(todo)} {result['question'][:80]!r} "
+                  f"{'failed' if 'error' in result else 'answered'} in {result['seconds']:.1f}s")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer the questions of a JSONL file and write the answers as JSONL")
+    parser.add_argument("input", help="JSONL file with the questions")
+    parser.add_argument("output", help="JSONL file the answers are appended to, answered questions are skipped")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--requests-per-minute", type=int, default=BATCH_REQUESTS_PER_MINUTE)
+    parser.add_argument("--tokens-per-minute", type=int, default=BATCH_TOKENS_PER_MINUTE)
+    parser.add_argument("--prompt-file",
+                        help="custom prompt with {summaries} and {question} (default: the prompt of customprompt.py)")
+    parser.add_argument("--temperature", type=float, default=float(os.getenv("OPENAI_TEMPERATURE", 0.7)))
+    args = parser.parse_args()
+
+    from llm_helper import get_llm_helper
+    custom_prompt = ""
+    if args.prompt_file:
+        with open(args.prompt_file, encoding="utf-8") as f:
+            custom_prompt = f.read()
+    llm_helper = get_llm_helper(custom_prompt=custom_prompt, temperature=args.temperature)
+    stats = llm_helper.answer_questions_file(args.input, args.output, workers=args.workers,
+                                             requests_per_minute=args.requests_per_minute,
+                                             tokens_per_minute=args.tokens_per_minute)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import hashlib
+import re
+import time
+from typing import Any, Iterator, List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Deterministic stand-ins for the Azure OpenAI chat model and embeddings. They answer instantly apart from a
+# configurable latency, so the benchmarks measure our own code plus a fixed, known service time.
+
+_WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+_SOURCE_PATTERN = re.compile(r"^Source: (.+)$", re.MULTILINE)
+_FOLLOWUP_INPUT_PATTERN = re.compile(r"Follow Up Input: (.*)\n")
+
+
+class FakeChatModel(BaseChatModel):
+    # Answers from the prompt itself: the condense prompt returns the follow-up question, the summary prompt a short
+    # summary, and the QA prompt the first words of the context with a citation per source and a sources list
+    latency: float = 0.5
+    token_latency: float = 0.01
+    answer_words: int = 80
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _respond(self, messages: List[BaseMessage]) -> str:
+        prompt = "\n".join(message.content for message in messages)
+        followup = _FOLLOWUP_INPUT_PATTERN.search(prompt)
+        if followup:
+            return followup.group(1).strip()
+        if "Progressively summarize" in prompt:
+            return " ".join(_WORD_PATTERN.findall(prompt)[-self.answer_words // 2:])
+        sources = list(dict.fromkeys(_SOURCE_PATTERN.findall(prompt)))
+        words = _WORD_PATTERN.findall(prompt)[:self.answer_words]
+        citations = "".join(f"[[{source}]]" for source in sources)
+        return " ".join(words) + " " + citations + "\nSOURCES: " + ", ".join(sources)
+
+    def _tokens(self, text):
+        return re.findall(r"\S+\s*", text)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        text = self._respond(messages)
+        time.sleep(self.latency + self.token_latency * len(self._tokens(text)))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for token in self._tokens(self._respond(messages)):
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+class FakeEmbeddings(Embeddings):
+    # Hashed bag-of-words vectors: texts sharing words are similar, so retrieval returns sensible results. The latency
+    # is charged per request plus per text, like a batch embeddings call.
+
+    def __init__(self, size=256, latency=0.05, text_latency=0.001):
+        self.size = size
+        self.latency = latency
+        self.text_latency = text_latency
+        self.model = "fake-embeddings"
+        # EmbeddingScheduler sends its requests through embed_documents when the client has no raw responses
+        self.client = None
+        self.requests = 0
+
+    def _vector(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in _WORD_PATTERN.findall(text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.size] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        self.requests += 1
+        time.sleep(self.latency + self.text_latency * len(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        self.requests += 1
+        time.sleep(self.latency)
+        return self._vector(text)
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# Local HTTP servers for the benchmarks: a synthetic website (pages linking to each other, with ETags for conditional
+# requests) with the subset of the Confluence REST API the ConfluenceLoader and the delta sync use, and a stub of an
+# OpenAI-compatible chat completions server for the LLM routing. All content is generated from the page number, so
+# every run sees the same site.
+
+_VOCABULARY = ("project client team consulting banking insurance cloud migration architecture platform data "
+               "analytics delivery agile scrum backlog release security compliance onboarding training office "
+               "location employee benefit process review quality testing automation pipeline service customer "
+               "strategy roadmap budget contract partner network event workshop knowledge article guideline").split()
+_SITE_NAVIGATION = "<nav><ul>\n" + "\n".join(
+    f'<li><a href="/site/page/0">{entry}</a></li>'
+    for entry in ("Home", "Services", "Industries", "Insights", "Careers", "About us", "Contact")) + "\n</ul></nav>"
+_SITE_FOOTER = ("<footer>\n<p>We use cookies to improve your experience on our website. By continuing to browse, you "
+                "agree to our use of cookies as described in our cookie policy.</p>\n<p>Copyright 2024 Example "
+                "Consulting GmbH. All rights reserved. Imprint, privacy policy and terms of use apply to all content "
+                "published on this website.</p>\n<p>Follow us on LinkedIn, Xing and GitHub.</p>\n</footer>")
+_PAGE_PATTERN = re.compile(r"^/site/page/(\d+)$")
+_CONTENT_PATTERN = re.compile(r"/rest/api/content/(\d+)(/restriction/byOperation)?$")
+
+
+def synthetic_text(seed, paragraphs=6, sentences=5):
+    rng = random.Random(seed)
+    return ["".join(" ".join(rng.choice(_VOCABULARY) for _ in range(rng.randint(8, 16))).capitalize() + ". "
+                    for _ in range(sentences)).strip() for _ in range(paragraphs)]
+
+
+class SyntheticServer:
+    # Serves site_pages website pages under /site and confluence_pages pages with ids 1000, 1001, ... Every response
+    # is delayed by latency seconds, like the round trip to a remote server.
+
+    def __init__(self, site_pages=50, confluence_pages=50, links_per_page=5, paragraphs=6, version=1, latency=0.0):
+        self.site_pages = site_pages
+        self.confluence_pages = confluence_pages
+        self.links_per_page = links_per_page
+        self.paragraphs = paragraphs
+        self.version = version
+        self.latency = latency
+        self.requests = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    @property
+    def confluence_page_ids(self):
+        return [str(1000 + i) for i in range(self.confluence_pages)]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def site_page(self, number):
+        links = "".join(f'<li><a href="/site/page/{(number * self.links_per_page + i) % self.site_pages}">'
+                        f'Page {(number * self.links_per_page + i) % self.site_pages}</a></li>'
+                        for i in range(1, self.links_per_page + 1))
+        body = "\n".join(f"<p>{paragraph}</p>" for paragraph in synthetic_text(number, self.paragraphs))
+        # Site-wide navigation, footer and cookie banner, the same on every page
+        return (f"<html><head><title>Page {number}</title></head><body>\n{_SITE_NAVIGATION}\n"
+                f"<nav><ul>{links}</ul></nav>\n<h1>Page {number}</h1>\n{body}\n{_SITE_FOOTER}\n</body></html>")
+
+    def confluence_page(self, page_id, expand=""):
+        number = int(page_id) - 1000
+        page = {"id": page_id, "type": "page", "status": "current", "title": f"Confluence page {number}",
+                "version": {"number": self.version, "when": "2024-01-01T00:00:00.000Z"},
+                "_links": {"webui": f"/pages/viewpage.action?pageId={page_id}"}}
+        if "body" in expand:
+            html = "".join(f"<p>{paragraph}</p>" for paragraph in synthetic_text(10000 + number, self.paragraphs))
+            page["body"] = {format: {"value": html, "representation": format}
+                            for format in ("view", "storage", "export_view")}
+        return page
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=b"", content_type="text/html", headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self, data):
+                self._send(200, json.dumps(data).encode("utf-8"), "application/json")
+
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.latency)
+                parts = urlsplit(self.path)
+                query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+                path = parts.path.rstrip("/") or "/"
+                if path in ("/site", "/"):
+                    path = "/site/page/0"
+                page = _PAGE_PATTERN.match(path)
+                if page and int(page.group(1)) < server.site_pages:
+                    body = server.site_page(int(page.group(1))).encode("utf-8")
+                    etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                    if self.headers.get("If-None-Match") == etag:
+                        return self._send(304, headers={"ETag": etag})
+                    return self._send(200, body, headers={"ETag": etag})
+                content = _CONTENT_PATTERN.search(path)
+                if path.endswith("/child/attachment"):
+                    return self._json({"results": [], "start": 0, "limit": 50, "size": 0})
+                if content and content.group(1) in server.confluence_page_ids:
+                    if content.group(2):
+                        empty = {"results": []}
+                        return self._json({"read": {"restrictions": {"user": empty, "group": empty}}})
+                    return self._json(server.confluence_page(content.group(1), query.get("expand", "")))
+                if path.endswith("/rest/api/content"):
+                    start, limit = int(query.get("start", 0)), int(query.get("limit", 25))
+                    ids = server.confluence_page_ids[start:start + limit]
+                    return self._json({"results": [server.confluence_page(i, query.get("expand", "")) for i in ids],
+                                       "start": start, "limit": limit, "size": len(ids)})
+                self._send(404, b"Not found")
+
+        return Handler
+
+
+class OpenAIStubServer:
+    # OpenAI-compatible chat completions endpoint (/v1/chat/completions, also streamed) like the one vLLM serves.
+    # Answers take latency seconds (plus up to jitter), every rate_limit_every-th request is answered with a 429 and
+    # slow_every-th request takes slow_latency seconds instead, to exercise failover and hedging.
+
+    def __init__(self, name="stub", latency=0.1, jitter=0.0, rate_limit_every=0, slow_every=0, slow_latency=5.0,
+                 retry_after=1, answer="This is the answer of the stub server."):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_every = rate_limit_every
+        self.slow_every = slow_every
+        self.slow_latency = slow_latency
+        self.retry_after = retry_after
+        self.answer = answer
+        self.requests = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(name)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        # Clients that time out close the connection while the stub is still answering
+        self._server.handle_error = lambda request, client_address: None
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_request(self):
+        # (rate limited, seconds to answer) of the next request
+        with self._lock:
+            self.requests += 1
+            number = self.requests
+            jitter = self._rng.uniform(0, self.jitter)
+            if self.rate_limit_every and number % self.rate_limit_every == 0:
+                self.rate_limited += 1
+                return True, 0.0
+        if self.slow_every and number % self.slow_every == 0:
+            return False, self.slow_latency
+        return False, self.latency + jitter
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, status, data, headers=None):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if urlsplit(self.path).path.rstrip("/") != "/v1/chat/completions":
+                    return self._json(404, {"error": {"message": "Not found"}})
+                rate_limited, seconds = server._next_request()
+                if rate_limited:
+                    return self._json(429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit"}},
+                                      {"retry-after": str(max(int(server.retry_after), 1)),
+                                       "retry-after-ms": str(int(server.retry_after * 1000))})
+                time.sleep(seconds)
+                completion = {"id": "chatcmpl-stub", "created": int(time.time()), "model": request.get("model", ""),
+                              "system_fingerprint": server.name}
+                if not request.get("stream"):
+                    return self._json(200, dict(completion, object="chat.completion", choices=[
+                        {"index": 0, "message": {"role": "assistant", "content": server.answer},
+                         "finish_reason": "stop"}], usage={"prompt_tokens": 1, "completion_tokens": 1,
+                                                           "total_tokens": 2}))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                words = re.findall(r"\S+\s*", server.answer)
+                for i, word in enumerate(words):
+                    delta = {"role": "assistant", "content": word} if i == 0 else {"content": word}
+                    chunk = dict(completion, object="chat.completion.chunk",
+                                 choices=[{"index": 0, "delta": delta, "finish_reason": None}])
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                chunk = dict(completion, object="chat.completion.chunk",
+                             choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
@@ -0,0 +1,350 @@
+import argparse
+import functools
+import inspect
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.local_server import SyntheticServer, OpenAIStubServer, synthetic_text
+
+# Offline benchmarks for the query and ingestion paths. The Azure services are replaced by the stand-ins in
+# benchmarks.fakes, the vector index by the in-process LocalVectorStore, and the website and Confluence by a local
+# HTTP server. All caches and indexes live in a temporary directory, so every run starts cold.
+#
+#   python -m benchmarks.run --output results.json
+#   python -m benchmarks.run --output new.json --compare results.json
+#
+# The results are JSON, and --compare prints the relative change of every number against an earlier run.
+
+
+def configure_environment(workdir, server, args):
+    # Must run before the application modules are imported, they read their settings at import time
+    os.environ.update({
+        "VECTOR_STORE_BACKEND": "local",
+        "LOCAL_INDEX_PATH": os.path.join(workdir, "index"),
+        "LEXICAL_INDEX_PATH": os.path.join(workdir, "lexical"),
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embeddings.sqlite"),
+        "ATTACHMENT_CACHE_PATH": os.path.join(workdir, "attachments.sqlite"),
+        "DEDUP_STATE_PATH": os.path.join(workdir, "dedup.sqlite"),
+        "INGESTION_CHECKPOINT_PATH": os.path.join(workdir, "checkpoints.sqlite"),
+        "SYNC_STATE_PATH": os.path.join(workdir, "sync_state.sqlite"),
+        "CRAWL_STATE_PATH": os.path.join(workdir, "crawl_state.sqlite"),
+        "ANSWER_CACHE_PATH": "",
+        "CRAWL_MAX_DEPTH": "100",
+        "CRAWL_MAX_PAGES": str(args.site_pages),
+        "CONFLUENCE_URL": server.url,
+        "CONFLUENCE_TOKEN": "benchmark",
+        "CONFLUENCE_API_KEY": "",
+    })
+
+
+def install_fakes(args):
+    from benchmarks.fakes import FakeChatModel, FakeEmbeddings
+    from client_registry import register_clients
+    from embedding_cache import CachedEmbeddings, get_embedding_store
+    from embedding_scheduler import EmbeddingScheduler
+    embeddings = FakeEmbeddings(latency=args.embedding_latency)
+    register_clients(llm=FakeChatModel(latency=args.llm_latency, token_latency=args.token_latency),
+                     embeddings=CachedEmbeddings(embeddings, model="fake", store=get_embedding_store()),
+                     ingestion_embeddings=CachedEmbeddings(EmbeddingScheduler(embeddings), model="fake",
+                                                           store=get_embedding_store()))
+    return embeddings
+
+
+def summarize(values):
+    # Milliseconds
+    values = sorted(values)
+    if not values:
+        return {}
+    return {"mean_ms": statistics.mean(values) * 1000, "p50_ms": values[len(values) // 2] * 1000,
+            "p95_ms": values[min(len(values) - 1, int(len(values) * 0.95))] * 1000,
+            "min_ms": values[0] * 1000, "max_ms": values[-1] * 1000, "count": len(values)}
+
+
+def measure_ingestion(name, ingest):
+    # Throughput comes from the pipeline statistics, memory as the growth of the peak RSS and the Python heap peak
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    stats = ingest()
+    seconds = time.perf_counter() - started
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = {"seconds": seconds, "peak_rss_mb": rss_after / 1024,
+              "peak_rss_growth_mb": (rss_after - rss_before) / 1024}
+    result.update({key: value for key, value in (stats or {}).items() if isinstance(value, (int, float))})
+    if tracemalloc.is_tracing():
+        result["python_heap_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.reset_peak()
+    print(f"{name}: {seconds:.2f}s, {result.get('chunks_uploaded', 0)} chunks", file=sys.stderr)
+    return result
+
+
+def bench_ingestion(server, args):
+    from vector_storage import add_website_to_vector_store, add_confluence_to_vector_store
+    site_url = server.url + "/site/page/0"
+    results = {
+        "website_full": measure_ingestion("website_full", lambda: add_website_to_vector_store(site_url)),
+        # Second crawl: every page answers 304
+        "website_only_changed": measure_ingestion(
+            "website_only_changed", lambda: add_website_to_vector_store(site_url, only_changed=True)),
+        "confluence_full": measure_ingestion(
+            "confluence_full", lambda: add_confluence_to_vector_store(page_ids=server.confluence_page_ids)),
+        # No page version changed, only the listing is fetched
+        "confluence_incremental": measure_ingestion(
+            "confluence_incremental",
+            lambda: add_confluence_to_vector_store(page_ids=server.confluence_page_ids, incremental=True)),
+    }
+    results["http_requests"] = server.requests
+    return results
+
+
+def _timed(timings, stage, function):
+    # Wrap a bound method of the helper, the time of each call is added to timings[stage]
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+    return wrapper
+
+
+def benchmark_questions(count):
+    # Distinct questions built from the synthetic vocabulary, every fifth one is a follow-up that needs condensing
+    questions = []
+    for i in range(count):
+        words = synthetic_text(50000 + i, paragraphs=1, sentences=1)[0].rstrip(".").split()[:6]
+        questions.append("What about it?" if i % 5 == 4 else f"What do we know about {' '.join(words)}?")
+    return questions
+
+
+def bench_query(args):
+    from llm_helper import get_llm_helper
+    helper = get_llm_helper()
+    timings = {}
+    # Stages: retrieval (speculative, in parallel with the condense call), answer cache lookup (the rest of
+    # _prepare_answer), context packing, generation (the rest) and post-processing
+    helper._aretrieve = _timed(timings, "retrieve_and_condense", helper._aretrieve)
+    helper._prepare_answer = _timed(timings, "prepare", helper._prepare_answer)
+    helper.pack_context = _timed(timings, "pack_context", helper.pack_context)
+    helper._format_semantic_answer = _timed(timings, "postprocess", helper._format_semantic_answer)
+    helper._store_answer = _timed(timings, "store_answer", helper._store_answer)
+
+    stages, stream_first_token, chat_history = {}, [], []
+    for question in benchmark_questions(args.queries):
+        timings.clear()
+        started = time.perf_counter()
+        _, answer, _, _ = helper.get_semantic_answer_lang_chain(question, chat_history[-8:])
+        total = time.perf_counter() - started
+        record = {"total": total,
+                  "retrieve_and_condense": timings.get("retrieve_and_condense", 0.0),
+                  "answer_cache": timings.get("prepare", 0.0) - timings.get("retrieve_and_condense", 0.0),
+                  "pack_context": timings.get("pack_context", 0.0),
+                  "postprocess": timings.get("postprocess", 0.0),
+                  "store_answer": timings.get("store_answer", 0.0)}
+        record["generate"] = total - sum(value for key, value in record.items() if key != "total")
+        for stage, seconds in record.items():
+            stages.setdefault(stage, []).append(seconds)
+        chat_history.append((question, answer))
+
+        # Same question streamed: time to the first visible text
+        started = time.perf_counter()
+        for event, _ in helper.get_semantic_answer_lang_chain_stream(question + " Please explain.", []):
+            if event == "partial":
+                stream_first_token.append(time.perf_counter() - started)
+                break
+    results = {stage: summarize(values) for stage, values in stages.items()}
+    results["stream_first_token"] = summarize(stream_first_token)
+    if helper.context_packer is not None:
+        results["context_tokens"] = dict(helper.context_packer.totals)
+    return results
+
+
+def synthetic_answer(citations, filenames):
+    # An answer as the LLM writes it: text with [[filename]] citations, follow-up questions and a sources list
+    paragraphs = synthetic_text(7, paragraphs=max(1, citations // 3), sentences=3)
+    body = " ".join(f"{paragraph} [[{filenames[i % len(filenames)]}.pdf]]"
+                    for i, paragraph in enumerate(paragraphs * 3))[:max(1, citations) * 200]
+    return (body + "\nFollow-up Questions:\n<<What else is there?>>\n<<Who is responsible?>>\n"
+            "SOURCES: " + ", ".join(filenames))
+
+
+def bench_postprocessing(args):
+    from answer_postprocessor import process_answer
+    from llm_helper import get_llm_helper
+    helper = get_llm_helper()
+    filenames = [f"document{i}" for i in range(20)]
+    sources = "\n".join(f"[https://confluence.example.com/pages/space/{name}.pdf](https://confluence.example.com/"
+                        f"{name})" for name in filenames)
+    functions = {
+        "process_answer": lambda answer: process_answer(answer, filenames, sources),
+        "strip_sources_section": helper.strip_sources_section,
+        "clean_encoding": helper.clean_encoding,
+        "filter_sources_links": lambda answer: helper.filter_sources_links(sources),
+        "insert_citations_in_answer": lambda answer: helper.insert_citations_in_answer(answer, filenames),
+        "extract_followupquestions": helper.extract_followupquestions,
+        "get_links_filenames": lambda answer: helper.get_links_filenames(answer, sources),
+    }
+    results = {}
+    for size, citations in (("short", 3), ("long", 300)):
+        answer = synthetic_answer(citations, filenames)
+        for name, function in functions.items():
+            timer = timeit.Timer(lambda: function(answer))
+            number, _ = timer.autorange()
+            best = min(timer.repeat(repeat=5, number=number)) / number
+            results.setdefault(name, {})[size + "_us"] = best * 1e6
+        results.setdefault("answer_chars", {})[size] = len(answer)
+    return results
+
+
+def bench_routing(args):
+    # Routed requests against two OpenAI-compatible stub servers: a fast one that rate limits every 7th request and
+    # is slow on every 10th, and a slower, reliable one. Compared with the fast server alone (which retries on 429).
+    from client_registry import get_llm
+    from langchain.schema.messages import HumanMessage
+    from llm_router import get_llm_router
+    fast = OpenAIStubServer("fast", latency=args.llm_latency, jitter=args.llm_latency / 5, rate_limit_every=7,
+                            slow_every=10, slow_latency=args.llm_latency * 10, retry_after=0.25).start()
+    slow = OpenAIStubServer("slow", latency=args.llm_latency * 3, jitter=args.llm_latency / 5).start()
+    results = {}
+    try:
+        os.environ.update({"LLM_BACKEND_FAST_BASE_URL": fast.url, "LLM_BACKEND_SLOW_BASE_URL": slow.url})
+        for name, backends in (("fast_only", ("fast",)), ("routed", ("fast", "slow"))):
+            llm = get_llm(deployment="routing-benchmark", temperature=0, backends=backends)
+            messages = [HumanMessage(content="What do we know about cloud migration?")]
+
+            def request(_):
+                # Latency, or None if the request failed after all retries
+                started = time.perf_counter()
+                try:
+                    llm.invoke(messages)
+                except Exception:
+                    return None
+                return time.perf_counter() - started
+
+            with ThreadPoolExecutor(max_workers=args.routing_concurrency) as executor:
+                outcomes = list(executor.map(request, range(args.routing_requests)))
+            latencies = [latency for latency in outcomes if latency is not None]
+            first_tokens = []
+            for _ in range(args.routing_requests // 5):
+                started = time.perf_counter()
+                next(iter(llm.stream(messages)))
+                first_tokens.append(time.perf_counter() - started)
+            results[name] = {"latency": summarize(latencies), "stream_first_token": summarize(first_tokens),
+                             "failed": len(outcomes) - len(latencies)}
+        results["backends"] = {name: {"requests": stats["requests"], "failures": stats["failures"]}
+                               for name, stats in get_llm_router().stats().items()}
+    finally:
+        fast.stop()
+        slow.stop()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except OSError:
+        return None
+
+
+def flatten(data, prefix=""):
+    values = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare(baseline, current):
+    # Print every number of the current run next to the baseline, with the relative change
+    old, new = flatten(baseline["results"]), flatten(current["results"])
+    print(f"{'metric':<60} {'baseline':>14} {'current':>14} {'change':>9}")
+    for key in sorted(set(old) | set(new)):
+        change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if key in old and key in new and old[key] else ""
+        print(f"{key:<60} {old.get(key, float('nan')):>14.3f} {new.get(key, float('nan')):>14.3f} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the query and ingestion paths")
+    parser.add_argument("--suites", default="ingestion,query,postprocessing,routing",
+                        help="comma separated: ingestion, query, postprocessing, routing")
+    parser.add_argument("--output", help="write the JSON results to this file (default: stdout)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--site-pages", type=int, default=100)
+    parser.add_argument("--confluence-pages", type=int, default=100)
+    parser.add_argument("--server-latency", type=float, default=0.0,
+                        help="seconds added to every response of the website / Confluence server")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds until the first token")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="seconds per generated token")
+    parser.add_argument("--routing-requests", type=int, default=100)
+    parser.add_argument("--routing-concurrency", type=int, default=4)
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embeddings request")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also report the Python heap peak of the ingestion (slows the ingestion down)")
+    args = parser.parse_args()
+    suites = [suite.strip() for suite in args.suites.split(",") if suite.strip()]
+
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    server = SyntheticServer(site_pages=args.site_pages, confluence_pages=args.confluence_pages,
+                             latency=args.server_latency).start()
+    try:
+        configure_environment(workdir, server, args)
+        install_fakes(args)
+        if args.trace_memory:
+            tracemalloc.start()
+        results = {}
+        if "ingestion" in suites:
+            results["ingestion"] = bench_ingestion(server, args)
+        elif "query" in suites:
+            from vector_storage import add_website_to_vector_store
+            add_website_to_vector_store(server.url + "/site/page/0")
+        if "query" in suites:
+            results["query"] = bench_query(args)
+        if "postprocessing" in suites:
+            results["postprocessing"] = bench_postprocessing(args)
+        if "routing" in suites:
+            results["routing"] = bench_routing(args)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {"commit": git_commit(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "config": vars(args), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+from langchain.docstore.document import Document
+
+# Deduplication between splitting and embedding. Website pages share navigation, footers and cookie banners, and
+# Confluence pages repeat their templates, so many chunks are (nearly) the same text in different places.
+# - Boilerplate: a line that was seen on BOILERPLATE_MIN_SOURCES different sources of a website or Confluence space is
+#   stripped from every source of it after that, and in later runs from the start. Short lines (single navigation
+#   entries, headings) are only stripped when they are part of a region of boilerplate lines. The learned lines can be
+#   reset with `python chunk_dedup.py reset-boilerplate [--scope SCOPE]`.
+# - Near-duplicates: chunks are compared by MinHash over word 3-grams, with locality sensitive hashing so only chunks
+#   that share a band of the signature are compared. A chunk that is a near-duplicate of a chunk already kept in this
+#   run is dropped, and its source is added to the "duplicate_sources" metadata of the kept chunk, so answers cite it
+#   as well. For Confluence, the dropped pages are recorded to load them again when the kept page changes.
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_STATE_PATH = os.getenv("DEDUP_STATE_PATH", os.path.join(".cache", "dedup.sqlite"))
+BOILERPLATE_MIN_SOURCES = int(os.getenv("BOILERPLATE_MIN_SOURCES", 3))
+BOILERPLATE_MIN_CHARS = int(os.getenv("BOILERPLATE_MIN_CHARS", 40))
+# Estimated Jaccard similarity of the word 3-grams above which a chunk is a near-duplicate
+DEDUP_SIMILARITY_THRESHOLD = float(os.getenv("DEDUP_SIMILARITY_THRESHOLD", 0.85))
+
+# 16 bands of 4 rows: chunks with a similarity of 0.5 become candidates with a probability of 2/3, at 0.85 with 99.99%
+_BANDS = 16
+_ROWS = 4
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_rng = np.random.RandomState(42)
+_A = _rng.randint(1, 1 << 32, size=_BANDS * _ROWS).astype(np.uint64)
+_B = _rng.randint(0, 1 << 32, size=_BANDS * _ROWS).astype(np.uint64)
+_WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+_SPACE_PATTERN = re.compile(r"\s+")
+
+
+def _line_hash(line):
+    # Stable across processes (unlike hash()) and fits a signed SQLite integer
+    return int.from_bytes(hashlib.blake2b(line.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+def minhash(text):
+    # MinHash signature of the word 3-grams of a text (the words themselves for texts of less than 3 words)
+    words = _WORD_PATTERN.findall(text.lower())
+    shingles = {" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))}
+    hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "big")
+                       for shingle in shingles], dtype=np.uint64)
+    # Universal hashing a * x + b mod p, the uint64 products wrap around like in the usual MinHash implementations
+    with np.errstate(over="ignore"):
+        permuted = ((np.outer(hashes, _A) + _B) % _MERSENNE_PRIME) & _MAX_HASH
+    return permuted.min(axis=0)
+
+
+class DedupStore:
+    # SQLite tables of the boilerplate lines of each website / Confluence space and of the sources whose chunks were
+    # dropped as near-duplicates of a kept chunk
+
+    def __init__(self, path=DEDUP_STATE_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS boilerplate (scope TEXT, line_hash INTEGER, "
+                         "PRIMARY KEY (scope, line_hash))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS duplicates (scope TEXT, source TEXT, kept_source TEXT, "
+                         "kept_hash TEXT, PRIMARY KEY (scope, source, kept_hash))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS duplicates_kept ON duplicates (scope, kept_hash)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS duplicates_kept_source ON duplicates (scope, kept_source)")
+        self._db.commit()
+
+    def boilerplate_lines(self, scope):
+        with self._lock:
+            rows = self._db.execute("SELECT line_hash FROM boilerplate WHERE scope = ?", (scope,)).fetchall()
+        return {row[0] for row in rows}
+
+    def add_boilerplate_lines(self, scope, line_hashes):
+        with self._lock:
+            self._db.executemany("INSERT OR IGNORE INTO boilerplate VALUES (?, ?)",
+                                 [(scope, line_hash) for line_hash in line_hashes])
+            self._db.commit()
+
+    def boilerplate_scopes(self):
+        with self._lock:
+            rows = self._db.execute("SELECT scope, COUNT(*) FROM boilerplate GROUP BY scope ORDER BY scope").fetchall()
+        return dict(rows)
+
+    def reset_boilerplate(self, scope=None):
+        # Forget the learned boilerplate lines of a scope, or of all scopes. Returns the number of lines removed.
+        with self._lock:
+            if scope is None:
+                cursor = self._db.execute("DELETE FROM boilerplate")
+            else:
+                cursor = self._db.execute("DELETE FROM boilerplate WHERE scope = ?", (scope,))
+            self._db.commit()
+        return cursor.rowcount
+
+    def set_duplicates(self, scope, source, duplicates):
+        # Replace the duplicates recorded for a source by a list of (kept_source, kept_hash)
+        with self._lock:
+            self._db.execute("DELETE FROM duplicates WHERE scope = ? AND source = ?", (scope, source))
+            self._db.executemany("INSERT OR IGNORE INTO duplicates VALUES (?, ?, ?, ?)",
+                                 [(scope, source, kept_source, kept_hash) for kept_source, kept_hash in duplicates])
+            self._db.commit()
+
+    def dependent_sources(self, scope, kept_source):
+        # Sources with chunks that were dropped in favour of chunks of kept_source
+        with self._lock:
+            rows = self._db.execute("SELECT DISTINCT source FROM duplicates WHERE scope = ? AND kept_source = ? "
+                                    "AND source != kept_source", (scope, kept_source)).fetchall()
+        return [row[0] for row in rows]
+
+    def forget_source(self, scope, source):
+        with self._lock:
+            self._db.execute("DELETE FROM duplicates WHERE scope = ? AND source = ?", (scope, source))
+            self._db.commit()
+
+
+class ChunkDeduplicator:
+    # Deduplication state of one ingestion run into the index scope, boilerplate is learned per boilerplate_scope
+    # (a website or a Confluence space). Called by the split stage of the IngestionPipeline, and by its upload stage
+    # to hand over the chunks it uploads (see uploading).
+
+    def __init__(self, scope, boilerplate_scope=None, store=None, min_sources=BOILERPLATE_MIN_SOURCES,
+                 min_chars=BOILERPLATE_MIN_CHARS, threshold=DEDUP_SIMILARITY_THRESHOLD):
+        self.scope = scope
+        self.boilerplate_scope = boilerplate_scope or scope
+        self.store = store or get_dedup_store()
+        self.min_sources = min_sources
+        self.min_chars = min_chars
+        self.threshold = threshold
+        self._boilerplate = self.store.boilerplate_lines(self.boilerplate_scope)
+        # Number of sources each line was seen on in this run, until it becomes boilerplate
+        self._line_sources = {}
+        self._signatures = []
+        # (source, text hash, metadata) of the kept chunks, by position of their signature
+        self._kept = []
+        self._bands = [{} for _ in range(_BANDS)]
+        self._lock = threading.Lock()
+        # Positions of the kept chunks by id(chunk), and the keys of the kept chunks handed to the upload
+        self._positions = {}
+        self._keys = {}
+        # key -> metadata of uploaded chunks that got more duplicate sources after their upload
+        self._updates = {}
+        self.boilerplate_lines_removed = 0
+        self.boilerplate_chars_removed = 0
+        self.chunks_deduplicated = 0
+
+    def strip_boilerplate(self, document):
+        # Return the document without its boilerplate lines, the lines of this document count towards boilerplate
+        lines = document.page_content.split("\n")
+        hashes = [_line_hash(_SPACE_PATTERN.sub(" ", line).strip()) if line.strip() else None for line in lines]
+        new_lines = []
+        for line_hash in set(hashes) - self._boilerplate - {None}:
+            count = self._line_sources.get(line_hash, 0) + 1
+            if count >= self.min_sources:
+                self._line_sources.pop(line_hash, None)
+                self._boilerplate.add(line_hash)
+                new_lines.append(line_hash)
+            else:
+                self._line_sources[line_hash] = count
+        if new_lines:
+            self.store.add_boilerplate_lines(self.boilerplate_scope, new_lines)
+
+        def is_boilerplate(i):
+            return hashes[i] is not None and hashes[i] in self._boilerplate
+
+        kept = []
+        for i, line in enumerate(lines):
+            if is_boilerplate(i):
+                # A short line is only boilerplate next to other boilerplate, e.g. a navigation entry
+                neighbours = [j for j in (i - 1, i + 1) if 0 <= j < len(lines)]
+                if len(line.strip()) >= self.min_chars or any(is_boilerplate(j) for j in neighbours):
+                    self.boilerplate_lines_removed += 1
+                    self.boilerplate_chars_removed += len(line)
+                    continue
+            kept.append(line)
+        if len(kept) == len(lines):
+            return document
+        return Document(page_content="\n".join(kept), metadata=document.metadata)
+
+    def _find_duplicate(self, signature):
+        candidates = set()
+        for band, table in enumerate(self._bands):
+            candidates.update(table.get(signature[band * _ROWS:(band + 1) * _ROWS].tobytes(), ()))
+        for candidate in sorted(candidates):
+            if np.mean(self._signatures[candidate] == signature) >= self.threshold:
+                return candidate
+        return None
+
+    def filter_chunks(self, source, chunks):
+        # Return the chunks of a source that are not near-duplicates of chunks kept before. Chunks without any
+        # words are dropped as well.
+        kept, duplicates = [], []
+        for chunk in chunks:
+            if not _WORD_PATTERN.search(chunk.page_content):
+                self.chunks_deduplicated += 1
+                continue
+            signature = minhash(chunk.page_content)
+            duplicate = self._find_duplicate(signature)
+            if duplicate is not None:
+                self.chunks_deduplicated += 1
+                duplicates.append(self._kept[duplicate][:2])
+                self._add_duplicate_source(duplicate, chunk.metadata.get("source"))
+                continue
+            index = len(self._signatures)
+            self._signatures.append(signature)
+            with self._lock:
+                self._kept.append((source, text_hash(chunk.page_content), chunk.metadata))
+                self._positions[id(chunk)] = index
+            for band, table in enumerate(self._bands):
+                table.setdefault(signature[band * _ROWS:(band + 1) * _ROWS].tobytes(), []).append(index)
+            kept.append(chunk)
+        # The recorded duplicates of an earlier run of this source are outdated
+        self.store.set_duplicates(self.scope, source, duplicates)
+        return kept
+
+    def _add_duplicate_source(self, index, duplicate_source):
+        # Cite the source of a dropped chunk with the kept chunk. The metadata of a chunk that is being uploaded is
+        # not changed anymore, its update is collected for metadata_updates instead.
+        with self._lock:
+            key = self._keys.get(index)
+            metadata = self._updates.get(key, self._kept[index][2]) if key is not None else self._kept[index][2]
+            sources = metadata.get("duplicate_sources", [])
+            if not duplicate_source or duplicate_source == metadata.get("source") or duplicate_source in sources:
+                return
+            if key is None:
+                metadata["duplicate_sources"] = sources + [duplicate_source]
+            else:
+                self._updates[key] = dict(metadata, duplicate_sources=sources + [duplicate_source])
+
+    def uploading(self, chunks, keys):
+        # Called by the upload stage before it uploads chunks with these keys
+        with self._lock:
+            for chunk, key in zip(chunks, keys):
+                index = self._positions.pop(id(chunk), None)
+                if index is not None:
+                    self._keys[index] = key
+
+    def metadata_updates(self):
+        # (keys, metadatas) of the uploaded chunks whose duplicate sources changed after their upload
+        with self._lock:
+            return list(self._updates), list(self._updates.values())
+
+    def stats(self):
+        return {"chunks_deduplicated": self.chunks_deduplicated,
+                "boilerplate_lines_removed": self.boilerplate_lines_removed,
+                "boilerplate_chars_removed": self.boilerplate_chars_removed}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_dedup_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = DedupStore()
+        return _store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the learned boilerplate lines")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list-boilerplate", help="number of boilerplate lines per scope")
+    reset = commands.add_parser("reset-boilerplate", help="forget the boilerplate lines of a scope")
+    reset.add_argument("--scope", help="e.g. langchain-vector-demo|www.example.com, all scopes if omitted")
+    args = parser.parse_args()
+
+    store = get_dedup_store()
+    if args.command == "list-boilerplate":
+        for scope, count in store.boilerplate_scopes().items():
+            print(f"{scope}: {count} lines")
+    else:
+        print(f"Removed {store.reset_boilerplate(args.scope)} boilerplate lines")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import os
+import threading
+
+from embedding_cache import CachedEmbeddings, get_embedding_store, EMBEDDING_CACHE_ENABLED
+
+# Process-wide registry of the Azure clients. Streamlit re-executes the page scripts on every interaction, so
+# building the clients there means a new client object and a new TLS handshake per keystroke. The registry keeps one
+# instance per configuration alive for the lifetime of the process and shares it between all sessions. Each OpenAI
+# client keeps its own keep-alive connection pools (sync and async), so reusing the instance reuses the connections.
+# The client libraries are imported when the first client is created, see warmup.py to do that before the first
+# question.
+
+LLM_DEPLOYMENT = os.getenv("AZURE_OPENAI_LLM_DEPLOYMENT", "AskSenacor-gpt35turbo-v1")
+EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "AskSenacor-ada002-v1")
+OPENAI_API_VERSION = "2023-05-15"
+INDEX_NAME = "langchain-vector-demo"
+# Chat model backends, comma separated. "azure" is the Azure OpenAI deployment, any other name is an OpenAI-compatible
+# server (e.g. vLLM, see mistral.yaml) configured by LLM_BACKEND_<NAME>_BASE_URL, _MODEL and _API_KEY. With more than
+# one backend, each request is routed to one of them by llm_router.
+LLM_BACKENDS = [name.strip() for name in os.getenv("LLM_BACKENDS", "azure").split(",") if name.strip()]
+# Timeout of a routed request in seconds, before it fails over to the next backend
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 60))
+
+_lock = threading.RLock()
+_llms = {}
+_embeddings = {}
+_ingestion_embeddings = {}
+_vector_stores = {}
+_registered_llms = {}
+
+
+def _create_llm_backend(name, deployment, temperature, routed=False):
+    # Routed backends give up early and do not retry on their own, the router fails over to another backend instead
+    from langchain.chat_models import AzureChatOpenAI, ChatOpenAI
+    options = dict(request_timeout=LLM_REQUEST_TIMEOUT, max_retries=0) if routed else {}
+    if name == "azure":
+        return AzureChatOpenAI(
+            azure_deployment=deployment,
+            openai_api_version=OPENAI_API_VERSION,
+            temperature=temperature,
+            **options,
+        )
+    prefix = "LLM_BACKEND_" + name.upper() + "_"
+    if not os.getenv(prefix + "BASE_URL"):
+        raise ValueError(f"{prefix}BASE_URL is not set for the LLM backend {name!r}")
+    return ChatOpenAI(
+        openai_api_base=os.getenv(prefix + "BASE_URL"),
+        openai_api_key=os.getenv(prefix + "API_KEY", "EMPTY"),
+        model_name=os.getenv(prefix + "MODEL", "mistralai/Mistral-7B-Instruct-v0.2"),
+        temperature=temperature,
+        **options,
+    )
+
+
+def get_llm(deployment=LLM_DEPLOYMENT, temperature=0.7, backends=None):
+    # Return the chat model for the given deployment and temperature, creating it on first use. With several
+    # backends the model routes each request to one of them.
+    backends = tuple(backends or LLM_BACKENDS)
+    key = (deployment, float(temperature), backends)
+    with _lock:
+        if deployment in _registered_llms:
+            return _registered_llms[deployment]
+        if key not in _llms:
+            if len(backends) == 1:
+                _llms[key] = _create_llm_backend(backends[0], deployment, temperature)
+            else:
+                from llm_router import RoutedChatModel, get_llm_router
+                _llms[key] = RoutedChatModel(backends={name: _create_llm_backend(name, deployment, temperature, True)
+                                                       for name in backends}, router=get_llm_router())
+        return _llms[key]
+
+
+def _get_azure_embeddings(deployment):
+    key = ("azure", deployment)
+    with _lock:
+        if key not in _embeddings:
+            from langchain.embeddings import AzureOpenAIEmbeddings
+            _embeddings[key] = AzureOpenAIEmbeddings(
+                azure_deployment=deployment,
+                openai_api_version=OPENAI_API_VERSION,
+            )
+        return _embeddings[key]
+
+
+def get_embeddings(deployment=EMBEDDING_DEPLOYMENT):
+    # Return the embeddings model for the given deployment, creating it on first use. Unless disabled, the model is
+    # wrapped by the persistent embedding cache, so unchanged texts are never sent to the API twice.
+    with _lock:
+        if deployment not in _embeddings:
+            embeddings = _get_azure_embeddings(deployment)
+            if EMBEDDING_CACHE_ENABLED:
+                embeddings = CachedEmbeddings(embeddings, model=deployment, store=get_embedding_store())
+            _embeddings[deployment] = embeddings
+        return _embeddings[deployment]
+
+
+def get_ingestion_embeddings(deployment=EMBEDDING_DEPLOYMENT):
+    # Embeddings for bulk ingestion: cache misses go through the rate-limit-aware scheduler. There is one scheduler
+    # per deployment, so concurrent ingestions share the same tokens-per-minute budget.
+    with _lock:
+        if deployment not in _ingestion_embeddings:
+            from embedding_scheduler import EmbeddingScheduler
+            embeddings = EmbeddingScheduler(_get_azure_embeddings(deployment))
+            if EMBEDDING_CACHE_ENABLED:
+                embeddings = CachedEmbeddings(embeddings, model=deployment, store=get_embedding_store())
+            _ingestion_embeddings[deployment] = embeddings
+        return _ingestion_embeddings[deployment]
+
+
+def get_embedding_scheduler(deployment=EMBEDDING_DEPLOYMENT):
+    embeddings = get_ingestion_embeddings(deployment)
+    return embeddings.embeddings if isinstance(embeddings, CachedEmbeddings) else embeddings
+
+
+def get_vector_store(index_name=INDEX_NAME, embedding_deployment=EMBEDDING_DEPLOYMENT):
+    # Return the vector store for the given index, the search client keeps its own pooled session
+    # imported here, because vector_storage itself uses the registry for the ingestion clients
+    from vector_storage import init_vector_store
+    key = (index_name, embedding_deployment)
+    with _lock:
+        if key not in _vector_stores:
+            _vector_stores[key] = init_vector_store(embeddings=get_embeddings(embedding_deployment),
+                                                    index_name=index_name)
+        return _vector_stores[key]
+
+
+def register_clients(deployment=LLM_DEPLOYMENT, llm=None, embedding_deployment=EMBEDDING_DEPLOYMENT,
+                     embeddings=None, ingestion_embeddings=None):
+    # Use the given clients instead of the Azure ones, e.g. the offline stand-ins of the benchmarks. A registered
+    # LLM serves all temperatures of its deployment.
+    with _lock:
+        if llm is not None:
+            _registered_llms[deployment] = llm
+        if embeddings is not None:
+            _embeddings[embedding_deployment] = embeddings
+        if ingestion_embeddings is not None:
+            _ingestion_embeddings[embedding_deployment] = ingestion_embeddings
+
+
+def clear_registry():
+    # Drop all cached clients, e.g. after the credentials in the environment have changed
+    with _lock:
+        _llms.clear()
+        _embeddings.clear()
+        _ingestion_embeddings.clear()
+        _vector_stores.clear()
+        _registered_llms.clear()
@@ -0,0 +1,275 @@
+import io
+import multiprocessing
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+# Parallel loading of Confluence spaces for add_confluence_to_vector_store. The ConfluenceLoader fetches pages, their
+# restrictions and attachments one after the other, and parses every attachment (OCR of PDFs and images, Office
+# documents) in the calling thread. Here the REST calls run in a thread pool on a connection pool of the same size,
+# attachments are parsed in a process pool on all cores, and the parsed text is cached by attachment id and version,
+# so unchanged attachments are neither downloaded nor parsed again.
+
+CONFLUENCE_FETCH_WORKERS = int(os.getenv("CONFLUENCE_FETCH_WORKERS", 8))
+CONFLUENCE_PARSE_PROCESSES = int(os.getenv("CONFLUENCE_PARSE_PROCESSES", os.cpu_count() or 1))
+ATTACHMENT_CACHE_PATH = os.getenv("ATTACHMENT_CACHE_PATH", os.path.join(".cache", "attachments.sqlite"))
+
+_PDF = "application/pdf"
+_IMAGES = ("image/png", "image/jpg", "image/jpeg")
+_DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+_XLS = "application/vnd.ms-excel"
+_SVG = "image/svg+xml"
+# Attachment types the ConfluenceLoader extracts text from, all others are skipped
+PARSED_MEDIA_TYPES = (_PDF, _DOCX, _XLS, _SVG) + _IMAGES
+
+
+def is_not_found(error):
+    # True for the 404 of a deleted page, atlassian-python-api wraps it into an ApiError with the HTTPError as reason
+    while isinstance(error, Exception):
+        response = getattr(error, "response", None)
+        if response is not None and getattr(response, "status_code", None) == 404:
+            return True
+        error = getattr(error, "reason", None)
+    return False
+
+
+def get_page_version(confluence, page_id, call=lambda function, **kwargs: function(**kwargs)):
+    # (version, last_modified) of a page, None if it was deleted or moved to the trash
+    try:
+        page = call(confluence.get_page_by_id, page_id=page_id, expand="version")
+    except Exception as e:
+        if is_not_found(e):
+            return None
+        raise
+    if page.get("status", "current") != "current":
+        return None
+    return page["version"]["number"], page["version"]["when"]
+
+
+def extract_attachment_text(media_type, link, content, ocr_languages=None):
+    # Text of a downloaded attachment, the same extraction as the ConfluenceLoader. Runs in the parse processes, so
+    # the libraries are imported here.
+    if media_type == _PDF:
+        import pytesseract
+        from pdf2image import convert_from_bytes
+        try:
+            images = convert_from_bytes(content)
+        except ValueError:
+            return ""
+        return "".join(f"Page {i + 1}:\n{pytesseract.image_to_string(image, lang=ocr_languages)}\n\n"
+                       for i, image in enumerate(images))
+    if media_type in _IMAGES:
+        import pytesseract
+        from PIL import Image
+        try:
+            image = Image.open(io.BytesIO(content))
+        except OSError:
+            return ""
+        return pytesseract.image_to_string(image, lang=ocr_languages)
+    if media_type == _DOCX:
+        import docx2txt
+        return docx2txt.process(io.BytesIO(content))
+    if media_type == _XLS:
+        # The extension is followed by the query of the download link, e.g. ".csv?version=2&api=v2"
+        if os.path.splitext(os.path.basename(link))[1].startswith(".csv"):
+            import pandas as pd
+            return pd.read_csv(io.StringIO(content.decode("utf-8"))).to_string(index=False, header=False) + "\n\n"
+        import xlrd
+        text = ""
+        for sheet in xlrd.open_workbook(file_contents=content).sheets():
+            text += f"{sheet.name}:\n"
+            for row in range(sheet.nrows):
+                text += "".join(f"{sheet.cell_value(row, col)}\t" for col in range(sheet.ncols)) + "\n"
+            text += "\n"
+        return text
+    if media_type == _SVG:
+        import pytesseract
+        from PIL import Image
+        from reportlab.graphics import renderPM
+        from svglib.svglib import svg2rlg
+        image_data = io.BytesIO()
+        renderPM.drawToFile(svg2rlg(io.BytesIO(content)), image_data, fmt="PNG")
+        image_data.seek(0)
+        return pytesseract.image_to_string(Image.open(image_data), lang=ocr_languages)
+    return ""
+
+
+class AttachmentTextCache:
+    # SQLite table of the parsed text of attachments, keyed by attachment id and version
+
+    def __init__(self, path=ATTACHMENT_CACHE_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS attachments (attachment_id TEXT, version INTEGER, text TEXT, "
+                         "PRIMARY KEY (attachment_id, version))")
+        self._db.commit()
+
+    def get(self, attachment_id, version):
+        with self._lock:
+            row = self._db.execute("SELECT text FROM attachments WHERE attachment_id = ? AND version = ?",
+                                   (attachment_id, version)).fetchone()
+        return row[0] if row else None
+
+    def put(self, attachment_id, version, text):
+        # Older versions of the attachment are not needed anymore
+        with self._lock:
+            self._db.execute("DELETE FROM attachments WHERE attachment_id = ? AND version != ?",
+                             (attachment_id, version))
+            self._db.execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?)", (attachment_id, version, text))
+            self._db.commit()
+
+
+class ParallelConfluenceLoader:
+    # Wraps a ConfluenceLoader, its client, base url and page processing are used as they are
+
+    def __init__(self, loader, workers=CONFLUENCE_FETCH_WORKERS, parse_processes=CONFLUENCE_PARSE_PROCESSES,
+                 cache=None):
+        self.loader = loader
+        self.confluence = loader.confluence
+        self.workers = workers
+        self.parse_processes = parse_processes
+        self.cache = cache
+        self.attachments_parsed = 0
+        self.attachments_cached = 0
+        # Keep a connection per worker alive, requests' default pool holds 10 connections per host
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session = getattr(self.confluence, "_session", None)
+        if session is not None:
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        # A missing page or attachment does not come back by retrying
+        self._retry = retry(reraise=True, stop=stop_after_attempt(loader.number_of_retries),
+                            wait=wait_exponential(multiplier=1, min=loader.min_retry_seconds,
+                                                  max=loader.max_retry_seconds),
+                            retry=retry_if_exception(lambda e: not is_not_found(e)))
+
+    def list_pages(self, space_key=None, page_ids=None, limit=50):
+        # Return page_id -> (version, last_modified). The listing of a space is requested workers batches at a time.
+        # Configured page ids that no longer exist are left out, so their chunks are removed.
+        pages = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            if space_key:
+                start, complete = 0, False
+                while not complete:
+                    starts = [start + i * limit for i in range(self.workers)]
+                    batches = executor.map(lambda offset: self._retry(self.confluence.get_all_pages_from_space)(
+                        space=space_key, start=offset, limit=limit, status="current", expand="version"), starts)
+                    for batch in batches:
+                        for page in batch:
+                            pages[page["id"]] = (page["version"]["number"], page["version"]["when"])
+                        complete = complete or len(batch) < limit
+                    start += self.workers * limit
+            else:
+                versions = executor.map(lambda page_id: get_page_version(
+                    self.confluence, page_id, lambda function, **kwargs: self._retry(function)(**kwargs)), page_ids)
+                for page_id, version in zip(page_ids, versions):
+                    if version is not None:
+                        pages[page_id] = version
+        return pages
+
+    def _attachments(self, page_id):
+        attachments, start = [], 0
+        while True:
+            batch = self._retry(self.confluence.get_attachments_from_content)(
+                page_id, start=start, limit=50, expand="version")["results"]
+            attachments += batch
+            if len(batch) < 50:
+                return attachments
+            start += 50
+
+    def _attachment_text(self, attachment, parser, ocr_languages):
+        # Title plus the parsed text, from the cache if this version was parsed before. None for skipped attachments.
+        media_type = attachment["metadata"]["mediaType"]
+        if media_type not in PARSED_MEDIA_TYPES:
+            return None
+        version = attachment.get("version", {}).get("number", 0)
+        text = self.cache.get(attachment["id"], version) if self.cache is not None else None
+        if text is not None:
+            self.attachments_cached += 1
+            return attachment["title"] + text
+        link = self.loader.base_url + attachment["_links"]["download"]
+        try:
+            response = self.confluence.request(path=link, absolute=True)
+        except requests.HTTPError as e:
+            if e.response.status_code == 404:
+                print(f"Attachment not found at {link}")
+                return None
+            raise
+        if response.status_code != 200 or not response.content:
+            text = ""
+        else:
+            text = parser().submit(extract_attachment_text, media_type, link, response.content, ocr_languages).result()
+        self.attachments_parsed += 1
+        if self.cache is not None:
+            self.cache.put(attachment["id"], version, text)
+        return attachment["title"] + text
+
+    def _load_page(self, page_id, include_attachments, include_restricted_content, content_format, ocr_languages,
+                   parser):
+        page = self._retry(self.confluence.get_page_by_id)(page_id=page_id, expand=f"{content_format.value},version")
+        if not include_restricted_content and not self.loader.is_public_page(page):
+            return None
+        document = self.loader.process_page(page, False, False, content_format)
+        if include_attachments:
+            texts = [self._attachment_text(attachment, parser, ocr_languages)
+                     for attachment in self._attachments(page_id)]
+            document.page_content += "".join(text for text in texts if text is not None)
+        return document
+
+    def lazy_load(self, page_ids, include_attachments=False, include_restricted_content=False,
+                  content_format=None, ocr_languages=None, **kwargs):
+        # Yields the documents of the pages as they are completed (not in the order of page_ids). The process pool
+        # is only started for the first attachment that has to be parsed.
+        from langchain.document_loaders.confluence import ContentFormat
+        content_format = content_format or ContentFormat.STORAGE
+        pool, pool_lock = [], threading.Lock()
+
+        def parser():
+            with pool_lock:
+                if not pool:
+                    # Spawned, forking the threads of a running Streamlit server is not safe
+                    pool.append(ProcessPoolExecutor(max_workers=self.parse_processes,
+                                                    mp_context=multiprocessing.get_context("spawn")))
+                return pool[0]
+
+        page_ids = iter(page_ids)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                running = set()
+                while True:
+                    for page_id in page_ids:
+                        running.add(executor.submit(self._load_page, page_id, include_attachments,
+                                                    include_restricted_content, content_format, ocr_languages,
+                                                    parser))
+                        if len(running) >= 2 * self.workers:
+                            break
+                    if not running:
+                        return
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        document = future.result()
+                        if document is not None:
+                            yield document
+        finally:
+            if pool:
+                pool[0].shutdown(cancel_futures=True)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_attachment_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AttachmentTextCache()
+        return _cache
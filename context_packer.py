@@ -0,0 +1,145 @@
+import os
+import re
+import threading
+from collections import Counter
+
+import tiktoken
+from langchain.docstore.document import Document
+
+# Context packing between retrieval and the "stuff" chain. The splitters produce chunks that repeat their overlap
+# with the neighbouring chunk, and neighbouring chunks of the same page are often retrieved together. The packer
+# merges such chunks and removes the overlap, drops near-duplicates, orders the rest by maximal marginal relevance
+# and fills a token budget, truncating the last segment at a sentence boundary.
+
+CONTEXT_PACKING_ENABLED = os.getenv("CONTEXT_PACKING_ENABLED", "true").lower() == "true"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1200))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", 0.7))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", 0.9))
+
+# Shortest overlap that is treated as the splitter overlap, and the smallest rest of the budget worth truncating into
+_MIN_OVERLAP = 10
+_MIN_TRUNCATED_TOKENS = 30
+_WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+_SENTENCE_END_PATTERN = re.compile(r"[.!?\n](?=\s|$)")
+
+
+def _overlap(left, right):
+    # Length of the longest suffix of left that is a prefix of right
+    for length in range(min(len(left), len(right)), _MIN_OVERLAP - 1, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+
+def _cosine(a, b):
+    if not a or not b:
+        return 0.0
+    dot = sum(count * b.get(word, 0) for word, count in a.items())
+    norm_a = sum(count * count for count in a.values()) ** 0.5
+    norm_b = sum(count * count for count in b.values()) ** 0.5
+    return dot / (norm_a * norm_b)
+
+
+class ContextPacker:
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, mmr_lambda=CONTEXT_MMR_LAMBDA,
+                 duplicate_threshold=CONTEXT_DUPLICATE_THRESHOLD):
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        self.duplicate_threshold = duplicate_threshold
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self._lock = threading.Lock()
+        # Statistics of the last query packed by the current thread, and totals over all queries
+        self._local = threading.local()
+        self.totals = {"queries": 0, "tokens_in": 0, "tokens_out": 0, "tokens_saved": 0}
+
+    @property
+    def last_stats(self):
+        return getattr(self._local, "stats", None)
+
+    def reset_stats(self):
+        self._local.stats = None
+
+    def count_tokens(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    @staticmethod
+    def merge_adjacent(documents):
+        # Merge chunks of the same source that overlap (in either order), and drop chunks contained in another one.
+        # Returns segments as [text, metadata, best rank] in the order of their best ranked chunk.
+        segments = []
+        for rank, doc in enumerate(documents):
+            text, source = doc.page_content, doc.metadata.get("source")
+            for segment in segments:
+                if segment[1].get("source") != source:
+                    continue
+                if text in segment[0]:
+                    break
+                if segment[0] in text:
+                    segment[0] = text
+                    break
+                overlap = _overlap(segment[0], text)
+                if overlap:
+                    segment[0] = segment[0] + text[overlap:]
+                    break
+                overlap = _overlap(text, segment[0])
+                if overlap:
+                    segment[0] = text + segment[0][overlap:]
+                    break
+            else:
+                segments.append([text, dict(doc.metadata), rank])
+        return segments
+
+    def select_mmr(self, segments):
+        # Order the segments by maximal marginal relevance: relevance from the retrieval rank, redundancy as the
+        # word vector cosine to the segments already selected. Near-duplicates are dropped.
+        vectors = [Counter(_WORD_PATTERN.findall(text.lower())) for text, _, _ in segments]
+        relevance = [1.0 - rank / max(len(segments), 1) for _, _, rank in segments]
+        remaining = list(range(len(segments)))
+        selected = []
+        while remaining:
+            best, best_score, best_similarity = None, None, 0.0
+            for i in remaining:
+                similarity = max((_cosine(vectors[i], vectors[j]) for j in selected), default=0.0)
+                score = self.mmr_lambda * relevance[i] - (1 - self.mmr_lambda) * similarity
+                if best_score is None or score > best_score:
+                    best, best_score, best_similarity = i, score, similarity
+            remaining.remove(best)
+            if best_similarity < self.duplicate_threshold:
+                selected.append(best)
+        return [segments[i] for i in selected]
+
+    def truncate(self, text, max_tokens):
+        # Cut the text to max_tokens, at the last sentence end that fits
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        truncated = self.encoding.decode(tokens[:max_tokens])
+        sentence_ends = [match.end() for match in _SENTENCE_END_PATTERN.finditer(truncated)]
+        return truncated[:sentence_ends[-1]] if sentence_ends else ""
+
+    def pack(self, documents):
+        # Returns the packed documents and the token statistics of this query
+        tokens_in = sum(self.count_tokens(doc.page_content) for doc in documents)
+        packed, budget = [], self.token_budget
+        for text, metadata, _ in self.select_mmr(self.merge_adjacent(documents)):
+            tokens = self.count_tokens(text)
+            if tokens > budget:
+                if budget < _MIN_TRUNCATED_TOKENS:
+                    continue
+                text = self.truncate(text, budget)
+                tokens = self.count_tokens(text)
+                if not text:
+                    continue
+            packed.append(Document(page_content=text, metadata=metadata))
+            budget -= tokens
+        tokens_out = self.token_budget - budget
+        stats = {"tokens_in": tokens_in, "tokens_out": tokens_out, "tokens_saved": tokens_in - tokens_out,
+                 "chunks_in": len(documents), "chunks_out": len(packed)}
+        with self._lock:
+            self.totals["queries"] += 1
+            self.totals["tokens_in"] += tokens_in
+            self.totals["tokens_out"] += tokens_out
+            self.totals["tokens_saved"] += tokens_in - tokens_out
+        self._local.stats = stats
+        return packed, stats
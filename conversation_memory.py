@@ -0,0 +1,118 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import tiktoken
+
+# Bounded chat history for the condense step. The last turns are passed verbatim, older turns are folded into a
+# rolling summary. Summaries are cached by the content of the turns they cover, so each new turn only folds the turns
+# since the last summary, and the folding runs in the background after the answer instead of before the next one.
+# The rendered history never exceeds a hard token ceiling, no matter how long the conversation gets.
+
+CHAT_MEMORY_TURNS = int(os.getenv("CHAT_MEMORY_TURNS", 4))
+CHAT_MEMORY_MAX_TOKENS = int(os.getenv("CHAT_MEMORY_MAX_TOKENS", 1500))
+CHAT_MEMORY_CACHE_SIZE = int(os.getenv("CHAT_MEMORY_CACHE_SIZE", 1000))
+
+
+def _format_turns(turns):
+    # Same format the ConversationalRetrievalChain uses for (question, answer) tuples
+    return "".join(f"\nHuman: {human}\nAssistant: {ai}" for human, ai in turns)
+
+
+def _prefix_keys(turns):
+    # keys[i] identifies the first i turns, each key is derived from the previous one
+    keys = [""]
+    for human, ai in turns:
+        keys.append(hashlib.sha256((keys[-1] + "\0" + human + "\0" + ai).encode("utf-8")).hexdigest())
+    return keys
+
+
+class ConversationMemory:
+    # Shared by all sessions of an LLMHelper, the conversations themselves stay in the session state
+
+    def __init__(self, llm, max_turns=CHAT_MEMORY_TURNS, max_tokens=CHAT_MEMORY_MAX_TOKENS,
+                 cache_size=CHAT_MEMORY_CACHE_SIZE):
+        # Imported here, langchain.chains is slow to import (see startup_profile.py)
+        from langchain.chains.llm import LLMChain
+        from langchain.memory.prompt import SUMMARY_PROMPT
+        self.summary_chain = LLMChain(llm=llm, prompt=SUMMARY_PROMPT, verbose=False)
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.cache_size = cache_size
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self._summaries = OrderedDict()
+        self._folding = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def count_tokens(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def _cached_summary(self, keys, end):
+        # Latest cached summary that covers at most the first `end` turns, returns (number of turns, summary)
+        with self._lock:
+            for i in range(end, 0, -1):
+                if keys[i] in self._summaries:
+                    self._summaries.move_to_end(keys[i])
+                    return i, self._summaries[keys[i]]
+        return 0, ""
+
+    def _fold(self, turns, keys, end):
+        # Extend the latest cached summary by the turns up to `end`, one LLM call per update
+        try:
+            start, summary = self._cached_summary(keys, end)
+            if start < end:
+                summary = self.summary_chain.run(summary=summary, new_lines=_format_turns(turns[start:end]).strip())
+                with self._lock:
+                    self._summaries[keys[end]] = summary
+                    while len(self._summaries) > self.cache_size:
+                        self._summaries.popitem(last=False)
+        finally:
+            with self._lock:
+                self._folding.discard(keys[end])
+
+    def update(self, chat_history):
+        # Schedule folding the turns that fell out of the verbatim window, returns immediately
+        end = len(chat_history) - self.max_turns
+        if end <= 0:
+            return
+        keys = _prefix_keys(chat_history)
+        with self._lock:
+            if keys[end] in self._summaries or keys[end] in self._folding:
+                return
+            self._folding.add(keys[end])
+        self._executor.submit(self._fold, list(chat_history), keys, end)
+
+    def _truncate(self, text, max_tokens, keep_end=False):
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoding.decode(tokens[-max_tokens:] if keep_end else tokens[:max_tokens])
+
+    def format(self, chat_history):
+        # The chat history as passed to the condense prompt: rolling summary plus the recent turns, at most
+        # max_tokens tokens. Turns not yet covered by a summary are kept verbatim as long as they fit.
+        self.update(chat_history)
+        keys = _prefix_keys(chat_history)
+        start, summary = self._cached_summary(keys, max(len(chat_history) - self.max_turns, 0))
+        # Newest turns first, so the oldest ones are dropped when the budget is exhausted
+        budget, recent = self.max_tokens, []
+        for turn in reversed(chat_history[start:]):
+            text = _format_turns([turn])
+            tokens = self.count_tokens(text)
+            if tokens > budget:
+                if not recent:
+                    # Even the last turn alone is too long, keep its end
+                    recent.append(self._truncate(text, budget, keep_end=True))
+                    budget = 0
+                break
+            recent.append(text)
+            budget -= tokens
+        prefix = "\nSummary of the earlier conversation: "
+        if summary and budget > self.count_tokens(prefix):
+            summary = prefix + self._truncate(summary, budget - self.count_tokens(prefix))
+        else:
+            summary = ""
+        return summary + "".join(reversed(recent))
@@ -14,6 +14,15 @@ Answer:"""
 
 PROMPT = PromptTemplate(template=template, input_variables=["summaries", "question"])
 
+# The same prompt, the answer ends with follow-up questions the user might ask next (see followup_prefetch.py)
+followup_template = template.replace("\n\nQuestion: {question}", """
+After the answer and before any list of sources, propose up to three short follow-up questions the user might ask \
+next, each in double angle brackets, e.g. <<Who leads the project?>>.
+
+Question: {question}""")
+
+FOLLOWUP_PROMPT = PromptTemplate(template=followup_template, input_variables=["summaries", "question"])
+
 EXAMPLE_PROMPT = PromptTemplate(
     template="Content: {page_content}\nSource: {source}",
     input_variables=["page_content", "source"],
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+from tracing import annotate
+
+# Persistent embedding cache: vectors are stored in SQLite under (model deployment, sha256 of the text). Unchanged
+# chunks are therefore never embedded twice, and repeated questions do not need a call to the embeddings API.
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(".cache", "embeddings.sqlite"))
+
+# SQLite limits the number of parameters of a single statement
+_LOOKUP_BATCH_SIZE = 500
+
+
+class EmbeddingStore:
+    # Thread-safe SQLite table of float32 vectors keyed by (model, text hash)
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash TEXT, vector BLOB, "
+                         "PRIMARY KEY (model, hash))")
+        self._db.commit()
+
+    def get_many(self, model, hashes):
+        # Return a dict hash -> vector for all hashes that are present
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), _LOOKUP_BATCH_SIZE):
+                batch = hashes[start:start + _LOOKUP_BATCH_SIZE]
+                rows = self._db.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [model] + batch).fetchall()
+                for text_hash, vector in rows:
+                    found[text_hash] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model, items):
+        # Store (hash, vector) pairs, existing entries are replaced
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                                 [(model, text_hash, np.asarray(vector, dtype=np.float32).tobytes())
+                                  for text_hash, vector in items])
+            self._db.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    # Wraps an embeddings model (e.g. AzureOpenAIEmbeddings) and only sends texts to it that are not cached yet
+
+    def __init__(self, embeddings, model, store):
+        self.embeddings = embeddings
+        self.model = model
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts):
+        hashes = [self.text_hash(text) for text in texts]
+        vectors = self.store.get_many(self.model, list(set(hashes)))
+        # Embed every missing text only once, even if it occurs several times in the batch
+        missing = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in vectors and text_hash not in missing:
+                missing[text_hash] = text
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), new_vectors))
+            self.store.put_many(self.model, new_items)
+            vectors.update(new_items)
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        return [vectors[text_hash] for text_hash in hashes]
+
+    def embed_query(self, text):
+        text_hash = self.text_hash(text)
+        vector = self.store.get_many(self.model, [text_hash]).get(text_hash)
+        if vector is None:
+            self.misses += 1
+            annotate(embedding_cache_hit=False)
+            vector = self.embeddings.embed_query(text)
+            self.store.put_many(self.model, [(text_hash, vector)])
+        else:
+            self.hits += 1
+            annotate(embedding_cache_hit=True)
+        return vector
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_embedding_store():
+    # One SQLite connection per process, shared by all cached embeddings models
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = EmbeddingStore()
+        return _store
@@ -0,0 +1,203 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import tiktoken
+from langchain.schema.embeddings import Embeddings
+
+# Rate-limit-aware embedding scheduler for the ingestion. Chunks are packed into requests by token count, requests
+# are only sent while the tokens-per-minute and requests-per-minute budgets of the deployment allow it, and the batch
+# size and concurrency adapt to the rate limit headers and 429 responses of Azure OpenAI. Failed batches are retried
+# on their own with jittered exponential backoff instead of failing the whole ingestion.
+
+EMBEDDING_TPM_LIMIT = int(os.getenv("EMBEDDING_TPM_LIMIT", 240000))
+EMBEDDING_RPM_LIMIT = int(os.getenv("EMBEDDING_RPM_LIMIT", 1440))
+EMBEDDING_MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", 8000))
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", 16))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 4))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", 6))
+
+_RETRIED_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                   openai.InternalServerError)
+
+
+class RateBudget:
+    # Sliding one minute window over the sent requests and tokens
+
+    def __init__(self, tokens_per_minute, requests_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self._sent = deque()
+        self._tokens = 0
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def block_for(self, seconds):
+        # Called on a 429: nothing is sent until the retry-after time has passed
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def _try_book(self, tokens):
+        # Book the request if it fits into the budget of the last minute, otherwise return the seconds to wait
+        with self._lock:
+            now = time.monotonic()
+            while self._sent and now - self._sent[0][0] >= 60:
+                self._tokens -= self._sent.popleft()[1]
+            if now >= self._blocked_until and len(self._sent) < self.requests_per_minute and \
+                    self._tokens + tokens <= self.tokens_per_minute:
+                self._sent.append((now, tokens))
+                self._tokens += tokens
+                return None
+            return max(self._blocked_until - now, 60 - (now - self._sent[0][0]) if self._sent else 0.1)
+
+    def acquire(self, tokens):
+        # Wait until the request fits into the budget of the last minute, then book it
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            wait = self._try_book(tokens)
+            if wait is None:
+                return
+            time.sleep(min(max(wait, 0.05), 5))
+
+    def try_acquire(self, tokens):
+        # Book the request only if it fits into the budget right now, e.g. for work that can be skipped
+        return self._try_book(min(tokens, self.tokens_per_minute)) is None
+
+
+class EmbeddingScheduler(Embeddings):
+    # Wraps AzureOpenAIEmbeddings for bulk embedding, queries are passed through unchanged
+
+    def __init__(self, embeddings, tokens_per_minute=EMBEDDING_TPM_LIMIT, requests_per_minute=EMBEDDING_RPM_LIMIT,
+                 max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS, max_batch_size=EMBEDDING_MAX_BATCH_SIZE,
+                 max_concurrency=EMBEDDING_MAX_CONCURRENCY, max_retries=EMBEDDING_MAX_RETRIES):
+        self.embeddings = embeddings
+        self.budget = RateBudget(tokens_per_minute, requests_per_minute)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+        # Adaptive limits, start at the configured maximum and back off on rate limiting
+        self.batch_tokens = max_batch_tokens
+        self.concurrency = max_concurrency
+        self._active = 0
+        self._slots = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "chunks": 0, "tokens": 0, "retries": 0, "rate_limited": 0}
+        self._started = None
+
+    def count_tokens(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def pack_batches(self, texts):
+        # Group consecutive texts into batches below the current token and size limit, returns (indices, tokens)
+        batches, indices, tokens = [], [], 0
+        for i, text in enumerate(texts):
+            text_tokens = self.count_tokens(text)
+            if indices and (tokens + text_tokens > self.batch_tokens or len(indices) >= self.max_batch_size):
+                batches.append((indices, tokens))
+                indices, tokens = [], 0
+            indices.append(i)
+            tokens += text_tokens
+        if indices:
+            batches.append((indices, tokens))
+        return batches
+
+    def _request(self, texts):
+        # Send one embeddings request, returns the vectors and the response headers (if the client exposes them)
+        client = self.embeddings.client
+        if hasattr(client, "with_raw_response"):
+            raw = client.with_raw_response.create(input=texts, model=self.embeddings.model)
+            data = sorted(raw.parse().data, key=lambda d: d.index)
+            return [d.embedding for d in data], raw.headers
+        return self.embeddings.embed_documents(texts), {}
+
+    def _adapt(self, headers, tokens):
+        # Use the remaining quota reported by Azure OpenAI to grow or shrink the concurrency and batch size
+        remaining = headers.get("x-ratelimit-remaining-tokens")
+        with self._slots:
+            if remaining is not None and int(remaining) < tokens * self.concurrency:
+                self.concurrency = max(1, self.concurrency - 1)
+            elif self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+            self.batch_tokens = min(self.max_batch_tokens, int(self.batch_tokens * 1.1) + 1)
+            self._slots.notify_all()
+
+    def _back_off(self, error, attempt):
+        # Halve concurrency and batch size and honour retry-after, otherwise exponential backoff with full jitter
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after-ms")
+            retry_after = float(retry_after) / 1000 if retry_after else response.headers.get("retry-after")
+        if isinstance(error, openai.RateLimitError):
+            with self._slots:
+                self.concurrency = max(1, self.concurrency // 2)
+                self.batch_tokens = max(1, self.batch_tokens // 2)
+            with self._stats_lock:
+                self._stats["rate_limited"] += 1
+        try:
+            delay = float(retry_after) + random.uniform(0, 1)
+        except (TypeError, ValueError):
+            delay = random.uniform(0, min(60, 2 ** attempt))
+        self.budget.block_for(delay)
+        return delay
+
+    def _embed_batch(self, texts, tokens):
+        for attempt in range(self.max_retries + 1):
+            with self._slots:
+                while self._active >= self.concurrency:
+                    self._slots.wait()
+                self._active += 1
+            try:
+                self.budget.acquire(tokens)
+                vectors, headers = self._request(texts)
+            except _RETRIED_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                # The budget is blocked for the backoff delay, so the next attempt waits in acquire()
+                self._back_off(e, attempt)
+                with self._stats_lock:
+                    self._stats["retries"] += 1
+                continue
+            finally:
+                with self._slots:
+                    self._active -= 1
+                    self._slots.notify_all()
+            self._adapt(headers, tokens)
+            with self._stats_lock:
+                self._stats["requests"] += 1
+                self._stats["chunks"] += len(texts)
+                self._stats["tokens"] += tokens
+            return vectors
+
+    def embed_documents(self, texts):
+        if self._started is None:
+            self._started = time.monotonic()
+        vectors = [None] * len(texts)
+        futures = []
+        for indices, tokens in self.pack_batches(texts):
+            futures.append((indices, self._executor.submit(self._embed_batch, [texts[i] for i in indices], tokens)))
+        for indices, future in futures:
+            for i, vector in zip(indices, future.result()):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    def stats(self):
+        # Counters since the first request, including the throughput in chunks and tokens per second
+        with self._stats_lock:
+            stats = dict(self._stats)
+        elapsed = time.monotonic() - self._started if self._started else 0
+        stats["concurrency"] = self.concurrency
+        stats["batch_tokens"] = self.batch_tokens
+        stats["chunks_per_second"] = stats["chunks"] / elapsed if elapsed else 0.0
+        stats["tokens_per_second"] = stats["tokens"] / elapsed if elapsed else 0.0
+        return stats
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from batch_runner import question_key, llm_tokens
+from tracing import trace, get_metrics
+
+# Speculative work for the follow-up questions proposed with an answer (opt-in). While the user reads the answer, the
+# questions are condensed and retrieved in the background ("retrieve"), or answered completely ("answer"). Clicking
+# a proposed question then only generates the answer, or returns it right away.
+# - The work runs on a small process-wide thread pool and is booked on a tokens- and requests-per-minute budget that
+#   is separate from the interactive questions. Work that does not fit into the budget is skipped, not queued.
+# - The results are kept per session for FOLLOWUP_PREFETCH_TTL_SECONDS. A new answer or a question that was not
+#   proposed cancels the outstanding work, a streamed speculative answer stops at the next token.
+# - A clicked question waits at most FOLLOWUP_PREFETCH_WAIT_SECONDS for its work, then it is answered live, with the
+#   retrieval of the work if that is done already.
+
+FOLLOWUP_PREFETCH_ENABLED = os.getenv("FOLLOWUP_PREFETCH_ENABLED", "false").lower() == "true"
+# "retrieve": condense and retrieve only, "answer": also generate the answer
+FOLLOWUP_PREFETCH_MODE = os.getenv("FOLLOWUP_PREFETCH_MODE", "retrieve")
+FOLLOWUP_PREFETCH_MAX_QUESTIONS = int(os.getenv("FOLLOWUP_PREFETCH_MAX_QUESTIONS", 3))
+FOLLOWUP_PREFETCH_WORKERS = int(os.getenv("FOLLOWUP_PREFETCH_WORKERS", 4))
+FOLLOWUP_PREFETCH_TTL_SECONDS = float(os.getenv("FOLLOWUP_PREFETCH_TTL_SECONDS", 300))
+FOLLOWUP_PREFETCH_TOKENS_PER_MINUTE = int(os.getenv("FOLLOWUP_PREFETCH_TOKENS_PER_MINUTE", 20000))
+FOLLOWUP_PREFETCH_REQUESTS_PER_MINUTE = int(os.getenv("FOLLOWUP_PREFETCH_REQUESTS_PER_MINUTE", 30))
+# How long a clicked question waits for its speculative work that is still running, before it is answered live
+FOLLOWUP_PREFETCH_WAIT_SECONDS = float(os.getenv("FOLLOWUP_PREFETCH_WAIT_SECONDS", 0.5))
+
+
+class Prefetched:
+    # The prepared retrieval (see LLMHelper.prepare_answer) and, in "answer" mode, the finished answer as
+    # (question, answer, contextDict, sources). Filled by the prefetch task as the work progresses.
+    def __init__(self, prepared=None, answer=None):
+        self.prepared = prepared
+        self.answer = answer
+
+
+class PrefetchPool:
+    # Threads and budget shared by the prefetchers of all sessions. The tokens of a task are estimated from the
+    # tasks that ran before.
+
+    def __init__(self, workers=FOLLOWUP_PREFETCH_WORKERS, tokens_per_minute=FOLLOWUP_PREFETCH_TOKENS_PER_MINUTE,
+                 requests_per_minute=FOLLOWUP_PREFETCH_REQUESTS_PER_MINUTE):
+        # embedding_scheduler imports openai, the chat page imports this module on every start
+        from embedding_scheduler import RateBudget
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.budget = RateBudget(tokens_per_minute, requests_per_minute)
+        self._lock = threading.Lock()
+        self._tasks = 0
+        self._tokens = 0
+        self.skipped = 0
+
+    def try_book(self):
+        with self._lock:
+            estimate = self._tokens // self._tasks if self._tasks else 0
+        if self.budget.try_acquire(estimate):
+            return True
+        with self._lock:
+            self.skipped += 1
+        return False
+
+    def record_tokens(self, tokens):
+        with self._lock:
+            self._tasks += 1
+            self._tokens += tokens
+
+
+class FollowupPrefetcher:
+    # Per session, kept in the Streamlit session state
+
+    def __init__(self, llm_helper, mode=FOLLOWUP_PREFETCH_MODE, pool=None, ttl_seconds=FOLLOWUP_PREFETCH_TTL_SECONDS,
+                 max_questions=FOLLOWUP_PREFETCH_MAX_QUESTIONS):
+        self.llm_helper = llm_helper
+        self.mode = mode
+        self.pool = pool or get_prefetch_pool()
+        self.ttl_seconds = ttl_seconds
+        self.max_questions = max_questions
+        # question key -> (future, cancel event, expiry time, Prefetched)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _run(self, question, chat_history, cancelled, prefetched):
+        # Fill prefetched, unless the work was cancelled before it started or is over the budget
+        if cancelled.is_set() or not self.pool.try_book():
+            return
+        with trace("followup_prefetch", mode=self.mode) as current:
+            prefetched.prepared = self.llm_helper.prepare_answer(question, chat_history)
+            if self.mode == "answer" and not cancelled.is_set():
+                stream = self.llm_helper.get_semantic_answer_lang_chain_stream(question, chat_history,
+                                                                               prepared=prefetched.prepared)
+                try:
+                    for event, value in stream:
+                        if cancelled.is_set():
+                            break
+                        if event == "done":
+                            prefetched.answer = value
+                finally:
+                    # Closes the request to the LLM right away, not only when the generator is collected
+                    stream.close()
+            current.set(cancelled=cancelled.is_set())
+        self.pool.record_tokens(llm_tokens(current))
+
+    def prefetch(self, questions, chat_history):
+        # Start the work for the proposed questions, chat_history is the history they would be asked with (including
+        # the answer that proposed them). Outstanding work for earlier proposals is cancelled.
+        self.cancel()
+        chat_history = list(chat_history)
+        expires = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            for question in questions[:self.max_questions]:
+                cancelled = threading.Event()
+                prefetched = Prefetched()
+                future = self.pool.executor.submit(self._run, question, chat_history, cancelled, prefetched)
+                self._entries[question_key(question, chat_history)] = (future, cancelled, expires, prefetched)
+
+    def take(self, question, chat_history, wait_seconds=FOLLOWUP_PREFETCH_WAIT_SECONDS):
+        # The Prefetched for a question that is asked now, or None. Work that is still running after wait_seconds is
+        # cancelled, its retrieval is used if it is done. All other outstanding work is cancelled.
+        key = question_key(question, chat_history)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        self.cancel()
+        result = None
+        if entry is not None and entry[2] > time.monotonic():
+            future, cancelled, _, prefetched = entry
+            try:
+                future.result(timeout=wait_seconds)
+            except TimeoutError:
+                cancelled.set()
+                future.cancel()
+            except Exception as e:
+                print(f"Follow-up prefetch failed: {type(e).__name__}: {e}")
+            if prefetched.prepared is not None:
+                result = prefetched
+        get_metrics().increment("cache_requests_total", cache="followup_prefetch",
+                                result="hit" if result is not None else "miss")
+        return result
+
+    def cancel(self):
+        # Cancel the outstanding work, finished results stay until they expire
+        now = time.monotonic()
+        with self._lock:
+            for key, (future, cancelled, expires, _) in list(self._entries.items()):
+                if not future.done():
+                    cancelled.set()
+                    future.cancel()
+                    del self._entries[key]
+                elif expires <= now:
+                    del self._entries[key]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_prefetch_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PrefetchPool()
+        return _pool
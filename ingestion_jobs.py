@@ -0,0 +1,324 @@
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from ingestion_pipeline import IngestionCancelled
+
+# Background ingestion jobs. The Streamlit page only submits a job to a persistent queue in SQLite, workers (threads
+# of the Streamlit process, or a separate `python ingestion_jobs.py worker`) claim the jobs, run them and write their
+# progress back, so a job survives a reload of the page and can be watched and cancelled from any session.
+# - At most INGESTION_MAX_RUNNING_JOBS jobs run at the same time over all worker processes, so concurrent ingestions
+#   do not compete for the embedding quota.
+# - A job whose worker died (no heartbeat for INGESTION_JOB_STALE_SECONDS) is queued again. The ingestion pipeline
+#   checkpoints the finished sources of a run, so the new attempt continues after the last finished page. After
+#   INGESTION_JOB_MAX_ATTEMPTS attempts the job fails instead, so a job that kills its worker is not retried forever.
+#
+#   python ingestion_jobs.py submit website https://example.com
+#   python ingestion_jobs.py submit confluence --incremental
+#   python ingestion_jobs.py worker
+#   python ingestion_jobs.py list
+#   python ingestion_jobs.py cancel <job id>
+
+INGESTION_JOB_PATH = os.getenv("INGESTION_JOB_PATH", os.path.join(".cache", "jobs.sqlite"))
+INGESTION_MAX_RUNNING_JOBS = int(os.getenv("INGESTION_MAX_RUNNING_JOBS", 1))
+INGESTION_JOB_STALE_SECONDS = float(os.getenv("INGESTION_JOB_STALE_SECONDS", 60))
+INGESTION_JOB_POLL_SECONDS = float(os.getenv("INGESTION_JOB_POLL_SECONDS", 1.0))
+INGESTION_JOB_MAX_ATTEMPTS = int(os.getenv("INGESTION_JOB_MAX_ATTEMPTS", 3))
+# Start the workers in the Streamlit process, disable when a separate worker process runs the jobs
+INGESTION_JOB_WORKERS_IN_APP = os.getenv("INGESTION_JOB_WORKERS_IN_APP", "true").lower() == "true"
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+def _run_website(params, on_progress, cancel_event):
+    from vector_storage import add_website_to_vector_store
+    return add_website_to_vector_store(params["url"], only_changed=params.get("only_changed", False),
+                                       on_progress=on_progress, cancel_event=cancel_event)
+
+
+def _run_confluence(params, on_progress, cancel_event):
+    from vector_storage import add_confluence_to_vector_store
+    kwargs = {"page_ids": params["page_ids"]} if params.get("page_ids") else {}
+    return add_confluence_to_vector_store(incremental=params.get("incremental", False), on_progress=on_progress,
+                                          cancel_event=cancel_event, **kwargs)
+
+
+# Job kind -> function(params, on_progress, cancel_event) returning the ingestion statistics
+JOB_KINDS = {"website": _run_website, "confluence": _run_confluence}
+
+
+class Job:
+    def __init__(self, job_id, kind, params, status, created, started, finished, progress, result, error,
+                 attempts, cancel_requested):
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.status = status
+        self.created = created
+        self.started = started
+        self.finished = finished
+        self.progress = progress
+        self.result = result
+        self.error = error
+        self.attempts = attempts
+        self.cancel_requested = cancel_requested
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class JobStore:
+    # SQLite table of the ingestion jobs, shared by all processes that use the same path
+
+    _COLUMNS = "id, kind, params, status, created, started, finished, progress, result, error, attempts, " \
+               "cancel_requested"
+
+    def __init__(self, path=INGESTION_JOB_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        # Autocommit, the claim of a job runs in an explicit transaction
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, params TEXT, status TEXT, "
+                         "created REAL, started REAL, finished REAL, progress TEXT, result TEXT, error TEXT, "
+                         "attempts INTEGER, cancel_requested INTEGER, worker TEXT, heartbeat REAL)")
+
+    @staticmethod
+    def _job(row):
+        job_id, kind, params, status, created, started, finished, progress, result, error, attempts, cancel = row
+        return Job(job_id, kind, json.loads(params), status, created, started, finished,
+                   json.loads(progress) if progress else {}, json.loads(result) if result else None, error,
+                   attempts, bool(cancel))
+
+    def submit(self, kind, params):
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind {kind}, expected one of {', '.join(JOB_KINDS)}")
+        job_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            self._db.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, NULL, NULL, NULL, NULL, NULL, 0, 0, NULL, NULL)",
+                             (job_id, kind, json.dumps(params), QUEUED, time.time()))
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def list(self, limit=20):
+        # Most recent jobs first
+        with self._lock:
+            rows = self._db.execute(f"SELECT {self._COLUMNS} FROM jobs ORDER BY created DESC LIMIT ?",
+                                    (limit,)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def claim(self, worker, max_running=INGESTION_MAX_RUNNING_JOBS, stale_seconds=INGESTION_JOB_STALE_SECONDS,
+              max_attempts=INGESTION_JOB_MAX_ATTEMPTS):
+        # Take the oldest queued job if fewer than max_running jobs are running, jobs of dead workers are queued
+        # again first (or failed after max_attempts). Returns the job or None.
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("UPDATE jobs SET status = ?, finished = ?, error = ?, worker = NULL "
+                                 "WHERE status = ? AND heartbeat < ? AND attempts >= ?",
+                                 (FAILED, now, f"The worker stopped responding, gave up after {max_attempts} attempts",
+                                  RUNNING, now - stale_seconds, max_attempts))
+                self._db.execute("UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat < ?",
+                                 (QUEUED, RUNNING, now - stale_seconds))
+                running = self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (RUNNING,)).fetchone()[0]
+                row = None
+                if running < max_running:
+                    row = self._db.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE status = ? ORDER BY created "
+                                           f"LIMIT 1", (QUEUED,)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE jobs SET status = ?, worker = ?, heartbeat = ?, attempts = attempts + 1, "
+                                     "started = COALESCE(started, ?) WHERE id = ?",
+                                     (RUNNING, worker, now, now, row[0]))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = self._job(row)
+        job.status = RUNNING
+        return job
+
+    def heartbeat(self, job_id, progress=None):
+        # Mark a running job alive and store its progress, returns True if the job should be cancelled
+        with self._lock:
+            if progress is None:
+                self._db.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+            else:
+                self._db.execute("UPDATE jobs SET progress = ?, heartbeat = ? WHERE id = ?",
+                                 (json.dumps(progress, default=str), time.time(), job_id))
+            row = self._db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def finish(self, job_id, status, result=None, error=None):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = ?, finished = ?, result = ?, error = ?, worker = NULL "
+                             "WHERE id = ?",
+                             (status, time.time(), json.dumps(result, default=str) if result is not None else None,
+                              error, job_id))
+
+    def requeue(self, job_id, max_attempts=INGESTION_JOB_MAX_ATTEMPTS):
+        # A job that was interrupted max_attempts times fails instead
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = ?, finished = ?, error = ?, worker = NULL "
+                             "WHERE id = ? AND attempts >= ?",
+                             (FAILED, time.time(), f"Interrupted, gave up after {max_attempts} attempts", job_id,
+                              max_attempts))
+            self._db.execute("UPDATE jobs SET status = ?, worker = NULL WHERE id = ? AND status = ?",
+                             (QUEUED, job_id, RUNNING))
+
+    def cancel(self, job_id):
+        # A queued job is cancelled right away, a running one by its worker at the next heartbeat
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                             (CANCELLED, time.time(), job_id, QUEUED))
+            self._db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?", (job_id, RUNNING))
+
+
+class JobWorker:
+    # Threads that claim and run jobs until stopped. The number of threads only bounds this process, the number of
+    # jobs running over all processes is bounded by the store.
+
+    def __init__(self, store=None, threads=INGESTION_MAX_RUNNING_JOBS, poll_seconds=INGESTION_JOB_POLL_SECONDS):
+        self.store = store or get_job_store()
+        self.name = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.poll_seconds = poll_seconds
+        self._threads = [threading.Thread(target=self._loop, daemon=True) for _ in range(threads)]
+        self._stop = threading.Event()
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self):
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(timeout=1.0)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            job = self.store.claim(self.name)
+            if job is None:
+                self._stop.wait(self.poll_seconds)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job):
+        cancel_event = threading.Event()
+
+        def on_progress(stats):
+            if self.store.heartbeat(job.id, stats) or self._stop.is_set():
+                cancel_event.set()
+
+        print(f"Job {job.id}: {job.kind} {json.dumps(job.params)} started (attempt {job.attempts + 1})")
+        # The heartbeat also runs before the pipeline starts, e.g. while the Confluence pages are listed
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, cancel_event), daemon=True)
+        heartbeat.start()
+        try:
+            result = JOB_KINDS[job.kind](job.params, on_progress, cancel_event)
+        except IngestionCancelled:
+            if self._stop.is_set() and not self.store.get(job.id).cancel_requested:
+                # The worker is shutting down, another worker continues the job from its checkpoint
+                self.store.requeue(job.id)
+            else:
+                self.store.finish(job.id, CANCELLED)
+            print(f"Job {job.id} cancelled")
+            return
+        except Exception as e:
+            self.store.finish(job.id, FAILED, error=f"{type(e).__name__}: {e}")
+            print(f"Job {job.id} failed: {type(e).__name__}: {e}")
+            return
+        finally:
+            cancel_event.set()
+            heartbeat.join()
+        self.store.finish(job.id, DONE, result=result or {})
+        print(f"Job {job.id} done: {json.dumps(result or {}, default=str)}")
+
+    def _heartbeat(self, job, cancel_event):
+        # Keeps the job alive and picks up cancellation between the progress reports of the pipeline
+        while not cancel_event.wait(INGESTION_JOB_STALE_SECONDS / 4):
+            if self.store.heartbeat(job.id) or self._stop.is_set():
+                cancel_event.set()
+
+
+_store = None
+_worker = None
+_lock = threading.Lock()
+
+
+def get_job_store():
+    global _store
+    with _lock:
+        if _store is None:
+            _store = JobStore()
+        return _store
+
+
+def ensure_app_worker():
+    # Start the workers of the Streamlit process once, the page scripts call this on every rerun
+    global _worker
+    if not INGESTION_JOB_WORKERS_IN_APP:
+        return None
+    store = get_job_store()
+    with _lock:
+        if _worker is None:
+            _worker = JobWorker(store).start()
+        return _worker
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Submit, run, list and cancel background ingestion jobs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit = commands.add_parser("submit", help="queue an ingestion job")
+    submit.add_argument("kind", choices=sorted(JOB_KINDS))
+    submit.add_argument("url", nargs="?", help="start URL of a website job")
+    submit.add_argument("--only-changed", action="store_true", help="website: skip pages unchanged since last crawl")
+    submit.add_argument("--incremental", action="store_true", help="confluence: only sync changed pages")
+    worker = commands.add_parser("worker", help="run queued jobs until interrupted")
+    worker.add_argument("--threads", type=int, default=INGESTION_MAX_RUNNING_JOBS)
+    commands.add_parser("list", help="show the most recent jobs")
+    cancel = commands.add_parser("cancel", help="cancel a queued or running job")
+    cancel.add_argument("job_id")
+    args = parser.parse_args()
+
+    store = get_job_store()
+    if args.command == "submit":
+        if args.kind == "website":
+            if not args.url:
+                parser.error("a website job needs a URL")
+            params = {"url": args.url, "only_changed": args.only_changed}
+        else:
+            params = {"incremental": args.incremental}
+        print(store.submit(args.kind, params))
+    elif args.command == "worker":
+        runner = JobWorker(store, threads=args.threads).start()
+        try:
+            runner.join()
+        except KeyboardInterrupt:
+            runner.stop()
+            runner.join()
+    elif args.command == "list":
+        for job in store.list():
+            print(json.dumps(job.to_dict(), default=str))
+    else:
+        store.cancel(args.job_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+# Streaming ingestion: load -> split -> embed -> upload run as concurrent stages connected by bounded queues. A slow
+# stage blocks the ones before it, so memory stays flat no matter how large the source is, and the first batches
+# are searchable while the rest is still loading. Sources that are completely uploaded are written to a checkpoint,
+# a failed run with the same run id continues after the last finished source.
+
+INGESTION_BATCH_SIZE = int(os.getenv("INGESTION_BATCH_SIZE", 16))
+INGESTION_QUEUE_SIZE = int(os.getenv("INGESTION_QUEUE_SIZE", 8))
+INGESTION_EMBED_WORKERS = int(os.getenv("INGESTION_EMBED_WORKERS", 2))
+INGESTION_CHECKPOINT_PATH = os.getenv("INGESTION_CHECKPOINT_PATH", os.path.join(".cache", "checkpoints.sqlite"))
+
+_DONE = object()
+
+
+class IngestionCancelled(Exception):
+    pass
+
+
+class IngestionCheckpoint:
+    # Set of finished sources per run, kept in SQLite until the run completes
+
+    def __init__(self, path=INGESTION_CHECKPOINT_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS checkpoints (run_id TEXT, source TEXT, "
+                         "PRIMARY KEY (run_id, source))")
+        self._db.commit()
+
+    def done_sources(self, run_id):
+        with self._lock:
+            rows = self._db.execute("SELECT source FROM checkpoints WHERE run_id = ?", (run_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def mark_done(self, run_id, source):
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO checkpoints VALUES (?, ?)", (run_id, source))
+            self._db.commit()
+
+    def clear(self, run_id):
+        with self._lock:
+            self._db.execute("DELETE FROM checkpoints WHERE run_id = ?", (run_id,))
+            self._db.commit()
+
+
+def upload_embedded_documents(vector_store, docs, vectors, keys=None):
+    # Upload already embedded chunks to the index, for Azure AI Search with the same fields as AzureSearch uses
+    keys = keys or [d.metadata.get("id") or str(uuid.uuid4()) for d in docs]
+    if hasattr(vector_store, "add_embeddings"):
+        # The local index stores the vectors directly
+        vector_store.add_embeddings([d.page_content for d in docs], vectors, [d.metadata for d in docs], keys)
+        return
+    from langchain_community.vectorstores.azuresearch import FIELDS_ID, FIELDS_CONTENT, FIELDS_CONTENT_VECTOR, \
+        FIELDS_METADATA
+    documents = [{
+        "@search.action": "upload",
+        FIELDS_ID: key,
+        FIELDS_CONTENT: d.page_content,
+        FIELDS_CONTENT_VECTOR: np.array(vector, dtype=np.float32).tolist(),
+        FIELDS_METADATA: json.dumps(d.metadata),
+    } for d, vector, key in zip(docs, vectors, keys)]
+    response = vector_store.client.upload_documents(documents=documents)
+    if not all(r.succeeded for r in response):
+        raise Exception(response)
+
+
+def update_document_metadata(vector_store, keys, metadatas):
+    # Replace the metadata of uploaded chunks without uploading their vectors again
+    if hasattr(vector_store, "update_metadata"):
+        vector_store.update_metadata(keys, metadatas)
+        return
+    from langchain_community.vectorstores.azuresearch import FIELDS_ID, FIELDS_METADATA
+    response = vector_store.client.merge_documents(
+        documents=[{FIELDS_ID: key, FIELDS_METADATA: json.dumps(metadata)} for key, metadata in zip(keys, metadatas)])
+    if not all(r.succeeded for r in response):
+        raise Exception(response)
+
+
+class IngestionPipeline:
+    # Runs the ingestion stages in threads. Hooks:
+    # - prepare(document, chunks) returns the chunks of a source that should be uploaded (e.g. to assign ids)
+    # - on_source_done(source) is called once all chunks of a source are in the index
+    # - on_progress(stats) is called about every second while the pipeline runs
+    # Setting cancel_event stops all stages, run() then raises IngestionCancelled. The checkpoint of the finished
+    # sources is kept, so a new run with the same id continues where the cancelled one stopped.
+    # A deduplicator (chunk_dedup.ChunkDeduplicator) strips boilerplate before the split and drops near-duplicate
+    # chunks before prepare. Chunks uploaded before one of their duplicates was dropped get its source in their
+    # metadata at the end of the run. Uploaded chunks are also added to the lexical index, if one is given
+
+    def __init__(self, vector_store, embeddings, text_splitter, run_id, source_key=lambda d: d.metadata["source"],
+                 prepare=None, on_source_done=None, batch_size=INGESTION_BATCH_SIZE, queue_size=INGESTION_QUEUE_SIZE,
+                 embed_workers=INGESTION_EMBED_WORKERS, checkpoint=None, lexical_index=None, deduplicator=None,
+                 on_progress=None, cancel_event=None):
+        self.vector_store = vector_store
+        self.embeddings = embeddings
+        self.text_splitter = text_splitter
+        self.run_id = run_id
+        self.source_key = source_key
+        self.prepare = prepare
+        self.on_source_done = on_source_done
+        self.batch_size = batch_size
+        self.embed_workers = embed_workers
+        self.checkpoint = checkpoint or IngestionCheckpoint()
+        self.lexical_index = lexical_index
+        self.deduplicator = deduplicator
+        self.on_progress = on_progress
+        self.cancel_event = cancel_event
+        self._documents = queue.Queue(maxsize=queue_size)
+        self._batches = queue.Queue(maxsize=queue_size)
+        self._embedded = queue.Queue(maxsize=queue_size)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._errors = []
+        self.documents_loaded = 0
+        self.documents_skipped = 0
+        self.chunks_embedded = 0
+        self.chunks_uploaded = 0
+        self.seconds = 0.0
+        self._started = None
+        # Busy seconds per stage, summed over the workers of the stage (waiting on the queues is not counted)
+        self.stage_seconds = {"split": 0.0, "embed": 0.0, "upload": 0.0}
+        # Guards the counters and stage_seconds, the embed workers update them concurrently
+        self._stats_lock = threading.Lock()
+
+    def _put(self, target, item):
+        # Blocking put that gives up when another stage failed, so no thread waits forever on a full queue
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _stage(self, target):
+        # Wraps a stage so that its exception stops the whole pipeline and is re-raised by run()
+        def run():
+            try:
+                target()
+            except Exception as e:
+                self._errors.append(e)
+                self._stop.set()
+        return threading.Thread(target=run, daemon=True)
+
+    def _busy(self, stage, started):
+        with self._stats_lock:
+            self.stage_seconds[stage] += time.perf_counter() - started
+
+    def _count(self, counter, count=1):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + count)
+
+    def _source_finished(self, source, count):
+        # Decrease the number of outstanding chunks of a source, and finish the source when none are left
+        with self._pending_lock:
+            self._pending[source] = self._pending.get(source, 0) + count
+            finished = self._pending[source] == 0
+            if finished:
+                del self._pending[source]
+        if finished:
+            if self.on_source_done:
+                self.on_source_done(source)
+            self.checkpoint.mark_done(self.run_id, source)
+
+    def _load(self, documents):
+        done_sources = self.checkpoint.done_sources(self.run_id)
+        try:
+            for document in documents:
+                if self._stop.is_set():
+                    return
+                if self.source_key(document) in done_sources:
+                    self._count("documents_skipped")
+                    continue
+                self._count("documents_loaded")
+                if not self._put(self._documents, document):
+                    return
+        finally:
+            # A generator that is left early (cancellation, failed stage) can release its threads
+            if hasattr(documents, "close"):
+                documents.close()
+            self._put(self._documents, _DONE)
+
+    def _split(self):
+        batch = []
+        try:
+            while True:
+                document = self._get(self._documents)
+                if document is _DONE:
+                    break
+                source = self.source_key(document)
+                started = time.perf_counter()
+                if self.deduplicator is not None:
+                    document = self.deduplicator.strip_boilerplate(document)
+                chunks = self.text_splitter.split_documents([document])
+                if self.deduplicator is not None:
+                    chunks = self.deduplicator.filter_chunks(source, chunks)
+                if self.prepare:
+                    chunks = self.prepare(document, chunks)
+                self._busy("split", started)
+                # Register the chunks (plus one for the split itself) before they are passed on, the source is
+                # finished when all of them have been uploaded and the count is back to 0
+                with self._pending_lock:
+                    self._pending[source] = self._pending.get(source, 0) + len(chunks) + 1
+                for chunk in chunks:
+                    batch.append((source, chunk))
+                    if len(batch) >= self.batch_size:
+                        if not self._put(self._batches, batch):
+                            return
+                        batch = []
+                self._source_finished(source, -1)
+                # Do not hold back a partial batch while the loader is still busy with the next document
+                if batch and self._documents.empty():
+                    if not self._put(self._batches, batch):
+                        return
+                    batch = []
+            if batch:
+                self._put(self._batches, batch)
+        finally:
+            for _ in range(self.embed_workers):
+                self._put(self._batches, _DONE)
+
+    def _uploaded(self, batch):
+        counts = {}
+        for source, _ in batch:
+            counts[source] = counts.get(source, 0) + 1
+        for source, count in counts.items():
+            self._source_finished(source, -count)
+
+    def _embed(self):
+        while True:
+            batch = self._get(self._batches)
+            if batch is _DONE:
+                break
+            started = time.perf_counter()
+            vectors = self.embeddings.embed_documents([chunk.page_content for _, chunk in batch])
+            self._busy("embed", started)
+            self._count("chunks_embedded", len(batch))
+            if not self._put(self._embedded, (batch, vectors)):
+                return
+        self._put(self._embedded, _DONE)
+
+    def _upload(self):
+        finished_workers = 0
+        while finished_workers < self.embed_workers:
+            item = self._get(self._embedded)
+            if item is _DONE:
+                if self._stop.is_set():
+                    return
+                finished_workers += 1
+                continue
+            batch, vectors = item
+            docs = [chunk for _, chunk in batch]
+            keys = [d.metadata.get("id") or str(uuid.uuid4()) for d in docs]
+            started = time.perf_counter()
+            if self.deduplicator is not None:
+                self.deduplicator.uploading(docs, keys)
+            upload_embedded_documents(self.vector_store, docs, vectors, keys)
+            if self.lexical_index is not None:
+                self.lexical_index.add_documents(docs, keys)
+            self._busy("upload", started)
+            self._count("chunks_uploaded", len(batch))
+            self._uploaded(batch)
+
+    def _update_duplicate_sources(self):
+        # Chunks that were uploaded before a near-duplicate of them was dropped get the additional source afterwards
+        keys, metadatas = self.deduplicator.metadata_updates()
+        if not keys:
+            return
+        started = time.perf_counter()
+        for i in range(0, len(keys), self.batch_size):
+            update_document_metadata(self.vector_store, keys[i:i + self.batch_size], metadatas[i:i + self.batch_size])
+            if self.lexical_index is not None:
+                self.lexical_index.update_metadata(keys[i:i + self.batch_size], metadatas[i:i + self.batch_size])
+        self._busy("upload", started)
+
+    def stats(self):
+        # While the pipeline runs, the throughput so far
+        seconds = self.seconds or (time.monotonic() - self._started if self._started is not None else 0.0)
+        with self._stats_lock:
+            stats = {"documents_loaded": self.documents_loaded, "documents_skipped": self.documents_skipped,
+                     "chunks_embedded": self.chunks_embedded, "chunks_uploaded": self.chunks_uploaded,
+                     "seconds": seconds, "stage_seconds": dict(self.stage_seconds),
+                     "chunks_per_second": self.chunks_uploaded / seconds if seconds else 0.0}
+        if self.deduplicator is not None:
+            stats.update(self.deduplicator.stats())
+        return stats
+
+    def run(self, documents):
+        # Run all stages until the documents are exhausted, raises the first error of any stage
+        self._started = time.monotonic()
+        threads = [self._stage(lambda: self._load(documents)), self._stage(self._split)]
+        threads += [self._stage(self._embed) for _ in range(self.embed_workers)]
+        threads.append(self._stage(self._upload))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1.0)
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    self._stop.set()
+                if self.on_progress and thread.is_alive():
+                    self.on_progress(self.stats())
+        self.seconds = time.monotonic() - self._started
+        if self._errors:
+            raise self._errors[0]
+        if self.deduplicator is not None:
+            self._update_duplicate_sources()
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise IngestionCancelled(f"Ingestion {self.run_id} was cancelled")
+        # The run is complete, the next run with this id starts from scratch
+        self.checkpoint.clear(self.run_id)
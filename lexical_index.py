@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, List
+
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+
+from tracing import annotate
+
+# Lexical (BM25) index over the ingested chunks, kept in a SQLite FTS5 table next to the vector index. It is updated
+# by the ingestion pipeline whenever chunks are uploaded or deleted. The HybridRetriever fuses its results with the
+# vector search by reciprocal rank fusion, and answers questions that clearly name a page title, person or project
+# code from the lexical index alone, without an embedding call.
+# The index is a local file that only holds the chunks ingested since it was introduced, it is not shared between app
+# instances. The lexical-only fast path is therefore only taken while the lexical index holds at least as many chunks
+# as the vector index (re-ingest the sources to fill it), otherwise the lexical results are only fused.
+
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", os.path.join(".cache", "lexical"))
+HYBRID_RETRIEVAL_ENABLED = os.getenv("HYBRID_RETRIEVAL_ENABLED", "true").lower() == "true"
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", 20))
+# The lexical fast path is taken when the best hit scores clearly above the next hit, title matches score higher
+LEXICAL_MIN_SCORE = float(os.getenv("LEXICAL_MIN_SCORE", 5.0))
+LEXICAL_CONFIDENCE_RATIO = float(os.getenv("LEXICAL_CONFIDENCE_RATIO", 1.5))
+# How long the comparison of the lexical and the vector index size is reused
+LEXICAL_COVERAGE_TTL_SECONDS = float(os.getenv("LEXICAL_COVERAGE_TTL_SECONDS", 300))
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+# Column weights for bm25(): chunk_id, title, content
+_BM25_WEIGHTS = "0.0, 5.0, 1.0"
+
+
+def chunk_key(doc):
+    # Identifies a chunk by source and content, independent of the index it was retrieved from
+    return doc.metadata.get("source", "") + "#" + hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+
+class LexicalIndex:
+    # Incrementally maintained BM25 index, one SQLite file per vector index
+
+    def __init__(self, path):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(chunk_id UNINDEXED, title, content, "
+                         "metadata UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')")
+        # The FTS table cannot index chunk_id, chunks are found by their rowid instead
+        self._db.execute("CREATE TABLE IF NOT EXISTS chunk_rowids (chunk_id TEXT PRIMARY KEY, fts_rowid INTEGER)")
+        if self._db.execute("SELECT NOT EXISTS (SELECT 1 FROM chunk_rowids) AND EXISTS (SELECT 1 FROM chunks)")\
+                .fetchone()[0]:
+            # Index files written before the rowid table existed
+            self._db.execute("INSERT OR REPLACE INTO chunk_rowids SELECT chunk_id, rowid FROM chunks")
+        self._db.commit()
+
+    def _rows(self, ids):
+        # Rowids of the chunks with the given ids, the caller holds the lock
+        rows = []
+        for id in ids:
+            row = self._db.execute("SELECT fts_rowid FROM chunk_rowids WHERE chunk_id = ?", (id,)).fetchone()
+            if row is not None:
+                rows.append(row)
+        return rows
+
+    def _delete(self, ids):
+        self._db.executemany("DELETE FROM chunks WHERE rowid = ?", self._rows(ids))
+        self._db.executemany("DELETE FROM chunk_rowids WHERE chunk_id = ?", [(id,) for id in ids])
+
+    def add_documents(self, docs, ids):
+        # Insert or replace the chunks with the given ids
+        with self._lock:
+            self._delete(ids)
+            for d, id in zip(docs, ids):
+                cursor = self._db.execute("INSERT INTO chunks VALUES (?, ?, ?, ?)",
+                                          (id, d.metadata.get("title", ""), d.page_content, json.dumps(d.metadata)))
+                self._db.execute("INSERT OR REPLACE INTO chunk_rowids VALUES (?, ?)", (id, cursor.lastrowid))
+            self._db.commit()
+
+    def update_metadata(self, ids, metadatas):
+        with self._lock:
+            self._db.executemany("UPDATE chunks SET metadata = ? WHERE rowid = (SELECT fts_rowid FROM chunk_rowids "
+                                 "WHERE chunk_id = ?)",
+                                 [(json.dumps(metadata), id) for id, metadata in zip(ids, metadatas)])
+            self._db.commit()
+
+    def delete(self, ids):
+        with self._lock:
+            self._delete(ids)
+            self._db.commit()
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chunk_rowids").fetchone()[0]
+
+    def search(self, query, k=4):
+        # Returns [(document, score)] with the best match first, scores are BM25 (higher is better)
+        terms = _TOKEN_PATTERN.findall(query.lower())
+        if not terms:
+            return []
+        match = " OR ".join('"' + term + '"' for term in dict.fromkeys(terms))
+        with self._lock:
+            rows = self._db.execute(f"SELECT content, metadata, bm25(chunks, {_BM25_WEIGHTS}) AS score FROM chunks "
+                                    f"WHERE chunks MATCH ? ORDER BY score LIMIT ?", (match, k)).fetchall()
+        return [(Document(page_content=content, metadata=json.loads(metadata)), -score)
+                for content, metadata, score in rows]
+
+    @staticmethod
+    def is_confident(results):
+        # True if the lexical result alone is good enough to answer the question
+        if not results:
+            return False
+        # A page title in the query alone is not enough, short titles ("Home", "Team") appear in unrelated questions.
+        # The title column is weighted in bm25(), so a hit on a named title wins by a clear margin.
+        best_score = results[0][1]
+        second_score = results[1][1] if len(results) > 1 else 0.0
+        return best_score >= LEXICAL_MIN_SCORE and best_score >= LEXICAL_CONFIDENCE_RATIO * max(second_score, 1e-9)
+
+
+def reciprocal_rank_fusion(result_lists, k=60):
+    # Fuse ranked document lists, each document scores sum(1 / (k + rank)) over the lists it appears in
+    scores, docs = {}, {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = chunk_key(doc)
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+class HybridRetriever(BaseRetriever):
+    # Lexical + vector retrieval with reciprocal rank fusion and a lexical-only fast path
+    vector_store: Any
+    lexical_index: Any
+    k: int = 4
+    fetch_k: int = HYBRID_FETCH_K
+    search_kwargs: dict = {}
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        lexical_results = self.lexical_index.search(query, self.fetch_k)
+        if self.lexical_index.is_confident(lexical_results) and \
+                lexical_covers_vector_store(self.lexical_index, self.vector_store):
+            return [doc for doc, _ in lexical_results[:self.k]]
+        vector_results = self.vector_store.similarity_search(query, k=self.fetch_k, **self.search_kwargs)
+        return reciprocal_rank_fusion([[doc for doc, _ in lexical_results], vector_results])[:self.k]
+
+
+def vector_store_size(vector_store):
+    # Number of chunks in the vector index, None if it cannot be counted
+    if hasattr(vector_store, "client") and hasattr(vector_store.client, "get_document_count"):
+        return vector_store.client.get_document_count()
+    try:
+        return len(vector_store)
+    except TypeError:
+        return None
+
+
+_coverage = {}
+_coverage_lock = threading.Lock()
+
+
+def lexical_covers_vector_store(lexical_index, vector_store):
+    # True if the lexical index holds at least as many chunks as the vector index, checked every
+    # LEXICAL_COVERAGE_TTL_SECONDS. Without it, a lexical hit may only be the best among the chunks it knows.
+    key = (id(lexical_index), id(vector_store))
+    with _coverage_lock:
+        expires, covered = _coverage.get(key, (0.0, False))
+    if expires > time.monotonic():
+        return covered
+    try:
+        size = vector_store_size(vector_store)
+        covered = size is not None and 0 < size <= lexical_index.count()
+    except Exception as e:
+        # The question is still answered by the fused retrieval, the error is recorded on its trace
+        annotate(lexical_coverage_error=f"{type(e).__name__}: {e}")
+        covered = False
+    with _coverage_lock:
+        _coverage[key] = (time.monotonic() + LEXICAL_COVERAGE_TTL_SECONDS, covered)
+    return covered
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_lexical_index(index_name):
+    # One lexical index per vector index and process
+    with _indexes_lock:
+        if index_name not in _indexes:
+            _indexes[index_name] = LexicalIndex(os.path.join(LEXICAL_INDEX_PATH, index_name + ".sqlite"))
+        return _indexes[index_name]
@@ -1,15 +1,89 @@
+import asyncio
+import contextvars
+import os
 import re
-from langchain.chains import RetrievalQA, ConversationalRetrievalChain
-from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from langchain.chains.llm import LLMChain
-from langchain.chains.chat_vector_db.prompts import CONDENSE_QUESTION_PROMPT
+import threading
+import time
+import tiktoken
 from langchain.prompts import PromptTemplate
-from langchain.chat_models import AzureChatOpenAI
 
-from langchain.embeddings import AzureOpenAIEmbeddings
-
-from vector_storage import init_vector_store
+from client_registry import get_llm, get_embeddings, get_vector_store, LLM_DEPLOYMENT, EMBEDDING_DEPLOYMENT, \
+    INDEX_NAME
 from customprompt import PROMPT
+from answer_cache import get_answer_cache, ANSWER_CACHE_ENABLED
+from answer_postprocessor import process_answer, find_sources_marker, number_citations, cited_references, \
+    clean_encoding, filter_sources_links, strip_sources_section, SOURCES_MARKER_OVERLAP
+from context_packer import ContextPacker, CONTEXT_PACKING_ENABLED
+from conversation_memory import ConversationMemory
+from tracing import trace, span, annotate
+from batch_runner import BatchRunner, run_batch, unique_questions, BATCH_WORKERS, BATCH_REQUESTS_PER_MINUTE, \
+    BATCH_TOKENS_PER_MINUTE
+from lexical_index import HybridRetriever, get_lexical_index, chunk_key, reciprocal_rank_fusion, \
+    HYBRID_RETRIEVAL_ENABLED
+
+# Number of documents stuffed into the prompt and the search type of the vector store (e.g. "similarity", "hybrid")
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", 4))
+RETRIEVAL_SEARCH_TYPE = os.getenv("RETRIEVAL_SEARCH_TYPE", None)
+# "auto" only condenses follow-up questions that refer back to the conversation, "always" condenses every question
+CONDENSE_MODE = os.getenv("CONDENSE_MODE", "auto")
+# Words (English and German) that usually refer to something earlier in the conversation
+_FOLLOWUP_PATTERN = re.compile(r"\b(it|its|this|that|these|those|they|them|their|he|him|his|she|her|there|same|"
+                               r"above|previous|more|else|also|es|das|dies|diese|dieser|dieses|er|sie|ihn|ihm|ihr|"
+                               r"ihre|dort|dazu|davon|darüber|damit|mehr|noch|auch)\b", re.IGNORECASE)
+
+# Removes "(...)" and "[...]" from the answer, e.g. the citations
+_BRACKETS_PATTERN = re.compile(r"([\(\[]).*?([\)\]])")
+
+_helpers_lock = threading.Lock()
+_helpers = {}
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_event_loop():
+    # One event loop for the process, running in a daemon thread. The async clients (e.g. the AsyncOpenAI connection
+    # pool of the shared chat model) are bound to the loop they were first used on, so they must not outlive it.
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-helper-loop", daemon=True).start()
+        return _loop
+
+
+def run_async(coroutine):
+    # Run a coroutine from synchronous code (Streamlit scripts, batch workers) on the shared event loop and wait for
+    # the result. The coroutine runs in a copy of the caller's context, so its spans are recorded on the caller's
+    # trace.
+    future = contextvars.copy_context().run(asyncio.run_coroutine_threadsafe, coroutine, _get_event_loop())
+    return future.result()
+
+
+def get_llm_helper(custom_prompt="", temperature=0.7, deployment=LLM_DEPLOYMENT, index_name=INDEX_NAME):
+    # Return the process-wide LLMHelper for this configuration. The helper holds no per-session state, so all
+    # Streamlit sessions can share it, together with its clients and their pooled connections.
+    key = (deployment, float(temperature), custom_prompt, index_name)
+    with _helpers_lock:
+        if key not in _helpers:
+            _helpers[key] = LLMHelper(custom_prompt=custom_prompt, temperature=temperature,
+                                      deployment=deployment, index_name=index_name)
+        return _helpers[key]
+
+
+class QAChains:
+    # The chains for one retrieval configuration. LangChain chains keep no state between calls, so one instance can
+    # serve concurrent sessions without rebuilding and re-validating the chains and prompts for every question.
+
+    def __init__(self, llm, prompt, retriever):
+        # langchain.chains imports all chains and their dependencies, which takes longer than anything else at
+        # startup, so it is only imported for the first chains (or by warmup.py)
+        from langchain.chains import RetrievalQA, LLMChain
+        from langchain.chains.qa_with_sources import load_qa_with_sources_chain
+        from langchain.chains.chat_vector_db.prompts import CONDENSE_QUESTION_PROMPT
+        self.retriever = retriever
+        self.question_generator = LLMChain(llm=llm, prompt=CONDENSE_QUESTION_PROMPT, verbose=False)
+        self.doc_chain = load_qa_with_sources_chain(llm, chain_type="stuff", verbose=False, prompt=prompt)
+        self.retrieval_qa = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever)
 
 
 class LLMHelper:
@@ -20,137 +94,284 @@ class LLMHelper:
     # 1. To answer a question and extract followup questions from the answer
     # 2. To answer a question and get the context of the answer from the source documents
 
-    def __init__(self, custom_prompt="", temperature=0.7):
-        # Initialize the LLM model
-        # TODO: Change to use open source LLM model
-        self.llm = AzureChatOpenAI(
-            azure_deployment="AskSenacor-gpt35turbo-v1",
-            openai_api_version="2023-05-15",
-            temperature=temperature,
-        )
+    def __init__(self, custom_prompt="", temperature=0.7, deployment=LLM_DEPLOYMENT, index_name=INDEX_NAME,
+                 k=RETRIEVAL_K, search_type=RETRIEVAL_SEARCH_TYPE):
+        # Initialize the LLM model, the clients are shared through the process-wide registry. The backends (Azure
+        # OpenAI and/or self-hosted OpenAI-compatible servers) are configured by LLM_BACKENDS.
+        self.llm = get_llm(deployment=deployment, temperature=temperature)
         # Initialize the prompt - this can be customized
         self.prompt = PROMPT if custom_prompt == '' else PromptTemplate(template=custom_prompt,
                                                                         input_variables=["summaries", "question"])
 
-        self.embeddings = AzureOpenAIEmbeddings(
-                azure_deployment="AskSenacor-ada002-v1",
-                openai_api_version="2023-05-15",
-            )
+        self.embeddings = get_embeddings(EMBEDDING_DEPLOYMENT)
         # Initialize the vector store, which is used to store and retrieve the source documents
-        self.vector_store = init_vector_store(
-            embeddings=self.embeddings,
-            index_name="langchain-vector-demo")
+        self.vector_store = get_vector_store(index_name=index_name, embedding_deployment=EMBEDDING_DEPLOYMENT)
+        # BM25 index over the same chunks, used together with the vector store for hybrid retrieval
+        self.lexical_index = get_lexical_index(index_name)
+        # Answers are cached per configuration, the namespace separates helpers with different prompts or models
+        self.answer_cache = get_answer_cache() if ANSWER_CACHE_ENABLED else None
+        self.cache_namespace = f"{deployment}|{temperature}|{index_name}|{self.prompt.template}"
+        # Number of documents retrieved for the context and the search type of the vector store (None: its default)
+        self.k = k
+        self.search_type = search_type
+        # Bounded chat history for the condense step: recent turns verbatim, older turns as a rolling summary
+        self.memory = ConversationMemory(get_llm(deployment=deployment, temperature=0))
+        # Retrieved chunks are merged, deduplicated and cut to a token budget before they are put into the prompt
+        self.context_packer = ContextPacker() if CONTEXT_PACKING_ENABLED else None
+        # Chains are built once per (k, search_type) and shared by all callers of this helper
+        self._chains = {}
+        self._chains_lock = threading.Lock()
+
+    def get_chains(self, k=None, search_type=None):
+        # Return the compiled chains for this helper's prompt and temperature and the given retrieval settings
+        key = (k or self.k, search_type or self.search_type)
+        with self._chains_lock:
+            if key not in self._chains:
+                self._chains[key] = QAChains(self.llm, self.prompt, self.get_retriever(*key))
+            return self._chains[key]
 
     def extract_followupquestions(self, answer):
         # Extract followup questions from the answer, this is an optional feature
-        followupTag = answer.find('Follow-up Questions')
-        followupQuestions = answer.find('<<')
-
-        # take min of followupTag and folloupQuestions if not -1 to avoid taking the followup questions if there is
-        # no followupTag
-        followupTag = min(followupTag, followupQuestions) if followupTag != -1 and followupQuestions != -1 else max(
-            followupTag, followupQuestions)
-        answer_without_followupquestions = answer[:followupTag] if followupTag != -1 else answer
-        followup_questions = answer[followupTag:].strip() if followupTag != -1 else ''
-
-        # Extract the followup questions as a list
-        pattern = r'\<\<(.*?)\>\>'
-        match = re.search(pattern, followup_questions)
-        followup_questions_list = []
-        while match:
-            followup_questions_list.append(followup_questions[match.start() + 2:match.end() - 2])
-            followup_questions = followup_questions[match.end():]
-            match = re.search(pattern, followup_questions)
-
-        if followup_questions_list != '':
-            # Extract follow up question
-            pattern = r'\d. (.*)'
-            match = re.search(pattern, followup_questions)
-            while match:
-                followup_questions_list.append(followup_questions[match.start() + 3:match.end()])
-                followup_questions = followup_questions[match.end():]
-                match = re.search(pattern, followup_questions)
-
-        if followup_questions_list != '':
-            pattern = r'Follow-up Question: (.*)'
-            match = re.search(pattern, followup_questions)
-            while match:
-                followup_questions_list.append(followup_questions[match.start() + 19:match.end()])
-                followup_questions = followup_questions[match.end():]
-                match = re.search(pattern, followup_questions)
-
-        # Special case when 'Follow-up questions:' appears in the answer after the <<
-        followupTag = answer_without_followupquestions.lower().find('follow-up questions')
-        if followupTag != -1:
-            answer_without_followupquestions = answer_without_followupquestions[:followupTag]
-        followupTag = answer_without_followupquestions.lower().find('follow up questions')  # LLM can make variations...
-        if followupTag != -1:
-            answer_without_followupquestions = answer_without_followupquestions[:followupTag]
-
-        return answer_without_followupquestions, followup_questions_list
-
-    def get_semantic_answer_lang_chain(self, question, chat_history):
+        processed = process_answer(answer)
+        return processed.answer, processed.followup_questions
+
+    def prepare_answer(self, question, chat_history, k=None, search_type=None):
+        # Condense, retrieve and look up the answer cache without generating, e.g. for a question that is likely to be
+        # asked next (see followup_prefetch). The result can be passed as prepared to get_semantic_answer_lang_chain
+        # and its streaming variant.
+        chains = self.get_chains(k, search_type)
+        return self._prepare_answer(question, chat_history, chains.question_generator, chains.retriever)
+
+    def get_semantic_answer_lang_chain(self, question, chat_history, k=None, search_type=None, prepared=None):
         # Get the answer from the LLM model including the sources, and takes chat history into account
-        question_generator = LLMChain(llm=self.llm, prompt=CONDENSE_QUESTION_PROMPT, verbose=False)
-        doc_chain = load_qa_with_sources_chain(self.llm, chain_type="stuff", verbose=False, prompt=self.prompt)
-        # TODO: Add a more sophisticated retrieval chain
-        chain = ConversationalRetrievalChain(
-            retriever=self.vector_store.as_retriever(),
-            question_generator=question_generator,
-            combine_docs_chain=doc_chain,
-            return_source_documents=True,
-            # top_k_docs_for_context= self.k
-        )
-        result = chain({"question": question, "chat_history": chat_history})
-        sources = "\n".join(set(map(lambda x: x.metadata["source"], result['source_documents'])))
+        with trace("semantic_answer", history_turns=len(chat_history), prepared=prepared is not None) as current:
+            chains = self.get_chains(k, search_type)
+            condensed_question, source_documents, question_embedding, cached = prepared or self._prepare_answer(
+                question, chat_history, chains.question_generator, chains.retriever)
+            if cached is not None:
+                answer, contextDict, sources = cached
+                return question, answer, contextDict, sources
+
+            context_documents = self.pack_context(source_documents)
+            with span("generate") as generate:
+                output = chains.doc_chain({"input_documents": context_documents, "question": condensed_question})
+                generate.update(prompt_tokens=self._count_tokens(self._build_messages(
+                    chains.doc_chain, context_documents, condensed_question)),
+                    completion_tokens=self._count_tokens(output["output_text"]))
+            result = {"answer": output["output_text"], "source_documents": context_documents}
+            with span("postprocess"):
+                answer, contextDict, sources = self._format_semantic_answer(result)
+            self._store_answer(question_embedding, source_documents, answer, contextDict, sources)
+            current.set(answer_chars=len(answer))
+            return question, answer, contextDict, sources
+
+    def get_semantic_answer_lang_chain_stream(self, question, chat_history, k=None, search_type=None, prepared=None):
+        # Streaming variant of get_semantic_answer_lang_chain. Yields ("partial", answer_so_far) while the LLM is
+        # generating, and finally ("done", (question, answer, contextDict, sources)) like the non-streaming version.
+        with trace("semantic_answer_stream", history_turns=len(chat_history), prepared=prepared is not None) as current:
+            chains = self.get_chains(k, search_type)
+            condensed_question, source_documents, question_embedding, cached = prepared or self._prepare_answer(
+                question, chat_history, chains.question_generator, chains.retriever)
+            if cached is not None:
+                yield "done", (question,) + tuple(cached)
+                return
+
+            # Same prompt as the "stuff" chain builds from the retrieved documents
+            context_documents = self.pack_context(source_documents)
+            messages = self._build_messages(chains.doc_chain, context_documents, condensed_question)
+
+            answer = ""
+            with span("generate", prompt_tokens=self._count_tokens(messages)) as generate:
+                started = time.perf_counter()
+                stream = self.llm.stream(messages)
+                try:
+                    for chunk in stream:
+                        if not answer:
+                            generate["first_token_seconds"] = time.perf_counter() - started
+                        # Only the new text (and the end of the previous one) has to be searched for the sources
+                        # marker
+                        scanned = max(len(answer) - SOURCES_MARKER_OVERLAP, 0)
+                        answer += chunk.content
+                        if find_sources_marker(answer, scanned) != -1:
+                            # The sources list is built from the retrieved documents, no need to wait for the LLM
+                            break
+                        # Hold back the end of the text, it could be the beginning of a "SOURCES:" marker
+                        yield "partial", clean_encoding(answer[:-SOURCES_MARKER_OVERLAP])
+                finally:
+                    # Ends the request to the LLM when the answer is complete early, or the caller stops reading
+                    stream.close()
+                generate["completion_tokens"] = self._count_tokens(answer)
+
+            result = {"answer": answer, "source_documents": context_documents}
+            with span("postprocess"):
+                answer, contextDict, sources = self._format_semantic_answer(result)
+            self._store_answer(question_embedding, source_documents, answer, contextDict, sources)
+            current.set(answer_chars=len(answer))
+            yield "done", (question, answer, contextDict, sources)
+
+    def _build_messages(self, doc_chain, documents, question):
+        from langchain.schema import format_document
+        summaries = doc_chain.document_separator.join(format_document(doc, doc_chain.document_prompt)
+                                                      for doc in documents)
+        return self.prompt.format_prompt(summaries=summaries, question=question).to_messages()
+
+    @staticmethod
+    def _count_tokens(content):
+        # Text or chat messages, the token counts of the prompt and the answer for the traces. tiktoken keeps the
+        # encoding once it is loaded.
+        text = content if isinstance(content, str) else "\n".join(message.content for message in content)
+        return len(tiktoken.get_encoding("cl100k_base").encode(text, disallowed_special=()))
+
+    def pack_context(self, documents):
+        # Documents that are put into the prompt, the token statistics are available from context_packer.last_stats
+        if self.context_packer is None:
+            return documents
+        with span("pack_context") as pack:
+            packed, stats = self.context_packer.pack(documents)
+            pack.update(context_tokens=stats["tokens_out"], saved_tokens=stats["tokens_saved"],
+                        segments=stats["chunks_out"])
+        return packed
+
+    def _prepare_answer(self, question, chat_history, question_generator, retriever):
+        # Condense the question and retrieve the documents (speculatively, see _aretrieve), then look the condensed
+        # question up in the answer cache. Returns the condensed question, the documents, the question embedding
+        # and the cached (answer, contextDict, sources) or None.
+        if self.context_packer is not None:
+            self.context_packer.reset_stats()
+        condensed_question, source_documents = run_async(
+            self._aretrieve(question, chat_history, question_generator, retriever))
+        annotate(retrieved_chunks=len(source_documents), condensed=condensed_question != question)
+        if self.answer_cache is None:
+            return condensed_question, source_documents, None, None
+        with span("embed_question"):
+            question_embedding = self.embeddings.embed_query(condensed_question)
+        with span("answer_cache_lookup") as lookup:
+            entry = self.answer_cache.lookup(question_embedding, namespace=self.cache_namespace)
+            hit = entry is not None and self.answer_cache.validate(entry, self.get_chunk_ids(source_documents))
+            lookup["answer_cache_hit"] = hit
+        return condensed_question, source_documents, question_embedding, entry.value if hit else None
+
+    def _store_answer(self, question_embedding, source_documents, answer, contextDict, sources):
+        if self.answer_cache is not None:
+            with span("answer_cache_store"):
+                self.answer_cache.store(question_embedding, self.get_chunk_ids(source_documents),
+                                        [answer, contextDict, sources], namespace=self.cache_namespace)
+
+    async def _aretrieve(self, question, chat_history, question_generator, retriever):
+        # Retrieval for the raw question starts right away, in parallel to the condense LLM call. If the condensed
+        # question differs from the raw one, it is searched as well and both result lists are merged.
+        raw_retrieval = asyncio.ensure_future(self._aretrieve_documents(retriever, question, "retrieve"))
+        # Fold old turns into the summary in the background, also for questions that are not condensed
+        self.memory.update(chat_history)
+        if not self.needs_condense(question, chat_history):
+            return question, await raw_retrieval
+        try:
+            with span("condense") as condense:
+                formatted_history = self.memory.format(chat_history)
+                condense["history_tokens"] = self._count_tokens(formatted_history)
+                condensed_question = await question_generator.arun(question=question,
+                                                                   chat_history=formatted_history)
+        except Exception:
+            raw_retrieval.cancel()
+            raise
+        if condensed_question.strip().lower() == question.strip().lower():
+            return question, await raw_retrieval
+        condensed_documents, raw_documents = await asyncio.gather(
+            self._aretrieve_documents(retriever, condensed_question, "retrieve_condensed"), raw_retrieval)
+        k = max(len(condensed_documents), len(raw_documents))
+        # The condensed question goes first, it wins ties in the fusion
+        return condensed_question, reciprocal_rank_fusion([condensed_documents, raw_documents])[:k]
+
+    @staticmethod
+    async def _aretrieve_documents(retriever, query, stage):
+        with span(stage) as retrieve:
+            documents = await retriever.aget_relevant_documents(query)
+            retrieve["chunks"] = len(documents)
+        return documents
+
+    @staticmethod
+    def needs_condense(question, chat_history):
+        # Only follow-up questions that refer back to the conversation have to be rewritten by the LLM
+        if not chat_history:
+            return False
+        if CONDENSE_MODE == "always":
+            return True
+        return len(question.split()) <= 4 or bool(_FOLLOWUP_PATTERN.search(question))
+
+    @staticmethod
+    def strip_sources_section(answer):
+        # Remove the sources list the LLM appends to the answer
+        return strip_sources_section(answer)
+
+    @staticmethod
+    def postprocess_answer(answer, filenames=None, sources=None):
+        # Structured post-processing in one pass: answer without sources list and follow-up questions, numbered
+        # citations (if filenames are given), cited sources, follow-up questions and normalized source links
+        return process_answer(answer, filenames, sources)
+
+    def _format_semantic_answer(self, result):
+        # Turn the chain result into the answer text, the context per source and the list of sources
+        # Chunks stand in for their near-duplicates dropped at ingestion, their sources are listed as well
+        sources = "\n".join(set(source for x in result['source_documents']
+                                 for source in [x.metadata["source"]] + x.metadata.get("duplicate_sources", [])))
 
         contextDict = {}
         for res in result['source_documents']:
-            source_key = self.filter_sources_links(res.metadata['source']).replace('\n', '').replace(' ', '')
+            source_key = filter_sources_links(res.metadata['source']).replace('\n', '').replace(' ', '')
             if source_key not in contextDict:
                 contextDict[source_key] = []
-            myPageContent = self.clean_encoding(res.page_content)
+            myPageContent = clean_encoding(res.page_content)
             contextDict[source_key].append(myPageContent)
 
-        result['answer'] = \
-            result['answer'].split('SOURCES:')[0].split('Sources:')[0].split('SOURCE:')[0].split('Source:')[0]
-        result['answer'] = self.clean_encoding(result['answer'])
-        sources = self.filter_sources_links(sources)
+        # The follow-up questions are not requested by the prompt, the answer is kept as the LLM wrote it
+        processed = process_answer(result['answer'], sources=sources, extract_followups=False)
+        return processed.answer, contextDict, processed.sources
+
+    @staticmethod
+    def get_chunk_ids(documents):
+        # Identify the retrieved chunks by source and content, so a changed or re-indexed chunk gets a new id
+        return [chunk_key(doc) for doc in documents]
 
-        return question, result['answer'], contextDict, sources
+    def get_retriever(self, k=4, search_type=None):
+        # Hybrid lexical + vector retriever, or plain vector search if hybrid retrieval is disabled
+        search_kwargs = {"search_type": search_type} if search_type else {}
+        if HYBRID_RETRIEVAL_ENABLED:
+            return HybridRetriever(vector_store=self.vector_store, lexical_index=self.lexical_index, k=k,
+                                   search_kwargs=search_kwargs)
+        return self.vector_store.as_retriever(search_kwargs=dict(search_kwargs, k=k))
 
     # Simple QA
+    def answer_questions(self, questions, workers=BATCH_WORKERS, requests_per_minute=BATCH_REQUESTS_PER_MINUTE,
+                         tokens_per_minute=BATCH_TOKENS_PER_MINUTE):
+        # Answer many questions concurrently, yields one result dict per unique question as soon as it is answered.
+        # Questions are strings or (question, chat_history) pairs.
+        records = [{"question": item} if isinstance(item, str) else {"question": item[0], "chat_history": item[1]}
+                   for item in questions]
+        runner = BatchRunner(self, workers, requests_per_minute, tokens_per_minute)
+        return runner.run(unique_questions(records))
+
+    def answer_questions_file(self, input_path, output_path, workers=BATCH_WORKERS,
+                              requests_per_minute=BATCH_REQUESTS_PER_MINUTE,
+                              tokens_per_minute=BATCH_TOKENS_PER_MINUTE):
+        # JSONL in, JSONL out, resumable: questions already answered in output_path are skipped
+        return run_batch(self, input_path, output_path, workers, requests_per_minute, tokens_per_minute)
+
     def standard_query(self, question, k=3, model_name="gpt-3.5-turbo"):
-        # Create a retriever from the Chroma vector database
-        retriever = self.vector_store.as_retriever(search_kwargs={"k": k})
-        # Create a RetrievalQA from the model and retriever
-        qa = RetrievalQA.from_chain_type(llm=self.llm, chain_type="stuff", retriever=retriever)
-        return qa(question)
+        # RetrievalQA over the vector store and the lexical index, built once per k
+        with trace("standard_query", k=k):
+            with span("retrieval_qa") as retrieval_qa:
+                result = self.get_chains(k).retrieval_qa(question)
+                retrieval_qa["completion_tokens"] = self._count_tokens(result.get("result", ""))
+            return result
 
     def insert_citations_in_answer(self, answer, filenameList):
         # Insert citations in the answer to indicate the source of the answer
         filenameList_lowered = [x.lower() for x in filenameList]    # LLM can make case mitakes in returing the filename of the source
-
-        matched_sources = []
-        pattern = r'\[\[(.*?)\]\]'
-        match = re.search(pattern, answer)
-        while match:
-            filename = match.group(1).split('.')[0] # remove any extension to the name of the source document
-            if filename in filenameList:
-                if filename not in matched_sources:
-                    matched_sources.append(filename.lower())
-                filenameIndex = filenameList.index(filename) + 1
-                answer = answer[:match.start()] + '$^{' + f'{filenameIndex}' + '}$' + answer[match.end():]
-            else:
-                answer = answer[:match.start()] + '$^{' + f'{filename.lower()}' + '}$' + answer[match.end():]
-            match = re.search(pattern, answer)
+        answer, matched_sources = number_citations(answer, filenameList)
 
         # When page is reloaded search for references already added to the answer (e.g. '${(id+1)}')
-        for id, filename in enumerate(filenameList_lowered):
-            reference = '$^{' + f'{id+1}' + '}$'
-            if reference in answer and not filename in matched_sources:
-                matched_sources.append(filename)
-
+        matched_sources += [filename for filename in cited_references(answer, filenameList_lowered)
+                            if filename not in matched_sources]
         return answer, matched_sources, filenameList_lowered
 
     def get_links_filenames(self, answer, sources):
@@ -160,7 +381,7 @@ class LLMHelper:
         for src in split_sources:
             if src != '':
                 srcList.append(src)
-        return re.sub("([\(\[]).*?([\)\]])", "", answer).replace(']', '').replace('[', ''), srcList
+        return _BRACKETS_PATTERN.sub("", answer).replace(']', '').replace('[', ''), srcList
 
     def print_semantic_similarity(self, question, k=3, search_type="similarity"):
         # Can be used to test the semantic search function of the vector store
@@ -175,25 +396,9 @@ class LLMHelper:
     @staticmethod
     def clean_encoding(text):
         # Clean the encoding of the text
-        try:
-            encoding = 'ISO-8859-1'
-            encodedtext = text.encode(encoding)
-            encodedtext = encodedtext.decode('utf-8')
-        except Exception as e:
-            encodedtext = text
-        return encodedtext
+        return clean_encoding(text)
 
     @staticmethod
     def filter_sources_links(sources):
-        # use regex to replace all occurences of '[anypath/anypath/somefilename.xxx](the_link)' to '[somefilename](
-        # thelink)' in sources
-        pattern = r'\[[^\]]*?/([^/\]]*?)\]'
-
-        match = re.search(pattern, sources)
-        while match:
-            withoutExtensions = match.group(1).split('.')[0]  # remove any extension to the name of the source document
-            sources = sources[:match.start()] + f'[{withoutExtensions}]' + sources[match.end():]
-            match = re.search(pattern, sources)
-
-        sources = '  \n ' + sources.replace('\n', '  \n ')  # add a carriage return after each source
-        return sources
+        # Replace '[anypath/anypath/somefilename.xxx](the_link)' by '[somefilename](the_link)', one source per line
+        return filter_sources_links(sources)
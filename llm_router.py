@@ -0,0 +1,270 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Dict, Iterator, List, Optional
+
+import openai
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema.messages import BaseMessage
+from langchain.schema.output import ChatGenerationChunk, ChatResult
+
+from tracing import get_metrics
+
+# Routing between several chat model backends, e.g. Azure OpenAI and the self-hosted Mistral behind vLLM's
+# OpenAI-compatible server (mistral.yaml). Each request goes to the backend with the lowest expected latency, from
+# the observed latency, error rate and the number of requests it is already serving. Timeouts, 429s and server errors
+# fail over to the next backend, a backend that answered with 429 is skipped until its retry-after has passed, and a
+# request that takes much longer than usual on its backend is hedged: the same request is sent to the next backend and
+# the first answer wins. Streams fail over until the first token has arrived.
+
+LLM_HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "true").lower() == "true"
+# A request is hedged when it takes longer than LLM_HEDGE_FACTOR times the usual latency of its backend
+LLM_HEDGE_FACTOR = float(os.getenv("LLM_HEDGE_FACTOR", 2.0))
+LLM_HEDGE_MIN_SECONDS = float(os.getenv("LLM_HEDGE_MIN_SECONDS", 1.0))
+# Additional attempts once every backend has failed for a request
+LLM_ROUTER_RETRIES = int(os.getenv("LLM_ROUTER_RETRIES", 2))
+LLM_ROUTER_WORKERS = int(os.getenv("LLM_ROUTER_WORKERS", 32))
+# Seconds added to the expected latency of a backend per unit of error rate. Without new requests the error rate
+# halves every LLM_ERROR_HALF_LIFE seconds, so a backend that failed is tried again later.
+LLM_ERROR_PENALTY_SECONDS = float(os.getenv("LLM_ERROR_PENALTY_SECONDS", 5.0))
+LLM_ERROR_HALF_LIFE = float(os.getenv("LLM_ERROR_HALF_LIFE", 10.0))
+
+_FAILOVER_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                    openai.InternalServerError)
+# Weight of the latest observation in the moving averages
+_SMOOTHING = 0.2
+
+
+def retry_after_seconds(error):
+    # Retry-after of a 429 response in seconds, or None
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    retry_after = response.headers.get("retry-after-ms")
+    try:
+        return float(retry_after) / 1000 if retry_after else float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class BackendStats:
+    # Observed behaviour of one backend. The latency is the time until the backend answers: the whole response for
+    # generate calls, the first token for streams.
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = None
+        self._error_rate = 0.0
+        self._error_time = time.monotonic()
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+
+    def end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    @property
+    def error_rate(self):
+        return self._error_rate * 0.5 ** ((time.monotonic() - self._error_time) / LLM_ERROR_HALF_LIFE)
+
+    def observe(self, seconds=None, error=None):
+        with self._lock:
+            self._error_rate, self._error_time = self.error_rate, time.monotonic()
+            if isinstance(error, openai.RateLimitError):
+                # A full backend, not a broken one: it is skipped until the retry-after has passed
+                self.failures += 1
+                delay = retry_after_seconds(error)
+                self.cooldown_until = max(self.cooldown_until,
+                                          time.monotonic() + (delay if delay is not None else random.uniform(1, 5)))
+            elif error is not None:
+                self.failures += 1
+                self._error_rate += _SMOOTHING * (1.0 - self._error_rate)
+            elif seconds is not None:
+                self._error_rate -= _SMOOTHING * self._error_rate
+                self.latency = seconds if self.latency is None else self.latency + _SMOOTHING * (seconds - self.latency)
+
+    def expected_latency(self):
+        # Unmeasured backends come first, so every backend gets measured
+        with self._lock:
+            latency = self.latency or 0.0
+            return latency * (1 + self.in_flight) + self.error_rate * LLM_ERROR_PENALTY_SECONDS
+
+    def cooling_down(self):
+        return time.monotonic() < self.cooldown_until
+
+    def to_dict(self):
+        with self._lock:
+            return {"latency": self.latency, "error_rate": self.error_rate, "in_flight": self.in_flight,
+                    "requests": self.requests, "failures": self.failures,
+                    "cooldown_seconds": max(self.cooldown_until - time.monotonic(), 0.0)}
+
+
+class LLMRouter:
+    # Statistics of the backends by name, shared by the routed models of all temperatures
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=LLM_ROUTER_WORKERS)
+
+    def backend_stats(self, name):
+        with self._lock:
+            if name not in self._stats:
+                self._stats[name] = BackendStats(name)
+            return self._stats[name]
+
+    def ranked(self, names):
+        # Backends by expected latency, those in a 429 cooldown last
+        return sorted(names, key=lambda name: (self.backend_stats(name).cooling_down(),
+                                               self.backend_stats(name).expected_latency()))
+
+    def stats(self):
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in self._stats.items()}
+
+
+class RoutedChatModel(BaseChatModel):
+    # Chat model that sends each request to one of its backends (name -> chat model), see above
+    backends: Dict[str, Any]
+    router: Any
+    hedging: bool = LLM_HEDGING_ENABLED
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "routed-chat"
+
+    def _record(self, name, outcome, seconds=None, error=None):
+        self.router.backend_stats(name).observe(seconds, error)
+        metrics = get_metrics()
+        metrics.increment("llm_requests_total", backend=name, result=outcome)
+        if seconds is not None:
+            metrics.observe("llm_backend_latency_seconds", seconds, backend=name)
+
+    def _call(self, name, messages, stop, kwargs, cancelled):
+        stats = self.router.backend_stats(name)
+        # A retry of a rate limited backend waits for its retry-after
+        wait_seconds = stats.cooldown_until - time.monotonic()
+        if wait_seconds > 0:
+            time.sleep(min(wait_seconds, 30))
+        stats.start()
+        started = time.perf_counter()
+        try:
+            result = self.backends[name].generate([messages], stop=stop, **kwargs)
+        except Exception as e:
+            self._record(name, "error", error=e)
+            raise
+        finally:
+            stats.end()
+        if cancelled.is_set():
+            # The other request of a hedge answered first, this one still counts for the latency
+            self._record(name, "hedge_lost", time.perf_counter() - started)
+        else:
+            self._record(name, "ok", time.perf_counter() - started)
+        return ChatResult(generations=result.generations[0], llm_output=result.llm_output)
+
+    def _hedge_after(self, name):
+        latency = self.router.backend_stats(name).latency
+        if not self.hedging or latency is None or len(self.backends) < 2:
+            return None
+        return max(LLM_HEDGE_MIN_SECONDS, LLM_HEDGE_FACTOR * latency)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        attempts = len(self.backends) + LLM_ROUTER_RETRIES
+        cancelled = threading.Event()
+        running, errors, hedged = {}, [], False
+
+        def launch():
+            # Next backend by rank that is not serving this request already
+            names = [name for name in self.router.ranked(self.backends) if name not in running.values()]
+            name = names[0]
+            running[self.router.executor.submit(self._call, name, messages, stop, kwargs, cancelled)] = name
+            return name
+
+        primary = launch()
+        attempts -= 1
+        try:
+            while running:
+                timeout = self._hedge_after(primary) if not hedged and len(running) == 1 and attempts > 0 else None
+                done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    launch()
+                    attempts -= 1
+                    continue
+                for future in done:
+                    running.pop(future)
+                    try:
+                        return future.result()
+                    except _FAILOVER_ERRORS as e:
+                        errors.append(e)
+                        # Fail over, unless the hedge of this request is still running
+                        if attempts > 0 and not running:
+                            primary = launch()
+                            attempts -= 1
+            raise errors[-1]
+        finally:
+            cancelled.set()
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        # Fail over until the first token, after that the answer is committed to its backend
+        errors = []
+        for _ in range(len(self.backends) + LLM_ROUTER_RETRIES):
+            name = self.router.ranked(self.backends)[0]
+            stats = self.router.backend_stats(name)
+            wait_seconds = stats.cooldown_until - time.monotonic()
+            if wait_seconds > 0:
+                time.sleep(min(wait_seconds, 30))
+            stats.start()
+            started = time.perf_counter()
+            try:
+                try:
+                    chunks = self.backends[name].stream(messages, stop=stop, **kwargs)
+                    first = next(chunks, None)
+                except _FAILOVER_ERRORS as e:
+                    self._record(name, "error", error=e)
+                    errors.append(e)
+                    continue
+                except Exception as e:
+                    self._record(name, "error", error=e)
+                    raise
+                self._record(name, "ok", time.perf_counter() - started)
+                if first is None:
+                    return
+                yield ChatGenerationChunk(message=first)
+                for chunk in chunks:
+                    yield ChatGenerationChunk(message=chunk)
+                return
+            finally:
+                # The backend is busy until the stream has ended
+                stats.end()
+        raise errors[-1]
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_llm_router():
+    # One router per process, the statistics of a backend are shared by all models that use it
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = LLMRouter()
+        return _router
@@ -0,0 +1,304 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.schema.vectorstore import VectorStore
+from langchain.vectorstores.utils import maximal_marginal_relevance
+
+# In-process vector index as an alternative to Azure AI Search. The vectors are kept in one NumPy matrix (float32,
+# float16 or int8 quantized), snapshots are memory-mapped on load so a restart does not need to read the whole
+# index. Small indexes are searched brute force, large ones with an inverted file index (IVF): the vectors are
+# clustered with k-means and a query only scans the lists of the closest clusters.
+
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", os.path.join(".cache", "index"))
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float16")
+LOCAL_INDEX_IVF_MIN_SIZE = int(os.getenv("LOCAL_INDEX_IVF_MIN_SIZE", 50000))
+LOCAL_INDEX_IVF_NPROBE = int(os.getenv("LOCAL_INDEX_IVF_NPROBE", 8))
+
+_KMEANS_ITERATIONS = 10
+_KMEANS_SAMPLE_SIZE = 50000
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def _matches(metadata, filter):
+    # filter is a callable on the metadata, or a dict of key -> value (or list of allowed values)
+    if callable(filter):
+        return filter(metadata)
+    for key, value in filter.items():
+        allowed = value if isinstance(value, (list, tuple, set)) else [value]
+        if metadata.get(key) not in allowed:
+            return False
+    return True
+
+
+class LocalVectorStore(VectorStore):
+    # Implements the LangChain VectorStore interface, so as_retriever() and the chains work unchanged
+
+    def __init__(self, embedding, path=None, dtype=LOCAL_INDEX_DTYPE, ivf_min_size=LOCAL_INDEX_IVF_MIN_SIZE,
+                 nprobe=LOCAL_INDEX_IVF_NPROBE):
+        self.embedding = embedding
+        self.path = path
+        self.dtype = dtype
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+        self._vectors = None
+        self._scales = None
+        self._pending = []
+        self._ids = []
+        self._texts = []
+        self._metadatas = []
+        self._rows = {}
+        self._deleted = set()
+        self._centroids = None
+        self._lists = None
+        self._ivf_size = 0
+        if path and self.snapshot_path(path) is not None:
+            self.load(path)
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def __len__(self):
+        return len(self._ids) - len(self._deleted)
+
+    # Storage
+
+    def _quantize(self, vectors):
+        # Returns the stored matrix and the per-row scale (only needed for int8)
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return vectors.astype(self.dtype), None
+
+    def _materialize(self):
+        # Append the pending vectors to the matrix, appending is batched to avoid copying the matrix per document
+        if not self._pending:
+            return
+        vectors, scales = self._quantize(_normalize(np.vstack(self._pending)))
+        self._pending = []
+        if self._vectors is None:
+            self._vectors, self._scales = vectors, scales
+        else:
+            self._vectors = np.concatenate([self._vectors, vectors])
+            if scales is not None:
+                self._scales = np.concatenate([self._scales, scales])
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None):
+        # Add already embedded texts, existing ids are replaced
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        with self._lock:
+            self.delete([i for i in ids if i in self._rows])
+            for text, vector, metadata, id in zip(texts, embeddings, metadatas, ids):
+                self._rows[id] = len(self._ids)
+                self._ids.append(id)
+                self._texts.append(text)
+                self._metadatas.append(metadata)
+                self._pending.append(np.asarray(vector, dtype=np.float32)[None, :])
+        return ids
+
+    def update_metadata(self, ids, metadatas):
+        # Replace the metadata of existing ids, unknown ids are ignored
+        with self._lock:
+            for id, metadata in zip(ids, metadatas):
+                if id in self._rows:
+                    self._metadatas[self._rows[id]] = metadata
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        texts = list(texts)
+        return self.add_embeddings(texts, self.embedding.embed_documents(texts), metadatas, kwargs.get("keys"))
+
+    def delete(self, ids=None, **kwargs):
+        # Rows are only marked as deleted, they are dropped from the matrix when the snapshot is saved
+        with self._lock:
+            for id in ids or []:
+                row = self._rows.pop(id, None)
+                if row is not None:
+                    self._deleted.add(row)
+        return True
+
+    # Search
+
+    def _build_ivf(self):
+        # k-means on a sample of the vectors, then assign every vector to its closest centroid. The matrix is
+        # dequantized in blocks, so building the index does not need a float32 copy of all vectors.
+        size = len(self._ids)
+        n_lists = max(1, int(np.sqrt(size)))
+        rng = np.random.default_rng(0)
+        sample = self._dequantize(np.sort(rng.choice(size, min(size, _KMEANS_SAMPLE_SIZE), replace=False)))
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(_KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        assignment = np.concatenate([np.argmax(self._dequantize(np.arange(start, min(start + 10000, size))) @
+                                               centroids.T, axis=1)
+                                     for start in range(0, size, 10000)])
+        self._centroids = centroids
+        self._lists = [np.flatnonzero(assignment == c) for c in range(n_lists)]
+        self._ivf_size = size
+
+    def _dequantize(self, rows):
+        vectors = self._vectors[rows].astype(np.float32)
+        if self._scales is not None:
+            vectors *= self._scales[rows][:, None]
+        return vectors
+
+    def _candidates(self, query, filter):
+        # Rows that have to be scored: all rows, or the IVF lists closest to the query, minus deleted/filtered rows
+        size = len(self._ids)
+        if size >= self.ivf_min_size:
+            # Rebuild the clustering when the index has grown considerably since the last build
+            if self._centroids is None or size > 1.5 * self._ivf_size:
+                self._build_ivf()
+            closest = np.argsort(-(self._centroids @ query))[:self.nprobe]
+            rows = np.concatenate([self._lists[c] for c in closest] +
+                                  [np.arange(self._ivf_size, size)])
+        else:
+            rows = np.arange(size)
+        if self._deleted:
+            rows = rows[~np.isin(rows, list(self._deleted))]
+        if filter:
+            rows = np.array([row for row in rows if _matches(self._metadatas[row], filter)], dtype=np.int64)
+        return rows
+
+    def _search(self, embedding, k, filter=None):
+        # Returns (rows, scores) of the k most similar vectors, scores are cosine similarities
+        with self._lock:
+            self._materialize()
+            if self._vectors is None:
+                return np.array([], dtype=np.int64), np.array([])
+            query = _normalize(embedding)
+            rows = self._candidates(query, filter)
+            if len(rows) == 0:
+                return rows, np.array([])
+            scores = self._vectors[rows].astype(np.float32) @ query
+            if self._scales is not None:
+                scores *= self._scales[rows]
+            top = np.argpartition(-scores, k - 1)[:k] if len(rows) > k else np.arange(len(rows))
+            top = top[np.argsort(-scores[top])]
+            return rows[top], scores[top]
+
+    def _document(self, row):
+        return Document(page_content=self._texts[row], metadata=self._metadatas[row])
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None, **kwargs):
+        rows, scores = self._search(embedding, k, filter)
+        return [(self._document(row), float(score)) for row, score in zip(rows, scores)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k, filter)
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        return lambda score: (score + 1) / 2
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, filter=None,
+                                                **kwargs):
+        rows, _ = self._search(embedding, fetch_k, filter)
+        if len(rows) == 0:
+            return []
+        with self._lock:
+            candidates = self._dequantize(rows)
+        selected = maximal_marginal_relevance(np.asarray(embedding, dtype=np.float32), candidates, lambda_mult, k)
+        return [self._document(rows[i]) for i in selected]
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5, filter=None, **kwargs):
+        return self.max_marginal_relevance_search_by_vector(self.embedding.embed_query(query), k, fetch_k,
+                                                            lambda_mult, filter)
+
+    # Snapshots
+
+    def save(self, path=None):
+        # Write a compacted snapshot: vectors (and int8 scales) as .npy, texts, metadata and ids as JSON lines. Each
+        # snapshot is a new directory, the CURRENT file names the complete one and is replaced atomically, so a crash
+        # leaves the previous snapshot in use. The current snapshot may still be memory-mapped.
+        path = path or self.path
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._materialize()
+            keep = [row for row in range(len(self._ids)) if row not in self._deleted]
+            snapshot = tempfile.mkdtemp(dir=path, prefix="snapshot-")
+            if self._vectors is not None:
+                np.save(os.path.join(snapshot, "vectors.npy"), np.asarray(self._vectors[keep]), allow_pickle=False)
+                if self._scales is not None:
+                    np.save(os.path.join(snapshot, "scales.npy"), np.asarray(self._scales[keep]), allow_pickle=False)
+            with open(os.path.join(snapshot, "documents.jsonl"), "w", encoding="utf-8") as f:
+                for row in keep:
+                    f.write(json.dumps({"id": self._ids[row], "text": self._texts[row],
+                                        "metadata": self._metadatas[row]}) + "\n")
+            with open(os.path.join(path, "CURRENT.tmp"), "w", encoding="utf-8") as f:
+                f.write(os.path.basename(snapshot))
+            os.replace(os.path.join(path, "CURRENT.tmp"), os.path.join(path, "CURRENT"))
+            self.load(path)
+            # Older snapshots and the files of the layout before snapshot directories
+            for name in os.listdir(path):
+                if name.startswith("snapshot-") and name != os.path.basename(snapshot):
+                    shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+                elif name in ("vectors.npy", "scales.npy", "documents.jsonl"):
+                    os.remove(os.path.join(path, name))
+
+    @staticmethod
+    def snapshot_path(path):
+        # Directory of the current snapshot under path, None if nothing was saved there yet
+        current = os.path.join(path, "CURRENT")
+        if os.path.exists(current):
+            with open(current, encoding="utf-8") as f:
+                return os.path.join(path, f.read().strip())
+        # Snapshots written before there were snapshot directories
+        return path if os.path.exists(os.path.join(path, "documents.jsonl")) else None
+
+    def load(self, path):
+        # The vectors are memory-mapped, pages are only read from disk when a search touches them
+        snapshot = self.snapshot_path(path)
+        with self._lock:
+            vectors_path = os.path.join(snapshot, "vectors.npy")
+            # A snapshot of an empty store has no vectors
+            self._vectors = np.load(vectors_path, mmap_mode="r") if os.path.exists(vectors_path) else None
+            if self._vectors is not None:
+                self.dtype = str(self._vectors.dtype)
+            scales_path = os.path.join(snapshot, "scales.npy")
+            self._scales = np.load(scales_path, mmap_mode="r") if self.dtype == "int8" and \
+                os.path.exists(scales_path) else None
+            self._ids, self._texts, self._metadatas = [], [], []
+            with open(os.path.join(snapshot, "documents.jsonl"), encoding="utf-8") as f:
+                for line in f:
+                    document = json.loads(line)
+                    self._ids.append(document["id"])
+                    self._texts.append(document["text"])
+                    self._metadatas.append(document["metadata"])
+            self._rows = {id: row for row, id in enumerate(self._ids)}
+            self._deleted = set()
+            self._pending = []
+            self._centroids, self._lists, self._ivf_size = None, None, 0
+
+    def persist(self):
+        if self.path:
+            self.save(self.path)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        store = cls(embedding, path=kwargs.get("path"), dtype=kwargs.get("dtype", LOCAL_INDEX_DTYPE))
+        store.add_texts(texts, metadatas, keys=kwargs.get("ids"))
+        return store
@@ -2,22 +2,42 @@ import streamlit as st
 import traceback
 
 from streamlit_chat import message
-from llm_helper import LLMHelper
+from llm_helper import get_llm_helper
+from warmup import start_warm_up
+from customprompt import FOLLOWUP_PROMPT
+from followup_prefetch import FOLLOWUP_PREFETCH_ENABLED, FollowupPrefetcher
 import regex as re
 import os
 from random import randint
 
+# Number of turns shown at once, older turns are revealed page by page
+history_page_size = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", 20))
+
 
 def clear_chat_data():
     # Clear chat history, and all other chat data
     st.session_state['chat_history'] = []
     st.session_state['chat_source_documents'] = []
+    st.session_state['chat_rendered'] = []
+    st.session_state['chat_visible_turns'] = history_page_size
     st.session_state['chat_askedquestion'] = ''
     st.session_state['chat_question'] = ''
-    # st.session_state['chat_followup_questions'] = []
+    st.session_state['chat_followup_questions'] = []
+    if 'chat_prefetcher' in st.session_state:
+        st.session_state['chat_prefetcher'].cancel()
     answer_with_citations = ""
 
 
+def render_turn(llm_helper, question, answer, sources):
+    # Rendered form of a chat turn, computed once when the answer arrives and kept in the session state
+    answer_without_citations, sourceList = llm_helper.get_links_filenames(answer, sources)
+    return {"question": question, "answer": answer_without_citations, "sources": sourceList}
+
+
+def show_earlier_turns():
+    st.session_state['chat_visible_turns'] += history_page_size
+
+
 def questionAsked():
     # Callback to assign the question asked by the user
     st.session_state.chat_askedquestion = st.session_state["input" + str(st.session_state['input_message_key'])]
@@ -41,6 +61,7 @@ def setup_ui():
 
 try:
     setup_ui()
+    start_warm_up()
     # Initialize chat history
     if 'chat_question' not in st.session_state:
         st.session_state['chat_question'] = ''
@@ -50,8 +71,12 @@ try:
         st.session_state['chat_history'] = []
     if 'chat_source_documents' not in st.session_state:
         st.session_state['chat_source_documents'] = []
-    # if 'chat_followup_questions' not in st.session_state:
-    #     st.session_state['chat_followup_questions'] = []
+    if 'chat_rendered' not in st.session_state:
+        st.session_state['chat_rendered'] = []
+    if 'chat_visible_turns' not in st.session_state:
+        st.session_state['chat_visible_turns'] = history_page_size
+    if 'chat_followup_questions' not in st.session_state:
+        st.session_state['chat_followup_questions'] = []
     if 'input_message_key' not in st.session_state:
         st.session_state['input_message_key'] = 1
 
@@ -61,8 +86,12 @@ try:
     user_avatar_style = os.getenv("CHAT_USER_AVATAR_STYLE", "thumbs")
     user_seed = os.getenv("CHAT_USER_SEED", "Bubba")
 
-    # Initialize LLMHelper
-    llm_helper = LLMHelper()
+    # Get the shared LLMHelper, it is only built once per process. With the follow-up prefetch, the answers propose
+    # follow-up questions, which are prepared in the background while the answer is read.
+    llm_helper = get_llm_helper(custom_prompt=FOLLOWUP_PROMPT.template if FOLLOWUP_PREFETCH_ENABLED else "")
+    if FOLLOWUP_PREFETCH_ENABLED and 'chat_prefetcher' not in st.session_state:
+        st.session_state['chat_prefetcher'] = FollowupPrefetcher(llm_helper)
+    prefetcher = st.session_state.get('chat_prefetcher')
 
     # Chat 
     clear_chat = st.button("Clear chat", key="clear_chat", on_click=clear_chat_data)
@@ -71,52 +100,53 @@ try:
     if st.session_state.chat_askedquestion:
         st.session_state['chat_question'] = st.session_state.chat_askedquestion
         st.session_state.chat_askedquestion = ""
-        st.session_state['chat_question'], result, context, sources = llm_helper.get_semantic_answer_lang_chain(
-            st.session_state['chat_question'], st.session_state['chat_history'])
-        # result, chat_followup_questions_list = llm_helper.extract_followupquestions(result)
+        st.session_state['chat_followup_questions'] = []
+        # The prefetched answer or retrieval if the question was proposed, this also cancels the other prefetches
+        prefetched = prefetcher.take(st.session_state['chat_question'], st.session_state['chat_history']) \
+            if prefetcher else None
+        if prefetched is not None and prefetched.answer is not None:
+            st.session_state['chat_question'], result, context, sources = prefetched.answer
+        else:
+            # Stream the answer into a placeholder, it is replaced by the chat history once the answer is complete
+            answer_placeholder = st.empty()
+            for event, value in llm_helper.get_semantic_answer_lang_chain_stream(
+                    st.session_state['chat_question'], st.session_state['chat_history'],
+                    prepared=prefetched.prepared if prefetched else None):
+                if event == "partial":
+                    # The proposed follow-up questions are shown as buttons once the answer is complete
+                    answer_placeholder.markdown(value.split("<<")[0] + "▌")
+                else:
+                    st.session_state['chat_question'], result, context, sources = value
+            answer_placeholder.empty()
+        if FOLLOWUP_PREFETCH_ENABLED:
+            result, st.session_state['chat_followup_questions'] = llm_helper.extract_followupquestions(result)
         st.session_state['chat_history'].append((st.session_state['chat_question'], result))
         st.session_state['chat_source_documents'].append(sources)
-        # st.session_state['chat_followup_questions'] = chat_followup_questions_list
+        st.session_state['chat_rendered'].append(render_turn(llm_helper, st.session_state['chat_question'], result,
+                                                             sources))
+        if prefetcher and st.session_state['chat_followup_questions']:
+            prefetcher.prefetch(st.session_state['chat_followup_questions'], st.session_state['chat_history'])
 
-    # Displays the chat history
+    # Displays the chat history from the rendered turns, only the last page is rendered on a rerun
     if st.session_state['chat_history']:
-        #history_range = range(len(st.session_state['chat_history']) - 1, -1, -1)
-        for i in range(0, len(st.session_state['chat_history']), 1):
-
-            # This history entry is the latest one - also show follow-up questions, buttons to access source(s) context(s) 
-            # if i == history_range.start+1:
-            #
-            #     answer_with_citations, sourceList = llm_helper.get_links_filenames(
-            #         st.session_state['chat_history'][i][1], st.session_state['chat_source_documents'][i])
-            #     st.session_state['chat_history'][i] = st.session_state['chat_history'][i][:1] + (answer_with_citations,)
-            #
-            #     answer_with_citations = re.sub(r'\$\^\{(.*?)\}\$', r'(\1)', st.session_state['chat_history'][i][
-            #         1]).strip()  # message() does not get Latex nor html
-
-                # Display proposed follow-up questions which can be clicked on to ask that question automatically
-                # if len(st.session_state['chat_followup_questions']) > 0:
-                #     st.markdown('**Proposed follow-up questions:**')
-                # with st.container():
-                #     for questionId, followup_question in enumerate(st.session_state['chat_followup_questions']):
-                #         if followup_question:
-                #             str_followup_question = re.sub(r"(^|[^\\\\])'", r"\1\\'", followup_question)
-                #             st.button(str_followup_question, key=randint(1000, 99999), on_click=ask_followup_question,
-                #                       args=(followup_question,))
-                #
-                # for questionId, followup_question in enumerate(st.session_state['chat_followup_questions']):
-                #     if followup_question:
-                #         str_followup_question = re.sub(r"(^|[^\\\\])'", r"\1\\'", followup_question)
-
-            answer_with_citations = re.sub(r'\$\^\{(.*?)\}\$', r'(\1)', st.session_state['chat_history'][i][
-                1])  # message() does not get Latex nor html
-            answer, sourceList = llm_helper.get_links_filenames(st.session_state['chat_history'][i][1],
-                                                                st.session_state['chat_source_documents'][i])
-            message(st.session_state['chat_history'][i][0], is_user=True, key=str(i) + 'user' + '_user',
+        # Turns of sessions that were started before the rendered turns were kept
+        for i in range(len(st.session_state['chat_rendered']), len(st.session_state['chat_history'])):
+            st.session_state['chat_rendered'].append(render_turn(llm_helper, *st.session_state['chat_history'][i],
+                                                                 st.session_state['chat_source_documents'][i]))
+        first_visible = max(len(st.session_state['chat_rendered']) - st.session_state['chat_visible_turns'], 0)
+        if first_visible > 0:
+            st.button(f"Show earlier messages ({first_visible})", key="show_earlier_turns",
+                      on_click=show_earlier_turns)
+        for i in range(first_visible, len(st.session_state['chat_rendered'])):
+            turn = st.session_state['chat_rendered'][i]
+            message(turn["question"], is_user=True, key=str(i) + 'user' + '_user',
                     avatar_style=user_avatar_style, seed=user_seed)
-            message(answer, key=str(i) + 'answers', seed=ai_seed)
-            st.markdown(f'\n\nSources: {sourceList}')
-
+            message(turn["answer"], key=str(i) + 'answers', seed=ai_seed)
+            st.markdown(f'\n\nSources: {turn["sources"]}')
 
+    # Proposed follow-up questions of the last answer
+    for i, followup_question in enumerate(st.session_state['chat_followup_questions']):
+        st.button(followup_question, key="followup" + str(i), on_click=ask_followup_question, args=(followup_question,))
 
     input_text = st.text_input("You: ", placeholder="type your question",
                                key="input" + str(st.session_state['input_message_key']), on_change=questionAsked)
@@ -1,8 +1,11 @@
 import os
+import time
 import traceback
+from datetime import datetime
+
 import streamlit as st
 from dotenv import load_dotenv
-from vector_storage import add_website_to_vector_store, add_confluence_to_vector_store
+from ingestion_jobs import get_job_store, ensure_app_worker, QUEUED, RUNNING, DONE, FAILED
 
 
 # Load environment variables from .env file (Optional)
@@ -19,16 +22,58 @@ def setup_ui():
     st.subheader('Add a website and all of its subpages to the vector store - use with caution!')
 
 
+def show_job(job):
+    # One line per job with its progress, and a cancel button while it is queued or running
+    progress = job.result or job.progress
+    started = datetime.fromtimestamp(job.created).strftime("%Y-%m-%d %H:%M:%S")
+    target = job.params.get("url") or "Confluence"
+    columns = st.columns([3, 1, 5, 1])
+    columns[0].write(f"{started} · {job.kind} · {target}")
+    columns[1].write(job.status + (" (cancelling)" if job.cancel_requested and job.status == RUNNING else ""))
+    if job.status == FAILED:
+        columns[2].error(job.error)
+    elif progress:
+        columns[2].write(f"{progress.get('documents_loaded', 0)} pages fetched, "
+                         f"{progress.get('chunks_embedded', 0)} chunks embedded, "
+                         f"{progress.get('chunks_uploaded', 0)} chunks uploaded "
+                         f"({progress.get('chunks_per_second', 0):.1f} chunks/s"
+                         + (f", {progress['tokens_per_second']:.0f} tokens/s" if "tokens_per_second" in progress
+                            else "")
+                         + f"), {progress.get('chunks_deduplicated', 0)} duplicate chunks dropped")
+    elif job.status == DONE:
+        columns[2].write("Nothing changed")
+    if job.status in (QUEUED, RUNNING) and not job.cancel_requested:
+        if columns[3].button("Cancel", key="cancel" + job.id):
+            get_job_store().cancel(job.id)
+
+
+active = False
 try:
     setup_ui()
+    # Ingestion runs in background jobs, this page only submits them and shows their progress
+    ensure_app_worker()
+    store = get_job_store()
     url = st.text_input("Insert The website URL")
-    if st.button("Add Website", type="secondary"):
+    only_changed = st.checkbox("Only add pages that changed since the last crawl", value=False)
+    if st.button("Add Website", type="secondary") and url:
         # Add the website and crawl over all subpages to the vector store
-        add_website_to_vector_store(url)
+        store.submit("website", {"url": url, "only_changed": only_changed})
 
+    incremental = st.checkbox("Only sync changed Confluence pages", value=True) if CONFLUENCE_URL else False
     if CONFLUENCE_URL and st.button("Add Confluence", type="secondary"):
         # Add defined confluence pages to the vector store
-        add_confluence_to_vector_store()
+        store.submit("confluence", {"incremental": incremental})
+
+    st.subheader("Ingestion jobs")
+    jobs = store.list()
+    for job in jobs:
+        show_job(job)
+    active = any(job.status in (QUEUED, RUNNING) for job in jobs)
 
 except Exception:
-    st.error(traceback.format_exc())
\ No newline at end of file
+    st.error(traceback.format_exc())
+
+if active:
+    # Refresh the progress while jobs are active
+    time.sleep(2)
+    st.rerun()
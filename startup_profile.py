@@ -0,0 +1,71 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# Import-time profiling against a startup budget. Every Streamlit worker start and every page run imports the app
+# modules, so their import time is the cold start of the app. Each module is imported in a fresh interpreter with
+# `python -X importtime`, and the import time of the module and its heaviest packages is reported. The exit code is 1
+# if a module takes longer than the budget, e.g. to catch a new top-level import of a heavy library in CI:
+#
+#   python startup_profile.py
+#   python startup_profile.py vector_storage --budget 0.5 --top 15
+
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", 1.5))
+# The modules the Streamlit pages import
+STARTUP_MODULES = ("llm_helper", "vector_storage", "ingestion_jobs", "warmup")
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def profile_import(module, python=sys.executable):
+    # Returns (seconds, {package: seconds}) for importing module in a fresh interpreter. Packages are the top-level
+    # packages that module pulls in, with the cumulative time of their first import.
+    result = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"], cwd=_ROOT, capture_output=True,
+                            text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[12:].split("|")
+        if cumulative.strip().isdigit():
+            # (cumulative seconds, nesting depth, module name), the header line is skipped
+            entries.append((int(cumulative) / 1e6, len(name) - len(name.lstrip()), name.strip()))
+    # A module is printed after the modules it imported, with a deeper indentation. The interpreter startup (site)
+    # comes before.
+    position = max(i for i, entry in enumerate(entries) if entry[2] == module)
+    seconds, depth, _ = entries[position]
+    packages = {}
+    for package_seconds, package_depth, name in reversed(entries[:position]):
+        if package_depth <= depth:
+            break
+        if "." not in name:
+            packages[name] = package_seconds
+    return seconds, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the import time of the app modules against a budget")
+    parser.add_argument("modules", nargs="*", default=list(STARTUP_MODULES))
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET_SECONDS, help="seconds per module")
+    parser.add_argument("--top", type=int, default=8, help="number of packages to show per module")
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        seconds, packages = profile_import(module)
+        status = "over budget" if seconds > args.budget else "ok"
+        print(f"{module}: {seconds:.3f}s ({status}, budget {args.budget:.3f}s)")
+        for package, package_seconds in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"  {package_seconds:8.3f}s  {package}")
+        if seconds > args.budget:
+            over_budget.append(module)
+    if over_budget:
+        print(f"Over the startup budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import json
+import os
+import sqlite3
+import threading
+
+# Bookkeeping for the incremental Confluence sync: for every page we remember the Confluence version, the last
+# modification time and the ids of the chunks that are currently in the index for it.
+
+SYNC_STATE_PATH = os.getenv("SYNC_STATE_PATH", os.path.join(".cache", "sync_state.sqlite"))
+
+
+class PageState:
+    def __init__(self, page_id, version, last_modified, chunk_ids):
+        self.page_id = page_id
+        self.version = version
+        self.last_modified = last_modified
+        self.chunk_ids = chunk_ids
+
+
+class SyncState:
+    # SQLite table of synced pages, scoped by the index and the Confluence space (or page list) they came from
+
+    def __init__(self, path=SYNC_STATE_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pages (scope TEXT, page_id TEXT, version INTEGER, "
+                         "last_modified TEXT, chunk_ids TEXT, PRIMARY KEY (scope, page_id))")
+        self._db.commit()
+
+    def get_pages(self, scope):
+        # Return a dict page_id -> PageState for all pages synced in this scope
+        with self._lock:
+            rows = self._db.execute("SELECT page_id, version, last_modified, chunk_ids FROM pages WHERE scope = ?",
+                                    (scope,)).fetchall()
+        return {page_id: PageState(page_id, version, last_modified, json.loads(chunk_ids))
+                for page_id, version, last_modified, chunk_ids in rows}
+
+    def set_page(self, scope, page_id, version, last_modified, chunk_ids):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                             (scope, page_id, version, last_modified, json.dumps(chunk_ids)))
+            self._db.commit()
+
+    def invalidate_page(self, scope, page_id):
+        # The page is loaded again by the next incremental sync, its chunk ids are kept
+        with self._lock:
+            self._db.execute("UPDATE pages SET version = -1 WHERE scope = ? AND page_id = ?", (scope, page_id))
+            self._db.commit()
+
+    def remove_page(self, scope, page_id):
+        with self._lock:
+            self._db.execute("DELETE FROM pages WHERE scope = ? AND page_id = ?", (scope, page_id))
+            self._db.commit()
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_sync_state():
+    global _state
+    with _state_lock:
+        if _state is None:
+            _state = SyncState()
+        return _state
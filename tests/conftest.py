@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules live in the repository root, the tests run with `python -m pytest tests` from there or from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
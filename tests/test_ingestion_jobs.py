@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+from ingestion_jobs import JobStore, QUEUED, RUNNING, FAILED, CANCELLED
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite"))
+
+
+def test_claim_takes_the_oldest_job_up_to_max_running(store):
+    first = store.submit("website", {"url": "https://a"})
+    second = store.submit("website", {"url": "https://b"})
+    job = store.claim("w1", max_running=1)
+    assert (job.id, job.status) == (first, RUNNING)
+    assert store.claim("w2", max_running=1) is None
+    assert store.claim("w2", max_running=2).id == second
+
+
+def test_unknown_kind_is_rejected(store):
+    with pytest.raises(ValueError):
+        store.submit("ftp", {})
+
+
+def test_stale_job_is_queued_again_until_max_attempts(store):
+    job_id = store.submit("website", {"url": "https://a"})
+    store.claim("w1", max_attempts=2)
+    time.sleep(0.01)
+    assert store.claim("w2", stale_seconds=0, max_attempts=2).id == job_id
+    time.sleep(0.01)
+    assert store.claim("w3", stale_seconds=0, max_attempts=2) is None
+    job = store.get(job_id)
+    assert job.status == FAILED
+    assert "2 attempts" in job.error
+
+
+def test_requeue_until_max_attempts(store):
+    job_id = store.submit("confluence", {})
+    store.claim("w1")
+    store.requeue(job_id, max_attempts=2)
+    assert store.get(job_id).status == QUEUED
+    store.claim("w1")
+    store.requeue(job_id, max_attempts=2)
+    assert store.get(job_id).status == FAILED
+
+
+def test_cancel(store):
+    queued = store.submit("website", {"url": "https://a"})
+    running = store.submit("website", {"url": "https://b"})
+    store.cancel(queued)
+    assert store.get(queued).status == CANCELLED
+    store.claim("w1")
+    assert not store.heartbeat(running)
+    store.cancel(running)
+    assert store.get(running).status == RUNNING
+    assert store.heartbeat(running, {"documents_loaded": 1})
+    assert store.get(running).progress == {"documents_loaded": 1}
@@ -0,0 +1,65 @@
+import sqlite3
+
+from langchain.docstore.document import Document
+
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+
+
+def doc(content, title="", source="s"):
+    return Document(page_content=content, metadata={"title": title, "source": source})
+
+
+def test_add_search_and_replace():
+    index = LexicalIndex(":memory:")
+    index.add_documents([doc("the billing service"), doc("the search service")], ["1", "2"])
+    assert [d.page_content for d, _ in index.search("billing")] == ["the billing service"]
+    index.add_documents([doc("the invoice service")], ["1"])
+    assert index.count() == 2
+    assert index.search("billing") == []
+    assert [d.page_content for d, _ in index.search("invoice")] == ["the invoice service"]
+
+
+def test_delete_and_update_metadata():
+    index = LexicalIndex(":memory:")
+    index.add_documents([doc("alpha"), doc("beta")], ["1", "2"])
+    index.update_metadata(["2", "unknown"], [{"source": "b", "duplicate_sources": ["c"]}, {}])
+    assert index.search("beta")[0][0].metadata == {"source": "b", "duplicate_sources": ["c"]}
+    index.delete(["1", "unknown"])
+    assert index.count() == 1
+    assert index.search("alpha") == []
+
+
+def test_title_match_ranks_first():
+    index = LexicalIndex(":memory:")
+    index.add_documents([doc("who runs the project", title="Project Falcon"), doc("a project plan"),
+                         doc("another project")], ["1", "2", "3"])
+    assert index.search("falcon project")[0][0].metadata["title"] == "Project Falcon"
+
+
+def test_is_confident_needs_a_clear_margin():
+    assert LexicalIndex.is_confident([(doc("a"), 12.0), (doc("b"), 4.0)])
+    assert LexicalIndex.is_confident([(doc("a"), 12.0)])
+    assert not LexicalIndex.is_confident([(doc("a"), 12.0), (doc("b"), 11.0)])
+    assert not LexicalIndex.is_confident([(doc("a"), 1.0)])
+    assert not LexicalIndex.is_confident([])
+
+
+def test_opens_index_files_without_the_rowid_table(tmp_path):
+    path = str(tmp_path / "lexical.sqlite")
+    db = sqlite3.connect(path)
+    db.execute("CREATE VIRTUAL TABLE chunks USING fts5(chunk_id UNINDEXED, title, content, metadata UNINDEXED)")
+    db.execute("INSERT INTO chunks VALUES ('1', '', 'alpha', '{}')")
+    db.commit()
+    db.close()
+    index = LexicalIndex(path)
+    assert index.count() == 1
+    index.delete(["1"])
+    assert index.search("alpha") == []
+
+
+def test_reciprocal_rank_fusion_prefers_documents_in_both_lists():
+    a, b, c = doc("a"), doc("b"), doc("c")
+    fused = reciprocal_rank_fusion([[a, b], [c, b]])
+    assert [d.page_content for d in fused] == ["b", "a", "c"]
+    # The same chunk from two indexes counts once
+    assert len(reciprocal_rank_fusion([[doc("x")], [doc("x")]])) == 1
@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+import pytest
+
+from local_vector_store import LocalVectorStore
+
+
+def vectors(count, dimensions=8, seed=0):
+    return np.random.default_rng(seed).random((count, dimensions))
+
+
+def test_search_finds_the_closest_vector():
+    store = LocalVectorStore(None, dtype="float32")
+    embeddings = vectors(5)
+    store.add_embeddings([f"text {i}" for i in range(5)], embeddings, [{"n": i} for i in range(5)],
+                         [str(i) for i in range(5)])
+    doc, score = store.similarity_search_by_vector_with_score(list(embeddings[3]), k=1)[0]
+    assert doc.page_content == "text 3"
+    assert score == pytest.approx(1.0, abs=1e-5)
+
+
+def test_add_replaces_existing_ids_and_delete_hides_them():
+    store = LocalVectorStore(None, dtype="float32")
+    store.add_embeddings(["a", "b"], vectors(2), ids=["1", "2"])
+    store.add_embeddings(["a2"], vectors(1, seed=1), ids=["1"])
+    assert len(store) == 2
+    store.delete(["2"])
+    assert len(store) == 1
+    assert [doc.page_content for doc in store.similarity_search_by_vector(list(vectors(1)[0]), k=5)] == ["a2"]
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "int8"])
+def test_save_and_load(tmp_path, dtype):
+    store = LocalVectorStore(None, path=str(tmp_path), dtype=dtype)
+    embeddings = vectors(4)
+    store.add_embeddings(["a", "b", "c", "d"], embeddings, [{"source": s} for s in "abcd"], ["1", "2", "3", "4"])
+    store.delete(["2"])
+    store.persist()
+    loaded = LocalVectorStore(None, path=str(tmp_path))
+    assert len(loaded) == 3
+    assert loaded.dtype == dtype
+    doc = loaded.similarity_search_by_vector(list(embeddings[2]), k=1)[0]
+    assert (doc.page_content, doc.metadata) == ("c", {"source": "c"})
+
+
+def test_save_keeps_only_the_current_snapshot(tmp_path):
+    store = LocalVectorStore(None, path=str(tmp_path), dtype="int8")
+    store.add_embeddings(["a"], vectors(1), ids=["1"])
+    store.persist()
+    store.add_embeddings(["b"], vectors(1, seed=1), ids=["2"])
+    store.persist()
+    snapshots = [name for name in os.listdir(tmp_path) if name.startswith("snapshot-")]
+    assert len(snapshots) == 1
+    assert LocalVectorStore.snapshot_path(str(tmp_path)) == os.path.join(str(tmp_path), snapshots[0])
+    assert len(LocalVectorStore(None, path=str(tmp_path))) == 2
+
+
+def test_empty_store_is_saved_and_loaded(tmp_path):
+    LocalVectorStore(None, path=str(tmp_path)).persist()
+    store = LocalVectorStore(None, path=str(tmp_path))
+    assert len(store) == 0
+    assert store.similarity_search_by_vector(list(vectors(1)[0]), k=2) == []
+    store.add_embeddings(["a"], vectors(1), ids=["1"])
+    store.persist()
+    assert len(LocalVectorStore(None, path=str(tmp_path))) == 1
+
+
+def test_loads_the_flat_layout_of_earlier_snapshots(tmp_path):
+    np.save(os.path.join(tmp_path, "vectors.npy"), vectors(1).astype("float16"))
+    with open(os.path.join(tmp_path, "documents.jsonl"), "w", encoding="utf-8") as f:
+        f.write('{"id": "1", "text": "a", "metadata": {}}\n')
+    store = LocalVectorStore(None, path=str(tmp_path))
+    assert len(store) == 1
+    store.persist()
+    assert not os.path.exists(os.path.join(tmp_path, "vectors.npy"))
+    assert len(LocalVectorStore(None, path=str(tmp_path))) == 1
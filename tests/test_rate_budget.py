@@ -0,0 +1,23 @@
+from embedding_scheduler import RateBudget
+
+
+def test_try_acquire_respects_the_token_and_request_budget():
+    budget = RateBudget(tokens_per_minute=100, requests_per_minute=3)
+    assert budget.try_acquire(60)
+    assert not budget.try_acquire(60)
+    assert budget.try_acquire(40)
+    budget = RateBudget(tokens_per_minute=1000, requests_per_minute=2)
+    assert budget.try_acquire(1) and budget.try_acquire(1)
+    assert not budget.try_acquire(1)
+
+
+def test_oversized_requests_are_capped_at_the_budget():
+    budget = RateBudget(tokens_per_minute=100, requests_per_minute=10)
+    assert budget.try_acquire(500)
+    assert not budget.try_acquire(1)
+
+
+def test_block_for_stops_booking():
+    budget = RateBudget(tokens_per_minute=100, requests_per_minute=10)
+    budget.block_for(30)
+    assert not budget.try_acquire(1)
@@ -0,0 +1,278 @@
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Per-stage tracing of questions and ingestion runs. A trace is opened per operation (e.g. one question) and collects
+# a span per stage with its duration and attributes (token counts, retrieved chunks, cache hits). Finished traces are
+# - aggregated into Prometheus metrics, served on METRICS_PORT and/or written to METRICS_PATH,
+# - appended to the JSONL trace log at TRACE_LOG_PATH, if set,
+# - kept as the last trace of the thread, e.g. for the timing panel of the Direct Query page.
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", None)
+METRICS_PATH = os.getenv("METRICS_PATH", None)
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+_METRICS_PREFIX = "asksenacor_"
+_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_last_traces = threading.local()
+
+
+class Trace:
+    # Spans are appended from the event loop and worker threads of the same operation, so access is locked
+
+    def __init__(self, operation, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.operation = operation
+        self.attributes = dict(attributes)
+        self.spans = []
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.duration = None
+        self._lock = threading.Lock()
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add_span(self, name, duration, offset=None, **attributes):
+        # Record a stage that was measured elsewhere, e.g. the accumulated busy time of an ingestion stage
+        with self._lock:
+            self.spans.append({"name": name, "offset": offset, "duration": duration, "attributes": attributes})
+
+    @contextmanager
+    def span(self, name, **attributes):
+        # Yields the attribute dict of the span, the stage can add attributes while it runs
+        started = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            self.add_span(name, time.perf_counter() - started, started - self._started, **attributes)
+
+    def stage_durations(self):
+        # Total duration per stage name, stages can occur more than once (e.g. two retrievals)
+        durations = {}
+        for span in self.spans:
+            durations[span["name"]] = durations.get(span["name"], 0.0) + span["duration"]
+        return durations
+
+    def to_dict(self):
+        with self._lock:
+            return {"trace_id": self.trace_id, "operation": self.operation, "started_at": self.started_at,
+                    "duration": self.duration, "attributes": dict(self.attributes), "spans": list(self.spans)}
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+        _last_traces.trace = self
+        # Telemetry must never fail the operation or hide its error
+        try:
+            get_metrics().record(self)
+            if TRACE_LOG_PATH:
+                _write_trace_log(self)
+            if METRICS_PATH:
+                get_metrics().write(METRICS_PATH)
+        except Exception as e:
+            print(f"Writing the trace of {self.operation} failed: {type(e).__name__}: {e}")
+
+
+@contextmanager
+def trace(operation, **attributes):
+    # Open a trace for the operation, spans and annotations of the code inside are recorded on it. Nested calls
+    # (e.g. standard_query inside another traced operation) are recorded as spans of the outer trace.
+    outer = _current_trace.get()
+    if not TRACING_ENABLED or outer is not None:
+        with span(operation, **attributes):
+            yield outer or Trace(operation, **attributes)
+        return
+    current = Trace(operation, **attributes)
+    # Set (not reset) the previous value, generators may finish the trace from another context
+    _current_trace.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        _current_trace.set(outer)
+        current.finish()
+
+
+@contextmanager
+def span(name, **attributes):
+    # Span on the current trace, does nothing outside of a trace
+    current = _current_trace.get()
+    if current is None:
+        yield attributes
+        return
+    with current.span(name, **attributes) as span_attributes:
+        yield span_attributes
+
+
+def annotate(**attributes):
+    # Add attributes to the current trace, if there is one
+    current = _current_trace.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def last_trace():
+    # The last finished trace of the calling thread
+    return getattr(_last_traces, "trace", None)
+
+
+_log_lock = threading.Lock()
+
+
+def _write_trace_log(finished_trace):
+    line = json.dumps(finished_trace.to_dict(), default=str)
+    with _log_lock:
+        if os.path.dirname(TRACE_LOG_PATH):
+            os.makedirs(os.path.dirname(TRACE_LOG_PATH), exist_ok=True)
+        with open(TRACE_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def _labels(labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}" if labels else ""
+
+
+class Metrics:
+    # Counters and duration histograms in the Prometheus text format
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, {"buckets": [0] * len(_DURATION_BUCKETS), "sum": 0.0,
+                                                          "count": 0})
+            for i, bound in enumerate(_DURATION_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def record(self, finished_trace):
+        # Durations per operation and stage; numeric *_tokens attributes, retrieved chunks, boolean *_cache_hit and
+        # counted *_cache_hits / *_cache_misses attributes of the trace and its spans become counters
+        operation = finished_trace.operation
+        self.increment("operations_total", operation=operation,
+                       status="error" if "error" in finished_trace.attributes else "ok")
+        self.observe("operation_duration_seconds", finished_trace.duration, operation=operation)
+        for span in finished_trace.spans:
+            self.observe("stage_duration_seconds", span["duration"], operation=operation, stage=span["name"])
+        attribute_sets = [finished_trace.attributes] + [span["attributes"] for span in finished_trace.spans]
+        for attributes in attribute_sets:
+            for key, value in attributes.items():
+                if isinstance(value, bool) and key.endswith("_cache_hit"):
+                    self.increment("cache_requests_total", cache=key[:-len("_cache_hit")],
+                                   result="hit" if value else "miss")
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    if key.endswith("_cache_hits") or key.endswith("_cache_misses"):
+                        cache, result = key.rsplit("_cache_", 1)
+                        self.increment("cache_requests_total", value, cache=cache,
+                                       result="hit" if result == "hits" else "miss")
+                    elif key.endswith("_tokens"):
+                        self.increment("tokens_total", value, operation=operation, kind=key[:-7])
+                    elif key in ("retrieved_chunks", "chunks_uploaded", "chunks_embedded", "chunks_deduplicated"):
+                        self.increment(key + "_total", value, operation=operation)
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: dict(value, buckets=list(value["buckets"]))
+                          for key, value in self._histograms.items()}
+        lines, typed = [], set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {_METRICS_PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{_METRICS_PREFIX}{name}{_labels(dict(labels))} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {_METRICS_PREFIX}{name} histogram")
+                typed.add(name)
+            labels = dict(labels)
+            for bound, count in zip(_DURATION_BUCKETS, histogram["buckets"]):
+                lines.append(f"{_METRICS_PREFIX}{name}_bucket{_labels(dict(labels, le=bound))} {count}")
+            lines.append(f"{_METRICS_PREFIX}{name}_bucket{_labels(dict(labels, le='+Inf'))} {histogram['count']}")
+            lines.append(f"{_METRICS_PREFIX}{name}_sum{_labels(labels)} {histogram['sum']}")
+            lines.append(f"{_METRICS_PREFIX}{name}_count{_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # Text file for the node_exporter textfile collector, replaced atomically. Every writer has its own
+        # temporary file, traces finish concurrently in several threads.
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=directory or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def start_metrics_server(port, metrics):
+    # Serves the metrics on http://<host>:<port>/metrics from a daemon thread
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_metrics():
+    # One metrics registry per process, the endpoint is started with it if METRICS_PORT is set
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+            if METRICS_PORT:
+                start_metrics_server(METRICS_PORT, _metrics)
+        return _metrics
@@ -1,14 +1,21 @@
+import hashlib
 import os
 from dotenv import load_dotenv
 
-from langchain.document_loaders import WebBaseLoader, ConfluenceLoader
-from langchain.embeddings import AzureOpenAIEmbeddings
-from langchain.text_splitter import CharacterTextSplitter, RecursiveCharacterTextSplitter
-
-from langchain.vectorstores.azuresearch import AzureSearch
-import requests
-from bs4 import BeautifulSoup
 from enum import Enum
+from urllib.parse import urlparse
+
+from local_vector_store import LocalVectorStore, LOCAL_INDEX_PATH
+from client_registry import get_vector_store, get_ingestion_embeddings, get_embedding_scheduler
+from chunk_dedup import ChunkDeduplicator, get_dedup_store, DEDUP_ENABLED
+from embedding_cache import CachedEmbeddings
+from ingestion_pipeline import IngestionPipeline
+from lexical_index import get_lexical_index
+from sync_state import get_sync_state
+from tracing import trace, span
+
+# The document loaders, text splitters, the crawler and the Azure SDK are imported by the functions that use them, so
+# importing this module stays cheap for pages and workers that need only part of it (see startup_profile.py)
 
 # Load environment variables from .env file (Optional)
 load_dotenv()
@@ -17,9 +24,14 @@ CONFLUENCE_URL = os.getenv("CONFLUENCE_URL", None)
 CONFLUENCE_USERNAME = os.getenv("CONFLUENCE_USERNAME", None)
 CONFLUENCE_API_KEY = os.getenv("CONFLUENCE_API_KEY", None)
 CONFLUENCE_TOKEN = os.getenv("CONFLUENCE_TOKEN", None)
+# Fetch pages concurrently and parse attachments in a process pool, see confluence_fetcher
+CONFLUENCE_PARALLEL_LOADING = os.getenv("CONFLUENCE_PARALLEL_LOADING", "true").lower() == "true"
+ATTACHMENT_CACHE_ENABLED = os.getenv("ATTACHMENT_CACHE_ENABLED", "true").lower() == "true"
 
 vector_store_address: str = os.getenv("YOUR_AZURE_SEARCH_ENDPOINT")
 vector_store_password: str = os.getenv("YOUR_AZURE_SEARCH_ADMIN_KEY")
+# "azure" for Azure AI Search, "local" for the in-process index (offline use and tests)
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "azure")
 
 
 class ContentFormat(str, Enum):
@@ -45,8 +57,11 @@ def print_semantic_similarity(question, vector_store, k=3, search_type="similari
     print(docs[0].page_content)
 
 
-def init_vector_store(embeddings, index_name="langchain-vector-demo"):
+def init_vector_store(embeddings, index_name="langchain-vector-demo", backend=VECTOR_STORE_BACKEND):
     # Initialize the vector store, which is used to store and retrieve the source documents
+    if backend == "local":
+        return LocalVectorStore(embeddings, path=os.path.join(LOCAL_INDEX_PATH, index_name))
+    from langchain.vectorstores.azuresearch import AzureSearch
     index_name: str = index_name
     vector_store: AzureSearch = AzureSearch(
         azure_search_endpoint=vector_store_address,
@@ -57,58 +72,233 @@ def init_vector_store(embeddings, index_name="langchain-vector-demo"):
     return vector_store
 
 
-def add_website_to_vector_store(url):
-    # Add a website to the vector store, and all of its subpages
-    vector_store = init_vector_store(embeddings=AzureOpenAIEmbeddings(
-        azure_deployment="AskSenacor-ada002-v1",
-        openai_api_version="2023-05-15",
-    ),
-        index_name="langchain-vector-demo")
-    # Load all subpages of the website
-    grab = requests.get(url)
-    soup = BeautifulSoup(grab.text, 'html.parser')
-    urls = list({link.get('href') for link in soup.find_all("a")})
-    # Load the data from the website and all subpages
-    loader = WebBaseLoader(urls)
-    data = loader.load()
+def run_ingestion(pipeline, documents):
+    # Run the pipeline and report its throughput, the token throughput is the share of the embedding scheduler.
+    # The run is traced with the busy time of each stage, the embedded tokens and the embedding cache hits.
+    scheduler = get_embedding_scheduler()
+    tokens_before = scheduler.stats()["tokens"]
+    embeddings = pipeline.embeddings
+    cache_before = (embeddings.hits, embeddings.misses) if isinstance(embeddings, CachedEmbeddings) else None
+    with trace("ingestion", run_id=pipeline.run_id) as current:
+        with span("pipeline"):
+            pipeline.run(documents)
+        # The local index only becomes durable with a new snapshot
+        if isinstance(pipeline.vector_store, LocalVectorStore):
+            with span("persist"):
+                pipeline.vector_store.persist()
+        stats = pipeline.stats()
+        stats["tokens_embedded"] = scheduler.stats()["tokens"] - tokens_before
+        stats["tokens_per_second"] = stats["tokens_embedded"] / stats["seconds"] if stats["seconds"] else 0.0
+        for stage, seconds in stats["stage_seconds"].items():
+            current.add_span(stage, seconds)
+        current.set(documents_loaded=stats["documents_loaded"], chunks_embedded=stats["chunks_embedded"],
+                    chunks_uploaded=stats["chunks_uploaded"], embedded_tokens=stats["tokens_embedded"])
+        if pipeline.deduplicator is not None:
+            current.set(**pipeline.deduplicator.stats())
+        if cache_before is not None:
+            current.set(embedding_cache_hits=embeddings.hits - cache_before[0],
+                        embedding_cache_misses=embeddings.misses - cache_before[1])
+    return stats
+
+
+def add_website_to_vector_store(url, only_changed=False, on_progress=None, cancel_event=None):
+    # Add a website to the vector store, and all of its subpages.
+    # With only_changed=True pages that did not change since the last crawl (HTTP 304) are skipped.
+    # on_progress and cancel_event are passed to the IngestionPipeline, see ingestion_jobs.
+    from langchain.text_splitter import CharacterTextSplitter
+    from web_crawler import crawl_website, CrawlState, WebCrawler
+    vector_store = get_vector_store(index_name="langchain-vector-demo")
     # Split the loaded data
     # TODO: Add a more sophisticated text splitter
     text_splitter = CharacterTextSplitter(separator='\n',
                                           chunk_size=500,
                                           chunk_overlap=40)
 
-    docs = text_splitter.split_documents(data)
-    for i, d in enumerate(docs):
-        d.metadata["chunk_id"] = str(i)
-    # Add the documents to the vector store
-    vector_store.add_documents(documents=docs)
+    chunk_count = [0]
 
+    def number_chunks(page, chunks):
+        for d in chunks:
+            d.metadata["chunk_id"] = str(chunk_count[0])
+            chunk_count[0] += 1
+        return chunks
 
-def add_confluence_to_vector_store(page_ids=["209421559", "209421568", "209421563"]):
-    # Load data from the specified Confluence site and the specified pages
-    embeddings = AzureOpenAIEmbeddings(
-        azure_deployment="AskSenacor-ada002-v1",
-        openai_api_version="2023-05-15",
-    )
-    vector_store = init_vector_store(embeddings, index_name="langchain-vector-demo")
+    # Boilerplate is learned per website
+    deduplicator = ChunkDeduplicator("langchain-vector-demo", "langchain-vector-demo|" + urlparse(url).netloc) \
+        if DEDUP_ENABLED else None
+    # Pages that could not be fetched are skipped, their number is reported as crawl_errors. A failing start page
+    # raises.
+    crawler = WebCrawler(state=CrawlState(), only_changed=only_changed)
+
+    def report_progress(stats):
+        stats["crawl_errors"] = crawler.errors
+        on_progress(stats)
+
+    # Crawl the website and all subpages, pages are split, embedded and uploaded while the crawl continues
+    pipeline = IngestionPipeline(vector_store, get_ingestion_embeddings(), text_splitter, run_id="website|" + url,
+                                 prepare=number_chunks, lexical_index=get_lexical_index("langchain-vector-demo"),
+                                 deduplicator=deduplicator,
+                                 on_progress=report_progress if on_progress else None, cancel_event=cancel_event)
+    stats = run_ingestion(pipeline, crawl_website(url, crawler=crawler))
+    stats["crawl_errors"] = crawler.errors
+    return stats
+
+
+def get_confluence_loader(page_ids):
+    # Create the Confluence loader and the arguments to load the configured space or pages
+    from langchain.document_loaders import ConfluenceLoader
+    from confluence_fetcher import ParallelConfluenceLoader, get_attachment_cache
     # Username and API Token
     if CONFLUENCE_API_KEY:
         loader = ConfluenceLoader(
             url=CONFLUENCE_URL, username=CONFLUENCE_USERNAME, api_key=CONFLUENCE_API_KEY
         )
-        data = loader.load(space_key="SPACE", include_attachments=True, limit=50)
+        load_kwargs = dict(space_key="SPACE", include_attachments=True, limit=50)
     # This is the preferred way to authenticate
     elif CONFLUENCE_TOKEN:
         loader = ConfluenceLoader(url=CONFLUENCE_URL, token=CONFLUENCE_TOKEN)
-        data = loader.load(page_ids=page_ids, content_format=ContentFormat.VIEW)
+        load_kwargs = dict(page_ids=page_ids, content_format=ContentFormat.VIEW)
+    else:
+        raise ValueError("Neither CONFLUENCE_API_KEY nor CONFLUENCE_TOKEN is set")
+    if CONFLUENCE_PARALLEL_LOADING:
+        loader = ParallelConfluenceLoader(loader, cache=get_attachment_cache() if ATTACHMENT_CACHE_ENABLED else None)
+    return loader, load_kwargs
+
+
+def list_confluence_pages(loader, load_kwargs):
+    # Return page_id -> (version, last_modified) for all pages in scope, without loading their content. Configured
+    # page ids that no longer exist are left out, so their chunks are removed.
+    from confluence_fetcher import ParallelConfluenceLoader, get_page_version
+    if isinstance(loader, ParallelConfluenceLoader):
+        return loader.list_pages(space_key=load_kwargs.get("space_key"), page_ids=load_kwargs.get("page_ids"),
+                                 limit=load_kwargs.get("limit", 50))
+    pages = {}
+    if load_kwargs.get("space_key"):
+        start, limit = 0, load_kwargs.get("limit", 50)
+        while True:
+            batch = loader.confluence.get_all_pages_from_space(space=load_kwargs["space_key"], start=start,
+                                                                limit=limit, status="current", expand="version")
+            for page in batch:
+                pages[page["id"]] = (page["version"]["number"], page["version"]["when"])
+            if len(batch) < limit:
+                break
+            start += limit
+    else:
+        for page_id in load_kwargs["page_ids"]:
+            version = get_page_version(loader.confluence, page_id)
+            if version is not None:
+                pages[page_id] = version
+    return pages
+
+
+def load_confluence_pages(loader, load_kwargs, page_ids, group_size=10):
+    # Load the pages in small groups, so the pipeline can start before the whole space is downloaded. The parallel
+    # loader streams the pages itself.
+    from confluence_fetcher import ParallelConfluenceLoader
+    if isinstance(loader, ParallelConfluenceLoader):
+        yield from loader.lazy_load(**dict(load_kwargs, page_ids=page_ids))
+        return
+    for start in range(0, len(page_ids), group_size):
+        yield from loader.load(**dict(load_kwargs, page_ids=page_ids[start:start + group_size]))
+
+
+def make_chunk_id(page_id, text, seen):
+    # Content-derived chunk id: editing a page only changes the ids of the chunks whose text changed.
+    # Identical chunks within the same page get a running suffix to keep the ids unique.
+    chunk_id = hashlib.sha256(f"{page_id}\n{text}".encode("utf-8")).hexdigest()[:32]
+    seen[chunk_id] = seen.get(chunk_id, 0) + 1
+    return chunk_id if seen[chunk_id] == 1 else f"{chunk_id}_{seen[chunk_id] - 1}"
+
+
+def delete_chunks_from_vector_store(vector_store, chunk_ids, index_name="langchain-vector-demo"):
+    # Remove chunks by key from the index and from the lexical index
+    from langchain.vectorstores.azuresearch import AzureSearch
+    from langchain_community.vectorstores.azuresearch import FIELDS_ID
+    if not chunk_ids:
+        return
+    get_lexical_index(index_name).delete(chunk_ids)
+    if isinstance(vector_store, AzureSearch):
+        # The same key field as the upload, see upload_embedded_documents
+        vector_store.client.delete_documents(documents=[{FIELDS_ID: chunk_id} for chunk_id in chunk_ids])
+    else:
+        vector_store.delete(chunk_ids)
+
+
+def add_confluence_to_vector_store(page_ids=["209421559", "209421568", "209421563"], incremental=False,
+                                   on_progress=None, cancel_event=None):
+    # Load data from the specified Confluence site and the specified pages.
+    # With incremental=True only pages whose Confluence version changed since the last sync are loaded and split.
+    # In both modes unchanged chunks are not re-uploaded, and chunks of changed or deleted pages are removed.
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    vector_store = get_vector_store(index_name="langchain-vector-demo")
+    loader, load_kwargs = get_confluence_loader(page_ids)
+    state = get_sync_state()
+    scope = "langchain-vector-demo|" + (load_kwargs.get("space_key") or ",".join(sorted(page_ids)))
+
+    pages = list_confluence_pages(loader, load_kwargs)
+    known_pages = state.get_pages(scope)
+
+    dedup_store = get_dedup_store()
+
+    def invalidate_dependent_pages(page_id):
+        # Pages whose chunks were dropped as duplicates of chunks of this page are loaded again by the next sync
+        for dependent in dedup_store.dependent_sources("langchain-vector-demo", page_id):
+            state.invalidate_page(scope, dependent)
+
+    # Pages that disappeared from Confluence lose all their chunks
+    deleted_page_ids = set(known_pages) - set(pages)
+    for page_id in deleted_page_ids:
+        delete_chunks_from_vector_store(vector_store, known_pages[page_id].chunk_ids)
+        state.remove_page(scope, page_id)
+        invalidate_dependent_pages(page_id)
+        dedup_store.forget_source("langchain-vector-demo", page_id)
+    # Read the state again, the pages invalidated above are loaded in this run
+    known_pages = state.get_pages(scope)
+    changed_page_ids = [page_id for page_id, (version, _) in pages.items()
+                        if not incremental or page_id not in known_pages or known_pages[page_id].version != version]
+    if not changed_page_ids:
+        if deleted_page_ids and isinstance(vector_store, LocalVectorStore):
+            # run_ingestion persists the local index otherwise, the sync state has already forgotten the pages
+            vector_store.persist()
+        return {}
+
+    load_kwargs = {key: value for key, value in load_kwargs.items() if key not in ("space_key", "limit")}
 
     # Split the loaded data
     # TODO: Add a more sophisticated text splitter
     text_splitter = RecursiveCharacterTextSplitter(separators=['\n', '\n\n', ' '],
                                                    chunk_size=500,
                                                    chunk_overlap=40)
+    new_chunk_ids = {}
+
+    def assign_chunk_ids(page, chunks):
+        # Give every chunk its content-derived id, chunks with an already known id are in the index already
+        page_id = page.metadata["id"]
+        old_ids = set(known_pages[page_id].chunk_ids) if page_id in known_pages else set()
+        seen = {}
+        for d in chunks:
+            d.metadata["page_id"] = page_id
+            d.metadata["id"] = make_chunk_id(page_id, d.page_content, seen)
+        new_chunk_ids[page_id] = [d.metadata["id"] for d in chunks]
+        return [d for d in chunks if d.metadata["id"] not in old_ids]
+
+    def finish_page(page_id):
+        # All new chunks of the page are uploaded, now remove the outdated ones and remember the synced version
+        new_ids = new_chunk_ids.pop(page_id)
+        old_ids = set(known_pages[page_id].chunk_ids) if page_id in known_pages else set()
+        outdated_ids = list(old_ids - set(new_ids))
+        delete_chunks_from_vector_store(vector_store, outdated_ids)
+        if outdated_ids:
+            invalidate_dependent_pages(page_id)
+        version, last_modified = pages[page_id]
+        state.set_page(scope, page_id, version, last_modified, new_ids)
 
-    docs = text_splitter.split_documents(data)
-    for i, d in enumerate(docs):
-        d.metadata["id"] = d.metadata["id"] + '_' + str(i)
-    vector_store.add_documents(documents=docs)
\ No newline at end of file
+    # Boilerplate is learned per Confluence space (or set of pages)
+    deduplicator = ChunkDeduplicator("langchain-vector-demo", scope) if DEDUP_ENABLED else None
+    pipeline = IngestionPipeline(vector_store, get_ingestion_embeddings(), text_splitter,
+                                 run_id=f"confluence|{scope}|{'incremental' if incremental else 'full'}",
+                                 source_key=lambda d: d.metadata["id"], prepare=assign_chunk_ids,
+                                 on_source_done=finish_page,
+                                 lexical_index=get_lexical_index("langchain-vector-demo"),
+                                 deduplicator=deduplicator,
+                                 on_progress=on_progress, cancel_event=cancel_event)
+    return run_ingestion(pipeline, load_confluence_pages(loader, load_kwargs, changed_page_ids))
@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+import threading
+import traceback
+
+from tracing import trace, span
+
+# Warm-up after a deploy or a restart. The modules import their heavy libraries (langchain chains, loaders, the
+# Azure SDK) only when they are first used, so the first question would pay for the imports, the clients, the
+# token encoding and the TLS handshakes. The warm-up does all of that once: it builds the shared LLMHelper and its
+# chains, sends one embedding request and runs one search, without calling the LLM.
+#
+# The Streamlit pages start it in a background thread of the server process (WARMUP_ON_START), a deploy can run it
+# as a readiness check before traffic is switched over:
+#
+#   python warmup.py
+
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "true").lower() == "true"
+WARMUP_QUERY = os.getenv("WARMUP_QUERY", "warm-up")
+
+_started = False
+_lock = threading.Lock()
+
+
+def warm_up(llm_helper=None):
+    # Returns the seconds per warm-up stage, raises if a client does not work
+    with trace("warmup") as current:
+        with span("clients"):
+            if llm_helper is None:
+                from llm_helper import get_llm_helper
+                llm_helper = get_llm_helper()
+        with span("chains"):
+            chains = llm_helper.get_chains()
+            llm_helper._count_tokens(WARMUP_QUERY)
+        with span("embed"):
+            # The uncached client, a cached text would not open a connection
+            embeddings = getattr(llm_helper.embeddings, "embeddings", llm_helper.embeddings)
+            embeddings.embed_query(WARMUP_QUERY)
+        with span("search"):
+            chains.retriever.get_relevant_documents(WARMUP_QUERY)
+    return current.stage_durations()
+
+
+def _warm_up_in_background():
+    try:
+        durations = warm_up()
+        print(f"Warm-up done: {json.dumps({stage: round(seconds, 3) for stage, seconds in durations.items()})}")
+    except Exception:
+        print(f"Warm-up failed: {traceback.format_exc()}")
+
+
+def start_warm_up():
+    # Warm up once per process in a background thread, the pages call this on every rerun
+    global _started
+    if not WARMUP_ON_START:
+        return
+    with _lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_warm_up_in_background, daemon=True).start()
+
+
+def main():
+    try:
+        durations = warm_up()
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+    print(json.dumps(durations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import os
+import queue
+import sqlite3
+import threading
+from urllib.parse import urljoin, urlsplit, urlunsplit, parse_qsl, urlencode
+
+import aiohttp
+from bs4 import BeautifulSoup
+from langchain.docstore.document import Document
+
+# Asynchronous website crawler used by add_website_to_vector_store. Pages are fetched concurrently with a limit per
+# host, links are normalized and deduplicated, and the crawl stays on the start domain up to a maximum depth.
+# ETag / Last-Modified of every page are remembered, so unchanged pages are answered with 304 on the next crawl.
+
+CRAWL_MAX_DEPTH = int(os.getenv("CRAWL_MAX_DEPTH", 2))
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", 500))
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", 20))
+CRAWL_CONCURRENCY_PER_HOST = int(os.getenv("CRAWL_CONCURRENCY_PER_HOST", 4))
+CRAWL_TIMEOUT = float(os.getenv("CRAWL_TIMEOUT", 30))
+CRAWL_STATE_PATH = os.getenv("CRAWL_STATE_PATH", os.path.join(".cache", "crawl_state.sqlite"))
+
+_SKIPPED_SCHEMES = ("mailto:", "javascript:", "tel:", "data:")
+_SKIPPED_EXTENSIONS = (".pdf", ".zip", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".ico", ".css", ".js", ".mp4",
+                       ".mp3", ".woff", ".woff2")
+
+
+def normalize_url(url, base_url=None):
+    # Resolve relative links and bring the url into a canonical form, returns None for links that are not crawled
+    if not url or url.strip().lower().startswith(_SKIPPED_SCHEMES):
+        return None
+    url = urljoin(base_url, url.strip()) if base_url else url.strip()
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        return None
+    host = parts.hostname.lower() if parts.hostname else ""
+    if parts.port and not (parts.scheme == "http" and parts.port == 80 or parts.scheme == "https" and parts.port == 443):
+        host = f"{host}:{parts.port}"
+    path = parts.path or "/"
+    if path.lower().endswith(_SKIPPED_EXTENSIONS):
+        return None
+    if len(path) > 1 and path.endswith("/"):
+        path = path[:-1]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    # The fragment only points into the same page
+    return urlunsplit((parts.scheme.lower(), host, path, query, ""))
+
+
+def same_domain(url, domain):
+    host = urlsplit(url).hostname or ""
+    return host == domain or host.endswith("." + domain)
+
+
+class CrawlState:
+    # Remembers the validators and the outgoing links of each page, to send conditional requests on the next crawl
+
+    def __init__(self, path=CRAWL_STATE_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+                         "links TEXT)")
+        self._db.commit()
+
+    def get(self, url):
+        with self._lock:
+            row = self._db.execute("SELECT etag, last_modified, links FROM pages WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None, None, []
+        return row[0], row[1], json.loads(row[2])
+
+    def set(self, url, etag, last_modified, links):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                             (url, etag, last_modified, json.dumps(links)))
+            self._db.commit()
+
+
+def html_to_document(url, html):
+    # Same text extraction and metadata as the WebBaseLoader
+    soup = BeautifulSoup(html, "html.parser")
+    metadata = {"source": url}
+    if soup.find("title"):
+        metadata["title"] = soup.find("title").get_text()
+    description = soup.find("meta", attrs={"name": "description"})
+    if description:
+        metadata["description"] = description.get("content", "No description found.")
+    html_tag = soup.find("html")
+    if html_tag:
+        metadata["language"] = html_tag.get("lang", "No language found.")
+    links = [link.get("href") for link in soup.find_all("a")]
+    return Document(page_content=soup.get_text(), metadata=metadata), links
+
+
+class WebCrawler:
+    # Breadth-first crawler with a global and a per-host concurrency limit
+
+    def __init__(self, max_depth=CRAWL_MAX_DEPTH, max_pages=CRAWL_MAX_PAGES, concurrency=CRAWL_CONCURRENCY,
+                 concurrency_per_host=CRAWL_CONCURRENCY_PER_HOST, timeout=CRAWL_TIMEOUT, state=None,
+                 only_changed=False):
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.concurrency_per_host = concurrency_per_host
+        self.timeout = timeout
+        self.state = state
+        # When only_changed is set, pages answered with 304 Not Modified are not emitted again
+        self.only_changed = only_changed
+        self.pages_fetched = 0
+        self.pages_not_modified = 0
+        self.errors = 0
+        self._host_semaphores = {}
+
+    def _host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.concurrency_per_host)
+        return self._host_semaphores[host]
+
+    async def _fetch(self, session, url):
+        # Fetch one page, returns (document or None, raw links)
+        etag, last_modified, cached_links = self.state.get(url) if self.state else (None, None, [])
+        # Validators are only sent when unchanged pages may be skipped, a 304 carries no content
+        if not self.only_changed:
+            etag, last_modified = None, None
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        async with self._host_semaphore(url):
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    self.pages_not_modified += 1
+                    return None, cached_links
+                response.raise_for_status()
+                if "html" not in response.headers.get("Content-Type", "text/html"):
+                    return None, []
+                html = await response.text(errors="replace")
+                new_etag = response.headers.get("ETag")
+                new_last_modified = response.headers.get("Last-Modified")
+        document, links = html_to_document(url, html)
+        self.pages_fetched += 1
+        if self.state:
+            self.state.set(url, new_etag, new_last_modified, links)
+        return document, links
+
+    async def crawl(self, start_url):
+        # Async generator that yields every fetched page as a Document as soon as it has been downloaded
+        start_url = normalize_url(start_url)
+        domain = urlsplit(start_url).hostname
+        seen = {start_url}
+        pending = set()
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+            async def fetch(url, depth):
+                return url, depth, await self._fetch(session, url)
+
+            start = asyncio.ensure_future(fetch(start_url, 0))
+            pending.add(start)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        url, depth, (document, links) = task.result()
+                    except Exception:
+                        # Without the start page there is nothing to crawl, other pages are counted and skipped
+                        if task is start:
+                            raise
+                        self.errors += 1
+                        continue
+                    if depth < self.max_depth:
+                        for link in links:
+                            link = normalize_url(link, url)
+                            if link and link not in seen and same_domain(link, domain) and \
+                                    len(seen) < self.max_pages:
+                                seen.add(link)
+                                pending.add(asyncio.ensure_future(fetch(link, depth + 1)))
+                    if document is not None:
+                        yield document
+
+
+def crawl_website(start_url, **kwargs):
+    # Synchronous generator over the crawled pages. The event loop runs in a background thread, so the caller can
+    # split (and embed) the pages while the crawler is still downloading the next ones.
+    # Pass a WebCrawler as crawler to read its counters (e.g. errors) while and after crawling
+    pages = queue.Queue(maxsize=kwargs.pop("buffer_size", 50))
+    done = object()
+    crawler = kwargs.pop("crawler", None) or WebCrawler(**kwargs)
+    errors = []
+    stopped = threading.Event()
+
+    def put(item):
+        # Gives up once the consumer has stopped early, e.g. a cancelled ingestion
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def produce():
+        loop = asyncio.get_running_loop()
+        async for document in crawler.crawl(start_url):
+            # Blocks only this producer while the consumer is behind, the fetches keep running on the loop
+            if not await loop.run_in_executor(None, put, document):
+                return
+
+    def run():
+        try:
+            asyncio.run(produce())
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(done)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            document = pages.get()
+            if document is done:
+                break
+            yield document
+    finally:
+        stopped.set()
+    thread.join()
+    if errors:
+        raise errors[0]